@@ -0,0 +1,84 @@
+"""
+Benchmark writing the local SLR file with and without pre-compressed chunks.
+
+Writes the same local samples with the NetCDF library's own compression, then
+with chunks compressed by a pool of threads and written directly with h5py,
+reporting the wall time, throughput and file size of each, and checking that
+every file reads back the same. Needs the h5py extra. Run like
+
+    python benchmarks/compression.py --nsamps 20000 --nlocations 1000 --threads 1 2 4 8
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import dask.array as da
+import numpy as np
+import xarray as xr
+
+from ssp_landwaterstorage.core import Locations
+from ssp_landwaterstorage.io import write_lslr
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--nsamps", type=int, default=20_000)
+    parser.add_argument("--nyears", type=int, default=10)
+    parser.add_argument("--nlocations", type=int, default=200)
+    parser.add_argument("--chunk-layout", default="by-location")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--overlap", action="store_true")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    targyears = 2020 + 10 * np.arange(args.nyears)
+    sites = Locations(
+        name=np.array([str(i) for i in range(args.nlocations)]),
+        id=np.arange(args.nlocations),
+        lat=np.linspace(-60, 60, args.nlocations),
+        lon=np.linspace(0, 350, args.nlocations),
+    )
+    # Smooth sample paths scaled per location, like localized projections.
+    gslr = np.cumsum(rng.normal(size=(args.nsamps, args.nyears)), axis=1)
+    local_sl = (
+        gslr[:, :, np.newaxis] * rng.uniform(0.5, 1.5, size=args.nlocations)
+    ).astype("f4")
+    # Localization chunks of 50 locations, the default --chunksize.
+    chunks = (args.nsamps, args.nyears, 50)
+    nbytes = local_sl.nbytes
+    print(
+        f"{args.nsamps} samples x {args.nyears} years x {args.nlocations} locations,"
+        f" {nbytes / 2**20:.1f} MiB of local samples, {args.chunk_layout} chunks"
+    )
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for threads in [None, *args.threads]:
+            fl = os.path.join(tmpdir, f"lslr-{threads}.nc")
+            start = time.perf_counter()
+            write_lslr(
+                fl,
+                local_sl=da.from_array(local_sl, chunks=chunks),
+                targyears=targyears,
+                n_samps=args.nsamps,
+                baseyear=2005,
+                scenario="ssp5",
+                locations=sites,
+                overlap=args.overlap,
+                chunk_layout=args.chunk_layout,
+                compression_threads=threads,
+            )
+            elapsed = time.perf_counter() - start
+            with xr.open_dataset(fl) as ds:
+                same = np.array_equal(ds["sea_level_change"].values, local_sl)
+            name = "netCDF library" if threads is None else f"{threads} threads"
+            print(
+                f"  {name:<16} {elapsed:8.3f}s  {nbytes / 2**20 / elapsed:8.1f} MiB/s"
+                f"  {os.path.getsize(fl) / 2**20:8.1f} MiB on disk"
+                f"  {'identical' if same else 'DIFFERENT'}"
+            )
+
+
+if __name__ == "__main__":
+    main()
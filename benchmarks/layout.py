@@ -0,0 +1,97 @@
+"""
+Benchmark the memory layout of global samples on their way to the writers.
+
+Projection yields samples in the (samples, years) order they are written to
+disk in. This writes and localizes such samples, and the same samples as a
+transposed view of a (years, samples) array, the previous layout, reporting
+the wall time and the bytes numpy allocates along the way. Run like
+
+    python benchmarks/layout.py --nsamps 1000000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from ssp_landwaterstorage.core import Locations, postprocess
+from ssp_landwaterstorage.io import write_gslr
+
+
+def measure(func):
+    """Call func, returning its wall time in seconds and peak traced allocation in bytes."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--nsamps", type=int, default=200_000)
+    parser.add_argument("--nyears", type=int, default=10)
+    parser.add_argument("--nlocations", type=int, default=8)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    targyears = 2020 + 10 * np.arange(args.nyears)
+    sites = Locations(
+        name=np.array([str(i) for i in range(args.nlocations)]),
+        id=np.arange(args.nlocations),
+        lat=np.linspace(-60, 60, args.nlocations),
+        lon=np.linspace(0, 350, args.nlocations),
+    )
+    coefficients = rng.normal(size=args.nlocations)
+    layouts = {
+        "samples x years": rng.normal(size=(args.nsamps, args.nyears)),
+        "years x samples, transposed": np.ascontiguousarray(
+            rng.normal(size=(args.nsamps, args.nyears)).T
+        ).T,
+    }
+    gslr_bytes = args.nsamps * args.nyears * 8
+    # Load the kernels before timing anything.
+    postprocess(np.ones((1, 1)), None, sites, 1, coefficients=coefficients).compute()
+    print(
+        f"{args.nsamps} samples x {args.nyears} years x {args.nlocations} locations,"
+        f" {gslr_bytes / 2**20:.1f} MiB of global samples"
+    )
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, gslr in layouts.items():
+            fl = os.path.join(tmpdir, "gslr.nc")
+            steps = {
+                "write_gslr": lambda fl=fl, gslr=gslr: write_gslr(
+                    fl,
+                    lwssamps=gslr,
+                    targyears=targyears,
+                    n_samps=args.nsamps,
+                    pipeline_id="benchmark",
+                    baseyear=2005,
+                    scenario="ssp5",
+                ),
+                "shared memory input": lambda gslr=gslr: np.ascontiguousarray(gslr),
+                "localize": lambda gslr=gslr: postprocess(
+                    gslr,
+                    None,
+                    sites,
+                    (args.nsamps, args.nlocations),
+                    coefficients=coefficients,
+                ).compute(),
+            }
+            print(f"\n{name} (C-contiguous: {gslr.flags.c_contiguous})")
+            for step, func in steps.items():
+                elapsed, peak = measure(func)
+                print(
+                    f"  {step:<20} {elapsed:8.3f}s  peak allocated"
+                    f" {peak / gslr_bytes:5.2f}x global samples"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,54 +2,191 @@
 Logic for the CLI.
 """
 
+import json
+import logging
+import signal
+import threading
+
 import click
+from dask.utils import format_bytes, parse_bytes
+
+from ssp_landwaterstorage.core import (
+    COMPUTE_DTYPES,
+    DEFAULT_QUANTILES,
+    SWEEP_PARAMETERS,
+)
+from ssp_landwaterstorage.io import chunk_shape, read_manifest
+from ssp_landwaterstorage.kernels import BACKENDS
+from ssp_landwaterstorage.service import (
+    batch_landwaterstorage,
+    estimate_landwaterstorage,
+    project_landwaterstorage,
+    run_preprocess_stage,
+    run_fit_stage,
+    run_project_stage,
+    run_localize_stage,
+    serve_landwaterstorage,
+    sweep_landwaterstorage,
+)
 
-from ssp_landwaterstorage.service import project_landwaterstorage
 
+def _validate_chunk_layout(ctx, param, value):
+    if value is not None:
+        try:
+            chunk_shape(value, 1, 1, 1)
+        except ValueError as e:
+            raise click.BadParameter(str(e)) from e
+    return value
 
-@click.command()
-@click.option(
+
+def _parse_max_memory(ctx, param, value):
+    if value is not None:
+        value = parse_bytes(value)
+    return value
+
+
+def _parse_sweep(ctx, param, value):
+    out = {}
+    for item in value:
+        name, sep, values = item.partition("=")
+        name = name.strip().replace("-", "_")
+        if not sep or name not in SWEEP_PARAMETERS:
+            raise click.BadParameter(
+                f"expected NAME=V1,V2,... with NAME one of {', '.join(SWEEP_PARAMETERS)}, got {item!r}"
+            )
+        try:
+            out[name] = [float(v) for v in values.split(",")]
+        except ValueError as e:
+            raise click.BadParameter(f"invalid values in {item!r}") from e
+    return out
+
+
+def _parse_quantiles(ctx, param, value):
+    try:
+        out = tuple(float(q) for q in value.split(","))
+    except ValueError as e:
+        raise click.BadParameter(
+            f"expected comma-separated numbers, got {value!r}"
+        ) from e
+    if not all(0 < q < 1 for q in out):
+        raise click.BadParameter(f"quantiles must be within (0, 1), got {value!r}")
+    return out
+
+
+def _check_population_input(popscen_file, population_ensemble_file) -> None:
+    if (popscen_file is None) == (population_ensemble_file is None):
+        raise click.UsageError(
+            "Give either --popscen-file or --population-ensemble-file."
+        )
+
+
+def _check_run_options(
+    resume,
+    checkpoint_dir,
+    processes,
+    scheduler_address,
+    batch_size,
+    popscen_file,
+    population_ensemble_file,
+    bootstrap=None,
+    dotriangular=False,
+) -> None:
+    """Check the run command's options that only clash in combination."""
+    if resume and checkpoint_dir is None:
+        raise click.UsageError("--resume requires --checkpoint-dir.")
+    if processes is not None and scheduler_address is not None:
+        raise click.UsageError("Use either --processes or --scheduler-address.")
+    if batch_size is not None and processes is not None:
+        raise click.UsageError("--batch-size cannot be combined with --processes.")
+    if bootstrap is not None and dotriangular:
+        raise click.UsageError("--bootstrap cannot be combined with --dotriangular.")
+    _check_population_input(popscen_file, population_ensemble_file)
+
+
+def _location_sets(location_file, output_lslr_file):
+    """
+    Pair up repeated --location-file and --output-lslr-file options.
+
+    A single pair is passed on as plain paths, like before they could repeat.
+    """
+    if len(location_file) != len(output_lslr_file):
+        raise click.UsageError(
+            f"Got {len(location_file)} --location-file but "
+            f"{len(output_lslr_file)} --output-lslr-file options, give one of each per location set."
+        )
+    if len(location_file) == 1:
+        return location_file[0], output_lslr_file[0]
+    return list(location_file), list(output_lslr_file)
+
+
+def _add_options(*options):
+    """Apply click options in the order they are listed."""
+
+    def decorator(f):
+        for option in reversed(options):
+            f = option(f)
+        return f
+
+    return decorator
+
+
+pipeline_id_option = click.option(
     "--pipeline-id",
     envvar="SSP_LANDWATERSTORAGE_PIPELINE_ID",
     help="Unique identifier for this instance of the module.",
     required=True,
 )
-@click.option(
+
+output_gslr_file_option = click.option(
     "--output-gslr-file",
     envvar="SSP_LANDWATERSTORAGE_OUTPUT_GSLR_FILE",
     help="Path to write output global SLR file.",
     required=True,
     type=str,
 )
-@click.option(
+
+output_lslr_file_option = click.option(
     "--output-lslr-file",
     envvar="SSP_LANDWATERSTORAGE_OUTPUT_LSLR_FILE",
-    help="Path to write output local SLR file.",
+    help="Path to write output local SLR file. Repeat once per --location-file.",
     required=True,
+    multiple=True,
     type=str,
 )
-@click.option(
+
+pophist_file_option = click.option(
     "--pophist-file",
     envvar="SSP_LANDWATERSTORAGE_POPHIST_FILE",
     help="Path to the historical population file.",
     required=True,
     type=str,
 )
-@click.option(
+
+reservoir_file_option = click.option(
     "--reservoir-file",
     envvar="SSP_LANDWATERSTORAGE_RESERVOIR_FILE",
     help="Path to the groundwater impoundment file.",
     required=True,
     type=str,
 )
-@click.option(
+
+popscen_file_option = click.option(
     "--popscen-file",
     envvar="SSP_LANDWATERSTORAGE_POPSCEN_FILE",
-    help="Path to the population scenario file.",
-    required=True,
+    help="Path to the population scenario file. Required unless --population-ensemble-file is given.",
+    default=None,
     type=str,
 )
-@click.option(
+
+population_ensemble_file_option = click.option(
+    "--population-ensemble-file",
+    envvar="SSP_LANDWATERSTORAGE_POPULATION_ENSEMBLE_FILE",
+    help="Path to a CSV of probabilistic population trajectories, a year column then one column per trajectory, to use instead of --popscen-file. Each sample draws one trajectory.",
+    default=None,
+    type=str,
+)
+
+gwd_file_option = click.option(
     "gwd_files",
     "--gwd-file",
     envvar="SSP_LANDWATERSTORAGE_GWD_FILES",
@@ -58,115 +195,479 @@ from ssp_landwaterstorage.service import project_landwaterstorage
     type=str,
     required=True,
 )
-@click.option(
+
+fp_file_option = click.option(
     "--fp-file",
     envvar="SSP_LANDWATERSTORAGE_FP_FILE",
     help="Path to fingerprint file.",
     type=str,
     required=True,
 )
-@click.option(
+
+gwd_fp_variable_option = click.option(
+    "--gwd-fp-variable",
+    envvar="SSP_LANDWATERSTORAGE_GWD_FP_VARIABLE",
+    help="Variable in --fp-file to localize groundwater depletion with.",
+    default="GROUND",
+    show_default=True,
+    type=str,
+)
+
+dam_fp_variable_option = click.option(
+    "--dam-fp-variable",
+    envvar="SSP_LANDWATERSTORAGE_DAM_FP_VARIABLE",
+    help="Variable in --fp-file to localize reservoir impoundment and dam correction with. If it differs from --gwd-fp-variable, the two components are projected separately and localized together in one pass.",
+    default="GROUND",
+    show_default=True,
+    type=str,
+)
+
+location_file_option = click.option(
     "--location-file",
     envvar="SSP_LANDWATERSTORAGE_LOCATION_FILE",
-    help="File containing name, id, lat, and lon of points for localization.",
+    help="File containing name, id, lat, and lon of points for localization. Repeat to localize the same global samples at several sets of points, each written to the --output-lslr-file in the same position.",
     type=str,
     required=True,
+    multiple=True,
     # default="location.lst",
 )
-@click.option(
+
+scenario_option = click.option(
     "--scenario",
     envvar="SSP_LANDWATERSTORAGE_SCENARIO",
     help="Use RCP or SSP scenario.",
     default="rcp85",
 )
-@click.option(
+
+dotriangular_option = click.option(
     "--dotriangular",
     envvar="SSP_LANDWATERSTORAGE_DOTRIANGULAR",
     help="Use triangular distribution for GWD.",
     default=False,
 )
-@click.option(
+
+baseyear_option = click.option(
     "--baseyear",
     envvar="SSP_LANDWATERSTORAGE_BASEYEAR",
     help="Base year to which projections are centered.",
     default=2000,
     type=click.IntRange(2000, 2010),
 )
-@click.option(
+
+pyear_start_option = click.option(
     "--pyear-start",
     envvar="SSP_LANDWATERSTORAGE_PYEAR_START",
     help="Year for which projections start.",
     default=2000,
     type=click.IntRange(min=2000),
 )
-@click.option(
+
+pyear_end_option = click.option(
     "--pyear-end",
     envvar="SSP_LANDWATERSTORAGE_PYEAR_END",
     help="Year for which projections end.",
     default=2100,
     type=click.IntRange(max=2300),
 )
-@click.option(
+
+pyear_step_option = click.option(
     "--pyear-step",
     envvar="SSP_LANDWATERSTORAGE_PYEAR_STEP",
     help="Step size in years between start and end at which projections are produced.",
     default=10,
     type=click.IntRange(min=1),
 )
-@click.option(
+
+nsamps_option = click.option(
     "--nsamps",
     envvar="SSP_LANDWATERSTORAGE_NSAMPS",
     help="Number of samples to generate.",
     default=20000,
 )
-@click.option(
+
+seed_option = click.option(
     "--seed",
     envvar="SSP_LANDWATERSTORAGE_SEED",
     help="Seed value for random number generator.",
     default=1234,
 )
-@click.option(
+
+dcyear_start_option = click.option(
     "--dcyear-start",
     envvar="SSP_LANDWATERSTORAGE_DCYEAR_START",
     help="Year in which dam correction application is started.",
     default=2020,
 )
-@click.option(
+
+dcyear_end_option = click.option(
     "--dcyear-end",
     envvar="SSP_LANDWATERSTORAGE_DCYEAR_END",
     help="Year in which dam correction application is ended.",
     default=2040,
 )
-@click.option(
+
+dcrate_lo_option = click.option(
     "--dcrate-lo",
     envvar="SSP_LANDWATERSTORAGE_DCRATE_LO",
     help="Lower bound of dam correction rate.",
     default=0.0,
 )
-@click.option(
+
+dcrate_hi_option = click.option(
     "--dcrate-hi",
     envvar="SSP_LANDWATERSTORAGE_DCRATE_HI",
     help="Upper bound of dam correction rate.",
     default=0.0,
 )
-@click.option(
+
+chunksize_option = click.option(
     "--chunksize",
     envvar="SSP_LANDWATERSTORAGE_CHUNKSIZE",
     help="Number of locations to process at a time.",
     default=50,
 )
-def main(
+
+dedupe_locations_option = click.option(
+    "--dedupe-locations/--no-dedupe-locations",
+    envvar="SSP_LANDWATERSTORAGE_DEDUPE_LOCATIONS",
+    help="Collapse duplicate locations and order them along a space-filling curve before localization.",
+    default=False,
+)
+
+location_tolerance_option = click.option(
+    "--location-tolerance",
+    envvar="SSP_LANDWATERSTORAGE_LOCATION_TOLERANCE",
+    help="With --dedupe-locations, locations that snap to the same point of a grid spaced this many degrees apart are treated as duplicates. Longitudes wrap around 360.",
+    default=0.0,
+    type=click.FloatRange(min=0.0),
+)
+
+max_memory_option = click.option(
+    "--max-memory",
+    envvar="SSP_LANDWATERSTORAGE_MAX_MEMORY",
+    help="Memory budget for localization, like '4GB'. Overrides --chunksize with chunking derived from the problem shape.",
+    default=None,
+    type=str,
+    callback=_parse_max_memory,
+)
+
+overlap_writes_option = click.option(
+    "--overlap-writes/--no-overlap-writes",
+    envvar="SSP_LANDWATERSTORAGE_OVERLAP_WRITES",
+    help="Compress and write each localized chunk in a background thread while the next chunk is computed.",
+    default=False,
+)
+
+chunk_layout_option = click.option(
+    "--chunk-layout",
+    envvar="SSP_LANDWATERSTORAGE_CHUNK_LAYOUT",
+    help="On-disk chunking of output sea_level_change: 'by-location' for reading all samples at a location and year, 'by-sample' for reading sample paths across years, or an explicit 'samples,years,locations' shape. Defaults to the NetCDF library's chunking.",
+    default=None,
+    type=str,
+    callback=_validate_chunk_layout,
+)
+
+compression_threads_option = click.option(
+    "--compression-threads",
+    envvar="SSP_LANDWATERSTORAGE_COMPRESSION_THREADS",
+    help="Compress output sea_level_change chunks with this many threads and write them pre-compressed, instead of with the NetCDF library's single-threaded compression. Files are the same NetCDF4. Requires the h5py package.",
+    default=None,
+    type=click.IntRange(min=1),
+)
+
+processes_option = click.option(
+    "--processes",
+    envvar="SSP_LANDWATERSTORAGE_PROCESSES",
+    help="Localize with a pool of this many worker processes, sharing the global samples and writing into a memory-mapped buffer next to the local SLR file.",
+    default=None,
+    type=click.IntRange(min=1),
+)
+
+scheduler_address_option = click.option(
+    "--scheduler-address",
+    envvar="SSP_LANDWATERSTORAGE_SCHEDULER_ADDRESS",
+    help="Localize on the dask distributed scheduler at this address, like 'tcp://10.0.0.1:8786'. Only this process writes the local SLR file. Requires the distributed package.",
+    default=None,
+    type=str,
+)
+
+kernels_option = click.option(
+    "--kernels",
+    envvar="SSP_LANDWATERSTORAGE_KERNELS",
+    help="Backend of the projection and localization kernels. 'auto' uses numba if it is installed.",
+    default="auto",
+    type=click.Choice(BACKENDS),
+)
+
+compute_dtype_option = click.option(
+    "--compute-dtype",
+    envvar="SSP_LANDWATERSTORAGE_COMPUTE_DTYPE",
+    help="Precision to compute and hold global and local samples in. Outputs are float32 either way, so float32 halves the memory of the largest arrays.",
+    default="float64",
+    show_default=True,
+    type=click.Choice(COMPUTE_DTYPES),
+)
+
+quantile_tolerance_option = click.option(
+    "--quantile-tolerance",
+    envvar="SSP_LANDWATERSTORAGE_QUANTILE_TOLERANCE",
+    help="Project samples in batches until the Monte Carlo standard error of --quantiles, in mm, is within this tolerance in every year, up to --nsamps samples. The sample count used and the error reached are recorded in the output attributes.",
+    default=None,
+    type=click.FloatRange(min=0, min_open=True),
+)
+
+quantiles_option = click.option(
+    "--quantiles",
+    envvar="SSP_LANDWATERSTORAGE_QUANTILES",
+    help="Comma-separated quantiles whose convergence --quantile-tolerance checks.",
+    default=",".join(str(q) for q in DEFAULT_QUANTILES),
+    show_default=True,
+    type=str,
+    callback=_parse_quantiles,
+)
+
+bootstrap_option = click.option(
+    "--bootstrap",
+    envvar="SSP_LANDWATERSTORAGE_BOOTSTRAP",
+    help="Also fit an ensemble to this many resamples of the historical points, and draw each sample's GWD slope and dam sigmoid from it instead of the percent errors.",
+    default=None,
+    type=click.IntRange(min=1),
+)
+
+bootstrap_seed_option = click.option(
+    "--bootstrap-seed",
+    envvar="SSP_LANDWATERSTORAGE_BOOTSTRAP_SEED",
+    help="Seed value for the --bootstrap resampling.",
+    default=0,
+    show_default=True,
+    type=int,
+)
+
+fit_workers_option = click.option(
+    "--fit-workers",
+    envvar="SSP_LANDWATERSTORAGE_FIT_WORKERS",
+    help="Run the --bootstrap sigmoid fits in a pool of this many worker processes. Defaults to the CPU count.",
+    default=None,
+    type=click.IntRange(min=1),
+)
+
+checkpoint_dir_option = click.option(
+    "--checkpoint-dir",
+    envvar="SSP_LANDWATERSTORAGE_CHECKPOINT_DIR",
+    help="Directory to save preprocess, fit and project stage checkpoints in.",
+    default=None,
+    type=str,
+)
+
+resume_option = click.option(
+    "--resume/--no-resume",
+    envvar="SSP_LANDWATERSTORAGE_RESUME",
+    help="Reuse valid checkpoints in --checkpoint-dir instead of recomputing those stages.",
+    default=False,
+)
+preprocess_dir_option = click.option(
+    "--preprocess-dir",
+    envvar="SSP_LANDWATERSTORAGE_PREPROCESS_DIR",
+    help="Directory holding the output of the preprocess command.",
+    required=True,
+    type=str,
+)
+
+fit_dir_option = click.option(
+    "--fit-dir",
+    envvar="SSP_LANDWATERSTORAGE_FIT_DIR",
+    help="Directory holding the output of the fit command.",
+    required=True,
+    type=str,
+)
+
+project_dir_option = click.option(
+    "--project-dir",
+    envvar="SSP_LANDWATERSTORAGE_PROJECT_DIR",
+    help="Directory holding the output of the project command.",
+    required=True,
+    type=str,
+)
+
+output_dir_option = click.option(
+    "--output-dir",
+    envvar="SSP_LANDWATERSTORAGE_OUTPUT_DIR",
+    help="Directory to write this stage's intermediate output to.",
+    required=True,
+    type=str,
+)
+
+preprocess_options = _add_options(
+    pophist_file_option,
+    reservoir_file_option,
+    popscen_file_option,
+    population_ensemble_file_option,
+    gwd_file_option,
+    scenario_option,
+    dotriangular_option,
+    baseyear_option,
+    pyear_start_option,
+    pyear_end_option,
+    pyear_step_option,
+)
+
+project_options = _add_options(
+    nsamps_option,
+    seed_option,
+    dcyear_start_option,
+    dcyear_end_option,
+    dcrate_lo_option,
+    dcrate_hi_option,
+)
+
+adaptive_options = _add_options(quantile_tolerance_option, quantiles_option)
+
+bootstrap_options = _add_options(
+    bootstrap_option, bootstrap_seed_option, fit_workers_option
+)
+
+localize_options = _add_options(
+    chunksize_option,
+    dedupe_locations_option,
+    location_tolerance_option,
+    max_memory_option,
+    overlap_writes_option,
+    chunk_layout_option,
+    compression_threads_option,
+    processes_option,
+    scheduler_address_option,
+)
+
+
+def _report_estimate(estimate) -> None:
+    """Print resources predicted by ``estimate_landwaterstorage``."""
+    chunksize = estimate["chunksize"]
+    if isinstance(chunksize, tuple):
+        chunks = f"{chunksize[0]} samples x {chunksize[1]} locations"
+    else:
+        chunks = f"{chunksize} locations"
+    runtime = estimate["runtime"]
+    click.echo(
+        f"Problem size: {estimate['nsamps']} samples x {estimate['nyears']} years "
+        f"x {estimate['nlocations']} locations"
+    )
+    click.echo(f"Localization chunks: {chunks}")
+    click.echo(f"Peak memory: {format_bytes(estimate['peak_memory'])}")
+    for name, label in [("gslr", "Global"), ("lslr", "Local")]:
+        click.echo(
+            f"{label} SLR file: about {format_bytes(estimate[f'{name}_compressed_bytes'])}, "
+            f"at most {format_bytes(estimate[f'{name}_bytes'])} before compression (float32)"
+        )
+    click.echo(
+        "Runtime: "
+        + ", ".join(f"{k} {v:.1f}s" for k, v in runtime.items())
+        + f", total {sum(runtime.values()):.1f}s"
+    )
+
+
+class _DefaultGroup(click.Group):
+    """
+    Command group that falls back to the "run" command.
+
+    This keeps the original single-command usage, like
+    ``ssp-landwaterstorage --pipeline-id=1234 ...``, working.
+    """
+
+    def parse_args(self, ctx, args):
+        if not args or (
+            args[0] not in self.commands and args[0] not in ctx.help_option_names
+        ):
+            args = ["run", *args]
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=_DefaultGroup)
+def main() -> None:
+    """
+    Project groundwater depletion and dam impoundment contributions to sea level. See IPCC AR6 WG1 9.6.3.2.6.
+
+    Without a command, runs the full pipeline with "run". The preprocess,
+    fit, project and localize commands run one stage each, passing
+    memory-mapped intermediates between stages through directories. The batch
+    command runs many configurations from a manifest.
+    """
+    logging.basicConfig(level=logging.INFO)
+
+
+@main.command()
+@_add_options(
+    pipeline_id_option,
+    output_gslr_file_option,
+    output_lslr_file_option,
+    pophist_file_option,
+    reservoir_file_option,
+    popscen_file_option,
+    population_ensemble_file_option,
+    gwd_file_option,
+    fp_file_option,
+    gwd_fp_variable_option,
+    dam_fp_variable_option,
+    location_file_option,
+    scenario_option,
+    dotriangular_option,
+    baseyear_option,
+    pyear_start_option,
+    pyear_end_option,
+    pyear_step_option,
+)
+@bootstrap_options
+@project_options
+@adaptive_options
+@localize_options
+@_add_options(
+    kernels_option, compute_dtype_option, checkpoint_dir_option, resume_option
+)
+@click.option(
+    "--batch-size",
+    envvar="SSP_LANDWATERSTORAGE_BATCH_SIZE",
+    help="Project, write and localize this many samples at a time, so memory doesn't grow with --nsamps. Outputs are the same, but the project stage is not checkpointed. With --quantile-tolerance, the number of samples to project before checking convergence instead.",
+    default=None,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--skip-if-current",
+    envvar="SSP_LANDWATERSTORAGE_SKIP_IF_CURRENT",
+    help="Exit early if both output files already carry the provenance hash of these inputs, options and package version.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--profile-dir",
+    envvar="SSP_LANDWATERSTORAGE_PROFILE_DIR",
+    help="Directory to write a cProfile profile of each stage to, as <stage>.prof, and a trace.json of stage spans, localization's dask tasks and memory use in the Chrome trace event format.",
+    default=None,
+    type=str,
+)
+@click.option(
+    "--dry-run",
+    envvar="SSP_LANDWATERSTORAGE_DRY_RUN",
+    help="Only report predicted peak memory, output file sizes and runtime, then exit.",
+    is_flag=True,
+    default=False,
+)
+def run(
     pophist_file,
     reservoir_file,
     popscen_file,
+    population_ensemble_file,
     gwd_files,
     fp_file,
+    gwd_fp_variable,
+    dam_fp_variable,
     scenario,
     dotriangular,
     baseyear,
     pyear_start,
     pyear_end,
     pyear_step,
+    bootstrap,
+    bootstrap_seed,
+    fit_workers,
     nsamps,
     seed,
     pipeline_id,
@@ -174,14 +675,74 @@ def main(
     dcyear_end,
     dcrate_lo,
     dcrate_hi,
+    quantile_tolerance,
+    quantiles,
     location_file,
     chunksize,
     output_gslr_file,
     output_lslr_file,
+    dedupe_locations,
+    location_tolerance,
+    max_memory,
+    overlap_writes,
+    chunk_layout,
+    compression_threads,
+    processes,
+    scheduler_address,
+    kernels,
+    compute_dtype,
+    checkpoint_dir,
+    resume,
+    batch_size,
+    skip_if_current,
+    profile_dir,
+    dry_run,
 ) -> None:
     """
-    Project groundwater depletion and dam impoundment contributions to sea level. See IPCC AR6 WG1 9.6.3.2.6.
+    Run the full pipeline, from input data to global and local SLR files.
     """
+    _check_run_options(
+        resume,
+        checkpoint_dir,
+        processes,
+        scheduler_address,
+        batch_size,
+        popscen_file,
+        population_ensemble_file,
+        bootstrap,
+        dotriangular,
+    )
+    location_file, output_lslr_file = _location_sets(location_file, output_lslr_file)
+    if dry_run:
+        location_files = (
+            [location_file] if isinstance(location_file, str) else location_file
+        )
+        for fl in location_files:
+            if len(location_files) > 1:
+                click.echo(f"Location set {fl}:")
+            _report_estimate(
+                estimate_landwaterstorage(
+                    fl,
+                    baseyear,
+                    pyear_start,
+                    pyear_end,
+                    pyear_step,
+                    nsamps,
+                    chunksize,
+                    dedupe_locations=dedupe_locations,
+                    location_tolerance=location_tolerance,
+                    max_memory=max_memory,
+                    chunk_layout=chunk_layout,
+                    processes=processes,
+                    batch_size=batch_size,
+                    compute_dtype=compute_dtype,
+                    gwd_fp_variable=gwd_fp_variable,
+                    dam_fp_variable=dam_fp_variable,
+                    kernels=kernels,
+                    compression_threads=compression_threads,
+                )
+            )
+        return
     click.echo("Hello from ssp-landwaterstorage!")
     project_landwaterstorage(
         pophist_file,
@@ -206,4 +767,450 @@ def main(
         chunksize,
         output_gslr_file,
         output_lslr_file,
+        dedupe_locations=dedupe_locations,
+        location_tolerance=location_tolerance,
+        max_memory=max_memory,
+        overlap_writes=overlap_writes,
+        chunk_layout=chunk_layout,
+        checkpoint_dir=checkpoint_dir,
+        resume=resume,
+        skip_if_current=skip_if_current,
+        kernels=kernels,
+        processes=processes,
+        scheduler_address=scheduler_address,
+        batch_size=batch_size,
+        quantile_tolerance=quantile_tolerance,
+        quantiles=quantiles,
+        population_ensemble_file=population_ensemble_file,
+        compression_threads=compression_threads,
+        bootstrap=bootstrap,
+        bootstrap_seed=bootstrap_seed,
+        fit_workers=fit_workers,
+        compute_dtype=compute_dtype,
+        gwd_fp_variable=gwd_fp_variable,
+        dam_fp_variable=dam_fp_variable,
+        profile_dir=profile_dir,
+    )
+
+
+def _manifest_run_options(index, entry) -> dict:
+    """
+    Options of a manifest run, with the run command's defaults, conversions and checks.
+    """
+    entry = dict(entry)
+    name = entry.pop("name", None)
+    known = {p.name for p in run.params} - {"dry_run"}
+    if unknown := set(entry) - known:
+        raise click.UsageError(f"Run {index} has unknown options {sorted(unknown)}.")
+    for param in run.params:
+        # Options that repeat on the command line may be one path in a manifest.
+        if param.multiple and isinstance(entry.get(param.name), str):
+            entry[param.name] = [entry[param.name]]
+    try:
+        # Entries stand in for command line options, converted and checked alike.
+        params = run.make_context("run", [], default_map=entry).params
+        params.pop("dry_run")
+        _check_run_options(
+            params["resume"],
+            params["checkpoint_dir"],
+            params["processes"],
+            params["scheduler_address"],
+            params["batch_size"],
+            params["popscen_file"],
+            params["population_ensemble_file"],
+            params["bootstrap"],
+            params["dotriangular"],
+        )
+        params["location_file"], params["output_lslr_file"] = _location_sets(
+            params["location_file"], params["output_lslr_file"]
+        )
+    except click.ClickException as e:
+        raise click.UsageError(f"Run {index}: {e.format_message()}") from e
+    return {"name": name, **params}
+
+
+@main.command("batch")
+@click.option(
+    "--manifest",
+    envvar="SSP_LANDWATERSTORAGE_MANIFEST",
+    help="JSON or TOML file with a list of 'runs', each a table of run options by name, like scenario or location_file, and optional 'defaults' for all runs. Relative paths are relative to the manifest.",
+    required=True,
+    type=str,
+)
+@click.option(
+    "--workers",
+    envvar="SSP_LANDWATERSTORAGE_WORKERS",
+    help="Spread runs over this many worker processes. By default, runs go one after another in this process.",
+    default=None,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--report-file",
+    envvar="SSP_LANDWATERSTORAGE_REPORT_FILE",
+    help="Path to write a JSON report of each run's status, time, reused stages and output sizes.",
+    default=None,
+    type=str,
+)
+def batch_command(manifest, workers, report_file) -> None:
+    """
+    Run many configurations from a manifest, sharing inputs between runs.
+
+    Runs in one process parse each input file, fit each configuration and
+    interpolate fingerprints at each location file only once.
+    """
+    runs = [
+        _manifest_run_options(index, entry)
+        for index, entry in enumerate(read_manifest(manifest))
+    ]
+    reports = batch_landwaterstorage(runs, workers=workers)
+    if report_file is not None:
+        with open(report_file, "w") as f:
+            json.dump(reports, f, indent=2)
+
+    for report in reports:
+        label = report["name"] or f"Run {report['index']}"
+        if report["status"] == "ok":
+            outputs = ", ".join(
+                f"{fl} ({format_bytes(n)})" for fl, n in report["output_bytes"].items()
+            )
+            click.echo(f"{label}: ok in {report['seconds']:.1f}s, wrote {outputs}")
+        else:
+            click.echo(
+                f"{label}: failed in {report['seconds']:.1f}s, {report['error']}"
+            )
+    failed = sum(report["status"] != "ok" for report in reports)
+    if failed:
+        raise click.ClickException(f"{failed} of {len(reports)} runs failed.")
+
+
+@main.command("serve")
+@click.option(
+    "--spool-dir",
+    envvar="SSP_LANDWATERSTORAGE_SPOOL_DIR",
+    help="Directory to pick up JSON job files from, each a table of run options by name like a manifest run. Reports are written next to them.",
+    default=None,
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "--socket-path",
+    envvar="SSP_LANDWATERSTORAGE_SOCKET_PATH",
+    help="Unix socket to take jobs on, one line of JSON each, answered with a line of JSON reporting how the job went.",
+    default=None,
+    type=str,
+)
+@click.option(
+    "--workers",
+    envvar="SSP_LANDWATERSTORAGE_WORKERS",
+    help="Run at most this many jobs at a time.",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--cache-size",
+    envvar="SSP_LANDWATERSTORAGE_CACHE_SIZE",
+    help="Keep at most this many stage outputs, like parsed inputs, fits and fingerprint coefficients, in memory between jobs, dropping the least recently used.",
+    default=32,
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--poll-interval",
+    envvar="SSP_LANDWATERSTORAGE_POLL_INTERVAL",
+    help="Seconds between looks for new jobs in --spool-dir.",
+    default=1.0,
+    show_default=True,
+    type=click.FloatRange(min=0, min_open=True),
+)
+def serve_command(spool_dir, socket_path, workers, cache_size, poll_interval) -> None:
+    """
+    Serve runs as jobs arrive, keeping inputs, fits and fingerprints warm.
+
+    Jobs take the run command's options and defaults. Stops on SIGINT or
+    SIGTERM once running jobs finish.
+    """
+    if spool_dir is None and socket_path is None:
+        raise click.UsageError("Give --spool-dir, --socket-path or both.")
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    try:
+        serve_landwaterstorage(
+            spool_dir=spool_dir,
+            socket_path=socket_path,
+            workers=workers,
+            cache_size=cache_size,
+            poll_interval=poll_interval,
+            prepare=lambda job: _manifest_run_options(job.get("name", "job"), job),
+            stop=stop,
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+@main.command("preprocess")
+@preprocess_options
+@output_dir_option
+def preprocess_command(
+    pophist_file,
+    reservoir_file,
+    popscen_file,
+    population_ensemble_file,
+    gwd_files,
+    scenario,
+    dotriangular,
+    baseyear,
+    pyear_start,
+    pyear_end,
+    pyear_step,
+    output_dir,
+) -> None:
+    """
+    Read and preprocess input data.
+    """
+    _check_population_input(popscen_file, population_ensemble_file)
+    run_preprocess_stage(
+        pophist_file,
+        reservoir_file,
+        popscen_file,
+        gwd_files,
+        scenario,
+        dotriangular,
+        baseyear,
+        pyear_start,
+        pyear_end,
+        pyear_step,
+        output_dir,
+        population_ensemble_file=population_ensemble_file,
+    )
+
+
+@main.command("fit")
+@preprocess_dir_option
+@pipeline_id_option
+@output_dir_option
+@bootstrap_options
+def fit_command(
+    preprocess_dir, pipeline_id, output_dir, bootstrap, bootstrap_seed, fit_workers
+) -> None:
+    """
+    Fit the land water storage submodel to preprocessed data.
+    """
+    run_fit_stage(
+        preprocess_dir,
+        pipeline_id,
+        output_dir,
+        bootstrap=bootstrap,
+        bootstrap_seed=bootstrap_seed,
+        fit_workers=fit_workers,
+    )
+
+
+@main.command("project")
+@preprocess_dir_option
+@fit_dir_option
+@pipeline_id_option
+@project_options
+@adaptive_options
+@output_dir_option
+@click.option(
+    "--output-gslr-file",
+    envvar="SSP_LANDWATERSTORAGE_OUTPUT_GSLR_FILE",
+    help="Path to also write output global SLR file.",
+    default=None,
+    type=str,
+)
+@chunk_layout_option
+@compression_threads_option
+@kernels_option
+@compute_dtype_option
+@click.option(
+    "--batch-size",
+    envvar="SSP_LANDWATERSTORAGE_BATCH_SIZE",
+    help="Project this many samples at a time, so projection temporaries don't grow with --nsamps. The saved samples are the same. With --quantile-tolerance, the number of samples to project before checking convergence instead.",
+    default=None,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--split-components",
+    envvar="SSP_LANDWATERSTORAGE_SPLIT_COMPONENTS",
+    help="Save groundwater depletion and dam samples separately, to localize them with --gwd-fp-variable and --dam-fp-variable.",
+    is_flag=True,
+    default=False,
+)
+def project_command(
+    preprocess_dir,
+    fit_dir,
+    pipeline_id,
+    nsamps,
+    seed,
+    dcyear_start,
+    dcyear_end,
+    dcrate_lo,
+    dcrate_hi,
+    quantile_tolerance,
+    quantiles,
+    output_dir,
+    output_gslr_file,
+    chunk_layout,
+    compression_threads,
+    kernels,
+    compute_dtype,
+    batch_size,
+    split_components,
+) -> None:
+    """
+    Project global samples from a fit.
+    """
+    run_project_stage(
+        preprocess_dir,
+        fit_dir,
+        nsamps,
+        seed,
+        pipeline_id,
+        dcyear_start,
+        dcyear_end,
+        dcrate_lo,
+        dcrate_hi,
+        output_dir,
+        output_gslr_file=output_gslr_file,
+        chunk_layout=chunk_layout,
+        kernels=kernels,
+        quantile_tolerance=quantile_tolerance,
+        quantiles=quantiles,
+        batch_size=batch_size,
+        compression_threads=compression_threads,
+        compute_dtype=compute_dtype,
+        split_components=split_components,
+    )
+
+
+@main.command("localize")
+@project_dir_option
+@fp_file_option
+@gwd_fp_variable_option
+@dam_fp_variable_option
+@location_file_option
+@output_lslr_file_option
+@localize_options
+@kernels_option
+@compute_dtype_option
+def localize_command(
+    project_dir,
+    fp_file,
+    gwd_fp_variable,
+    dam_fp_variable,
+    location_file,
+    output_lslr_file,
+    chunksize,
+    dedupe_locations,
+    location_tolerance,
+    max_memory,
+    overlap_writes,
+    chunk_layout,
+    compression_threads,
+    processes,
+    scheduler_address,
+    kernels,
+    compute_dtype,
+) -> None:
+    """
+    Localize projected global samples and write local SLR.
+    """
+    if processes is not None and scheduler_address is not None:
+        raise click.UsageError("Use either --processes or --scheduler-address.")
+    location_file, output_lslr_file = _location_sets(location_file, output_lslr_file)
+    run_localize_stage(
+        project_dir,
+        fp_file,
+        location_file,
+        output_lslr_file,
+        chunksize,
+        dedupe_locations=dedupe_locations,
+        location_tolerance=location_tolerance,
+        max_memory=max_memory,
+        overlap_writes=overlap_writes,
+        chunk_layout=chunk_layout,
+        kernels=kernels,
+        processes=processes,
+        scheduler_address=scheduler_address,
+        compression_threads=compression_threads,
+        compute_dtype=compute_dtype,
+        gwd_fp_variable=gwd_fp_variable,
+        dam_fp_variable=dam_fp_variable,
+    )
+
+
+@main.command("sweep")
+@_add_options(pipeline_id_option, output_gslr_file_option)
+@preprocess_options
+@project_options
+@click.option(
+    "--sweep",
+    "sweep",
+    envvar="SSP_LANDWATERSTORAGE_SWEEP",
+    help=f"Parameter values to sweep, like 'dcrate_hi=0.1,0.2'. Repeat for a grid over several parameters. One of: {', '.join(SWEEP_PARAMETERS)}.",
+    multiple=True,
+    required=True,
+    callback=_parse_sweep,
+)
+@chunk_layout_option
+@compression_threads_option
+@kernels_option
+@compute_dtype_option
+def sweep_command(
+    pipeline_id,
+    output_gslr_file,
+    pophist_file,
+    reservoir_file,
+    popscen_file,
+    population_ensemble_file,
+    gwd_files,
+    scenario,
+    dotriangular,
+    baseyear,
+    pyear_start,
+    pyear_end,
+    pyear_step,
+    nsamps,
+    seed,
+    dcyear_start,
+    dcyear_end,
+    dcrate_lo,
+    dcrate_hi,
+    sweep,
+    chunk_layout,
+    compression_threads,
+    kernels,
+    compute_dtype,
+) -> None:
+    """
+    Project global SLR over a grid of uncertainty settings in one pass.
+    """
+    _check_population_input(popscen_file, population_ensemble_file)
+    sweep_landwaterstorage(
+        pophist_file,
+        reservoir_file,
+        popscen_file,
+        gwd_files,
+        scenario,
+        dotriangular,
+        baseyear,
+        pyear_start,
+        pyear_end,
+        pyear_step,
+        nsamps,
+        seed,
+        pipeline_id,
+        dcyear_start,
+        dcyear_end,
+        dcrate_lo,
+        dcrate_hi,
+        sweep,
+        output_gslr_file,
+        chunk_layout=chunk_layout,
+        kernels=kernels,
+        population_ensemble_file=population_ensemble_file,
+        compression_threads=compression_threads,
+        compute_dtype=compute_dtype,
     )
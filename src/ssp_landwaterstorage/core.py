@@ -2,16 +2,22 @@
 Core 'business logic'.
 """
 
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from itertools import repeat
 
 import dask.array as da
 import numpy as np
 from numpy import matlib as mb
-from scipy import interpolate
+from scipy import sparse
 from scipy.stats import norm
 from scipy.optimize import curve_fit
 from scipy.special import erf
 
+from ssp_landwaterstorage.kernels import get_kernels
+
 
 @dataclass
 class PopulationHistory:
@@ -47,13 +53,62 @@ class Locations:
     lon: np.ndarray
 
 
+@dataclass
+class LocationMap:
+    """
+    Unique localization slots and the mapping back to the original locations.
+
+    ``index[i]`` is the slot in ``locations`` holding original location ``i``.
+    """
+
+    locations: Locations
+    index: np.ndarray
+    original: Locations
+
+
 @dataclass
 class Fingerprints:
-    """Fingerprint coefficients to interpolate to sites."""
+    """
+    Fingerprint coefficients to interpolate to sites.
+
+    ``fp`` is one field with shape (lat, lon), or several fields on the same
+    grid with shape (fields, lat, lon), named by ``names``.
+    """
 
     fp: np.ndarray
     lat: np.ndarray
     lon: np.ndarray
+    names: tuple[str, ...] | None = None
+
+    def interpolation_weights(self, locations: Locations) -> sparse.csr_array:
+        """
+        Bilinear interpolation weights from the grid to sites.
+
+        Sites outside the grid take the values at its edge, like
+        ``RectBivariateSpline`` with ``kx=1, ky=1``. Longitudes are taken
+        modulo 360 and are not wrapped around the grid.
+
+        Parameters
+        ----------
+        locations: Sites of interest.
+
+        Returns
+        -------
+        Sparse matrix of shape (sites, lat * lon), with the weights of the
+        four grid cells around each site.
+        """
+        rows = np.arange(len(locations.lat))
+        i, u = _bracket(self.lat, locations.lat)
+        j, v = _bracket(self.lon, np.mod(locations.lon, 360))
+        nlon = len(self.lon)
+        cells = np.stack(
+            [i * nlon + j, i * nlon + j + 1, (i + 1) * nlon + j, (i + 1) * nlon + j + 1]
+        )
+        weights = np.stack([(1 - u) * (1 - v), (1 - u) * v, u * (1 - v), u * v])
+        return sparse.csr_array(
+            (weights.ravel(), (np.tile(rows, 4), cells.ravel())),
+            shape=(len(rows), len(self.lat) * nlon),
+        )
 
     def interpolate_coefficients(self, locations: Locations) -> np.ndarray:
         """
@@ -65,19 +120,332 @@ class Fingerprints:
 
         Returns
         -------
-        Vector of fingerprint coefficients for the sites of interst.
+        Vector of fingerprint coefficients for the sites of interst, or one
+        row of them per field, shape (fields, sites).
         """
-        qlat = locations.lat  # [-90, 90]
-        qlon = locations.lon  # [-180, 180]
-
-        fp_interp = interpolate.RectBivariateSpline(
-            self.lat, self.lon, self.fp, kx=1, ky=1
-        )
+        weights = self.interpolation_weights(locations)
+        fields = np.asarray(self.fp, dtype=float)
+        fields = fields.reshape(*fields.shape[:-2], -1)
         # TODO: Why divide by 100?
-        fp_sites = fp_interp.ev(qlat, np.mod(qlon, 360)) / 100
+        fp_sites = (weights @ fields.T).T / 100
         return fp_sites
 
 
+def _bracket(grid, x):
+    """
+    Grid interval of each point and its position within it, clamped to the grid.
+    """
+    x = np.clip(x, grid[0], grid[-1])
+    i = np.clip(np.searchsorted(grid, x, side="right") - 1, 0, len(grid) - 2)
+    return i, (x - grid[i]) / (grid[i + 1] - grid[i])
+
+
+def _hilbert_index(x, y, order):
+    """
+    Distance along a Hilbert curve for integer grid coordinates in [0, 2**order).
+    """
+    n = 2**order
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    d = np.zeros(x.shape, dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = ((x & s) > 0).astype(np.int64)
+        ry = ((y & s) > 0).astype(np.int64)
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve stays continuous.
+        flip = (ry == 0) & (rx == 1)
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        swap = ry == 0
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s //= 2
+    return d
+
+
+def deduplicate_locations(
+    sites: Locations, tolerance: float = 0.0, order: int = 16
+) -> LocationMap:
+    """
+    Collapse duplicate sites into shared slots, ordered along a Hilbert curve.
+
+    Parameters
+    ----------
+    sites: Sites of interest, in file order.
+    tolerance: Sites that snap to the same point of a grid spaced
+        ``tolerance`` degrees in lat and lon share a slot, so sites closer
+        than that may still fall on either side of a grid line. Longitudes
+        wrap, so 360 snaps to the same point as 0. Zero only collapses exact
+        duplicates.
+    order: Number of bits per axis used for the space-filling curve.
+
+    Returns
+    -------
+    Unique slots, in curve order, and the mapping back to ``sites``. Each slot
+    keeps the name, id, and coordinates of its first occurrence in ``sites``.
+    """
+    if tolerance < 0:
+        raise ValueError(f"tolerance must be non-negative, got {tolerance}")
+
+    lat = np.asarray(sites.lat, dtype=np.float64)
+    lon = np.mod(np.asarray(sites.lon, dtype=np.float64), 360)
+    if tolerance > 0:
+        # Wrap again after snapping, points just below 360 can snap up to it.
+        grid_lon = np.round(np.mod(np.round(lon / tolerance) * tolerance, 360), 9)
+        keys = np.stack(
+            [np.round(lat / tolerance), np.where(grid_lon == 360, 0, grid_lon)], axis=1
+        )
+    else:
+        keys = np.stack([lat, lon], axis=1)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    # Order slots along the curve so neighboring chunks cover compact regions.
+    n = 2**order
+    gx = np.clip((lon[first] / 360 * n).astype(np.int64), 0, n - 1)
+    gy = np.clip(((lat[first] + 90) / 180 * n).astype(np.int64), 0, n - 1)
+    curve_order = np.argsort(_hilbert_index(gx, gy, order), kind="stable")
+    keep = first[curve_order]
+
+    # Slot position of each unique key after reordering.
+    slot = np.empty_like(curve_order)
+    slot[curve_order] = np.arange(curve_order.size)
+
+    out = LocationMap(
+        locations=Locations(
+            name=sites.name[keep],
+            id=sites.id[keep],
+            lat=sites.lat[keep],
+            lon=sites.lon[keep],
+        ),
+        index=slot[inverse],
+        original=sites,
+    )
+    return out
+
+
+# Precisions projection and localization can compute in. Both output files
+# store float32 either way.
+COMPUTE_DTYPES = ("float64", "float32")
+
+
+def _compute_dtype(dtype) -> np.dtype:
+    """Check that ``dtype`` is one of ``COMPUTE_DTYPES``."""
+    dtype = np.dtype(dtype)
+    if dtype.name not in COMPUTE_DTYPES:
+        raise ValueError(
+            f"unknown compute dtype {dtype.name!r}, choose from {COMPUTE_DTYPES}"
+        )
+    return dtype
+
+
+def _chunk_bytes_per_element(itemsize: int) -> int:
+    """Bytes of a localized chunk in flight, at ``itemsize`` and again as float32 for writing."""
+    return itemsize if itemsize == 4 else itemsize + 4
+
+
+# Memory used by the interpreter and imported libraries before any data is loaded.
+BASE_MEMORY = 150 * 2**20
+
+# Single-core seconds per unit of work for each stage, calibrated on a
+# 20,000-sample, 11-year, 200-location run with the numpy kernels in float64.
+STAGE_COSTS = {
+    "project": 3.6e-7,  # per sample
+    "write_gslr": 1.9e-7,  # per sample-year
+    "localize": 7.5e-9,  # per sample-year-location
+    "write_lslr": 2.1e-7,  # per sample-year-location, including compression
+}
+
+# Cost of the stages that depend on them relative to STAGE_COSTS, by kernels
+# backend and compute dtype, measured on the same run.
+KERNEL_COSTS = {
+    ("numpy", "float64"): {"project": 1.0, "localize": 1.0},
+    ("numpy", "float32"): {"project": 1.25, "localize": 0.7},
+    ("numba", "float64"): {"project": 0.85, "localize": 1.2},
+    ("numba", "float32"): {"project": 0.6, "localize": 0.6},
+}
+
+
+# Uncertainty settings that project_sweep can vary within a single projection.
+SWEEP_PARAMETERS = (
+    "dcyear_start",
+    "dcyear_end",
+    "dcrate_lo",
+    "dcrate_hi",
+    "dgwd_dt_dpop_pcterr",
+    "dam_pcterr",
+)
+
+# Contributions that can be localized with fingerprints of their own, in the
+# order of the component axis of split global samples.
+COMPONENTS = ("gwd", "dam")
+
+# Quantiles project_adaptive tracks the convergence of by default.
+DEFAULT_QUANTILES = (0.05, 0.17, 0.5, 0.83, 0.95)
+
+# Samples project_adaptive generates before its first convergence check.
+ADAPTIVE_BATCH_SIZE = 1000
+
+
+def plan_chunks(
+    nsamps: int,
+    nyears: int,
+    nlocations: int,
+    max_memory: int,
+    nworkers: int | None = None,
+    itemsize: int = 8,
+    ncomponents: int = 1,
+) -> tuple[int, int]:
+    """
+    Pick localization chunk sizes that keep peak memory within a budget.
+
+    Whole sample dimensions are kept where possible and locations are split
+    first. Samples are only split once a single location no longer fits.
+
+    Parameters
+    ----------
+    nsamps: Number of samples.
+    nyears: Number of target years.
+    nlocations: Number of locations to localize.
+    max_memory: Memory budget in bytes.
+    nworkers: Chunks computed concurrently. Defaults to the CPU count, matching
+        dask's threaded scheduler.
+    itemsize: Bytes per value of the compute dtype.
+    ncomponents: Components of the global samples, localized with a
+        fingerprint each.
+
+    Returns
+    -------
+    Number of samples and number of locations per chunk.
+    """
+    if nworkers is None:
+        nworkers = os.cpu_count() or 1
+
+    # The global samples stay resident for the whole localization.
+    resident = ncomponents * nsamps * nyears * itemsize
+    per_element = _chunk_bytes_per_element(itemsize)
+    budget = max_memory - resident
+    max_elements = budget // (per_element * nworkers)
+    if max_elements < nyears:
+        raise ValueError(
+            f"max_memory of {max_memory} bytes is too small: the global samples "
+            f"alone need {resident} bytes plus at least {per_element * nyears * nworkers} "
+            "bytes for localization chunks"
+        )
+
+    loc_chunksize = max_elements // (nsamps * nyears)
+    if loc_chunksize >= 1:
+        return nsamps, int(min(loc_chunksize, nlocations))
+    return int(max_elements // nyears), 1
+
+
+def estimate_memory(
+    nsamps: int,
+    nyears: int,
+    nlocations: int,
+    chunksize,
+    nworkers: int | None = None,
+    itemsize: int = 8,
+    ncomponents: int = 1,
+) -> int:
+    """
+    Predict peak memory, in bytes, of a run.
+
+    Parameters
+    ----------
+    nsamps: Number of samples.
+    nyears: Number of target years.
+    nlocations: Number of locations to localize.
+    chunksize: Localization chunks, as passed to ``postprocess``.
+    nworkers: Chunks computed concurrently. Defaults to the CPU count.
+    itemsize: Bytes per value of the compute dtype.
+    ncomponents: Components of the global samples, localized with a
+        fingerprint each.
+
+    Returns
+    -------
+    Predicted peak memory in bytes.
+    """
+    if nworkers is None:
+        nworkers = os.cpu_count() or 1
+    if isinstance(chunksize, tuple):
+        samp_chunksize, loc_chunksize = chunksize
+    else:
+        samp_chunksize, loc_chunksize = nsamps, chunksize
+    samp_chunksize = min(samp_chunksize, nsamps)
+    loc_chunksize = min(loc_chunksize, nlocations)
+
+    global_samples = ncomponents * nsamps * nyears * itemsize
+    # project holds the dam, GWD and dam correction samples, and their total
+    # or each component, at once.
+    project_peak = (3 + ncomponents) * nsamps * nyears * itemsize
+    nchunks = -(-nsamps // samp_chunksize) * -(-nlocations // loc_chunksize)
+    localize_peak = global_samples + (
+        min(nworkers, nchunks)
+        * samp_chunksize
+        * nyears
+        * loc_chunksize
+        * _chunk_bytes_per_element(itemsize)
+    )
+    return BASE_MEMORY + max(project_peak, localize_peak)
+
+
+def estimate_runtime(
+    nsamps: int,
+    nyears: int,
+    nlocations: int,
+    nworkers: int | None = None,
+    kernels: str = "auto",
+    dtype=np.float64,
+    compression_threads: int | None = None,
+) -> dict[str, float]:
+    """
+    Predict the runtime, in seconds, of each stage from ``STAGE_COSTS``.
+
+    Parameters
+    ----------
+    nsamps: Number of samples.
+    nyears: Number of target years.
+    nlocations: Number of locations to localize.
+    nworkers: Chunks localized concurrently. Defaults to the CPU count.
+    kernels: Kernels backend, see ``get_kernels``.
+    dtype: Compute dtype, one of ``COMPUTE_DTYPES``.
+    compression_threads: Threads compressing the local SLR file, see
+        ``write_lslr``. By default, it is compressed in one.
+
+    Returns
+    -------
+    Predicted seconds of each stage. Localization and writing the local SLR
+    file overlap unless overlapped writes are turned off.
+    """
+    if nworkers is None:
+        nworkers = os.cpu_count() or 1
+    costs = KERNEL_COSTS[get_kernels(kernels).name, _compute_dtype(dtype).name]
+    cores = os.cpu_count() or 1
+    out = {
+        "project": STAGE_COSTS["project"] * costs["project"] * nsamps,
+        "write_gslr": STAGE_COSTS["write_gslr"] * nsamps * nyears,
+        "localize": STAGE_COSTS["localize"]
+        * costs["localize"]
+        * nsamps
+        * nyears
+        * nlocations
+        / min(nworkers, cores),
+        "write_lslr": STAGE_COSTS["write_lslr"]
+        * nsamps
+        * nyears
+        * nlocations
+        / min(compression_threads or 1, cores),
+    }
+    return out
+
+
+def target_years(baseyear, pyear_start, pyear_end, pyear_step) -> np.ndarray:
+    """Years at which projections are produced, always including the base year."""
+    yrs = np.arange(pyear_start, pyear_end + 1, pyear_step)  # target years projections
+    return np.union1d(yrs, baseyear)
+
+
 def preprocess(
     pophist,
     dams,
@@ -89,6 +457,7 @@ def preprocess(
     pyear_start,
     pyear_end,
     pyear_step,
+    population_ensemble=False,
 ):
     """ssp_preprocess_landwaterstorage.py
 
@@ -102,6 +471,8 @@ def preprocess(
     dotriangular		Logical 0 or 1, to use triangular distribution for gwd [1,1]
     includepokhrel		Logical 0 or 1, to include Pokhrel data for gwd [1,1]
     pipeline_id			Unique identifier for the pipeline running this module
+    population_ensemble	Whether popscen holds trajectories of a population ensemble
+                        rather than the SSP scenarios
 
     Output:
     "%PIPELINE_ID%_data.pkl" = Contains the LWS data
@@ -114,8 +485,7 @@ def preprocess(
     dgwd_dt_dpop_pcterr = 0.25  # error on gwd slope
     dam_pcterr = 0.25  # error on sigmoidal function reservoirs
     # baseyear = 2005					# Base year to which projetions are centered
-    yrs = np.arange(pyear_start, pyear_end + 1, pyear_step)  # target years projections
-    yrs = np.union1d(yrs, baseyear)
+    yrs = target_years(baseyear, pyear_start, pyear_end, pyear_step)
 
     # # paths to data
     # pophist_file = "UNWPP2012 population historical.csv"
@@ -147,12 +517,13 @@ def preprocess(
         "t0": pophist.t0,
         "baseyear": baseyear,
         "targyears": yrs,
+        "population_ensemble": population_ensemble,
     }
 
     return output, output_conf
 
 
-def extend_pop(popscen, popscenyrs):
+def extend_pop(popscen, popscenyrs, scenario_map=None):
     # Rate as a function of population scenario (in percent)
     # Obtained from https://www.un.org/development/desa/pd/sites/www.un.org.development.desa.pd/files/files/documents/2020/Jan/un_2002_world_population_to_2300.pdf
     # Table 1, page 14 (pdf page 28)
@@ -214,7 +585,8 @@ def extend_pop(popscen, popscenyrs):
     # SSP map to population scenario
     # "popscen" is sorted in terms of lowest to highest projected population, which is
     # SSP1, SSP5, SSP2, SSP4, SSP3
-    scenario_map = np.array([0, 0, 1, 1, 2])
+    if scenario_map is None:
+        scenario_map = np.array([0, 0, 1, 1, 2])
 
     # Select the appropriate rates
     scenario_rates = ext_rates[scenario_map, :].T
@@ -253,7 +625,120 @@ def extend_pop(popscen, popscenyrs):
     return (popscen, popscenyrs)
 
 
-def fit(my_data, my_config, pipeline_id):
+def sigmoidal(pop0, a, b, c, I0):
+    """Reservoir impoundment as a sigmoidal function of population."""
+    return a * erf((pop0 / 1e6 - b) / c) + I0  # see Kopp et al. 2014 eq.1
+
+
+def _fit_sigmoids(pop0, dams, resamples, p0) -> np.ndarray:
+    """Fit the dam sigmoid to each resample of the points, NaN where it doesn't converge."""
+    out = np.full((len(resamples), len(p0)), np.nan)
+    for k, idx in enumerate(resamples):
+        try:
+            out[k] = curve_fit(sigmoidal, pop0[idx], dams[idx], p0=p0)[0]
+        except RuntimeError:
+            pass
+    return out
+
+
+def bootstrap_fit(
+    pop0,
+    dams,
+    dams_popt,
+    pop2gwd,
+    dgwd_dt,
+    n_bootstrap: int,
+    seed=0,
+    workers: int | None = None,
+) -> dict:
+    """
+    Bootstrap ensemble of the GWD slope and dam sigmoid parameters.
+
+    Each member refits both relations to the historical points resampled
+    with replacement. The least squares GWD slopes of every dataset and
+    resample are solved at once from their normal equations, and each member
+    takes the slope of one dataset picked at random, so the spread between
+    datasets stays in the ensemble. The nonlinear sigmoid fits start from
+    ``dams_popt``, in a pool of ``workers`` processes. Members whose sigmoid
+    fit doesn't converge are dropped.
+
+    Parameters
+    ----------
+    pop0: Annual historical population.
+    dams: Reservoir impoundment in the years of ``pop0``.
+    dams_popt: Sigmoid parameters fitted to all points.
+    pop2gwd: Population at the points of each GWD dataset.
+    dgwd_dt: GWD rate at the points of each GWD dataset.
+    n_bootstrap: Number of resamples.
+    seed: Seed value for the random number generator.
+    workers: Number of worker processes for the sigmoid fits. Defaults to the
+        CPU count, and 1 fits them in this process.
+
+    Returns
+    -------
+    dict with the GWD slope of each member as "dgwd_dt_dpop_ensemble", shape
+    (members,), and its sigmoid parameters as "dams_popt_ensemble", shape
+    (members, 4).
+    """
+    rng = np.random.default_rng(seed)
+    ndatasets = len(pop2gwd)
+    npoints = max(len(x) for x in pop2gwd)
+    x = np.zeros((ndatasets, npoints))
+    y = np.zeros((ndatasets, npoints))
+    counts = np.zeros((ndatasets, n_bootstrap, npoints))
+    for d, (xd, yd) in enumerate(zip(pop2gwd, dgwd_dt)):
+        n = len(xd)
+        x[d, :n] = xd
+        y[d, :n] = yd
+        # How often each point is drawn into each resample
+        counts[d, :, :n] = rng.multinomial(n, np.full(n, 1 / n), size=n_bootstrap)
+    # Slope through the origin of every resample, as np.linalg.lstsq would fit
+    slopes = np.einsum("dbn,dn->db", counts, x * y) / np.einsum(
+        "dbn,dn->db", counts, x * x
+    )
+    dataset = rng.integers(ndatasets, size=n_bootstrap)
+    slopes = slopes[dataset, np.arange(n_bootstrap)]
+
+    resamples = rng.integers(len(pop0), size=(n_bootstrap, len(pop0)))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, n_bootstrap)
+    if workers == 1:
+        popt = _fit_sigmoids(pop0, dams, resamples, dams_popt)
+    else:
+        # Spawn rather than fork, the parent may be running dask threads.
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            popt = np.concatenate(
+                list(
+                    pool.map(
+                        _fit_sigmoids,
+                        repeat(pop0),
+                        repeat(dams),
+                        np.array_split(resamples, 4 * workers),
+                        repeat(dams_popt),
+                    )
+                )
+            )
+
+    converged = ~np.isnan(popt).any(axis=1)
+    if not converged.any():
+        raise ValueError("no bootstrap sigmoid fit converged")
+    return {
+        "dgwd_dt_dpop_ensemble": slopes[converged],
+        "dams_popt_ensemble": popt[converged],
+    }
+
+
+def fit(
+    my_data,
+    my_config,
+    pipeline_id,
+    n_bootstrap=None,
+    bootstrap_seed=0,
+    workers=None,
+):
     """ssp_fit_landwaterstorage.py
 
     Code generated 16-09-2019, by Tim Hermans
@@ -264,6 +749,11 @@ def fit(my_data, my_config, pipeline_id):
 
     Parameters:
     pipeline_id = Unique identifier for the pipeline running this code
+    n_bootstrap = Number of resamples for a bootstrap ensemble of the fitted parameters,
+                  see bootstrap_fit, or None to only fit all points
+    bootstrap_seed = Seed value for the bootstrap resampling
+    workers = Number of worker processes for the bootstrap sigmoid fits, by default
+              the CPU count
 
     Output:
     "%PIPELINE_ID%_fit.pkl" = Pickle file that contains the fitted submodel information
@@ -289,9 +779,6 @@ def fit(my_data, my_config, pipeline_id):
     dams = np.interp(t0, tdams, dams)
 
     # optimisation problem, least squares of fitting dams with sigmoidal function of population
-    def sigmoidal(pop0, a, b, c, I0):
-        return a * erf((pop0 / 1e6 - b) / c) + I0  # see Kopp et al. 2014 eq.1
-
     # initial guess
     pinit = np.array([max(dams) / 2, 1, 1, max(dams) / 2])
     # curve fit
@@ -361,15 +848,21 @@ def fit(my_data, my_config, pipeline_id):
             (
                 np.transpose(
                     mb.repmat(
-                        np.interp(range(2000, int(min(popscenyr0))), t0, pop0), 5, 1
+                        np.interp(range(2000, int(min(popscenyr0))), t0, pop0),
+                        popscen.shape[1],
+                        1,
                     )
                 ),
                 popscen,
             )
         )
 
-    # Extend the population projections
-    (popscen, popscenyr) = extend_pop(popscen, popscenyr)
+    # Extend the population projections. Ensemble trajectories continue at
+    # the UN medium rates.
+    scenario_map = None
+    if my_config.get("population_ensemble", False):
+        scenario_map = np.ones(popscen.shape[1], dtype=int)
+    (popscen, popscenyr) = extend_pop(popscen, popscenyr, scenario_map)
 
     # Test to make sure the target years are within the projected population years
     if max(yrs) > max(popscenyr):
@@ -387,6 +880,19 @@ def fit(my_data, my_config, pipeline_id):
         "mean_dgwd_dt_dpop": mean_dgwd_dt_dpop,
         "std_dgwd_dt_dpop": std_dgwd_dt_dpop,
     }
+    if n_bootstrap is not None:
+        output.update(
+            bootstrap_fit(
+                pop0,
+                dams,
+                dams_popt,
+                pop2gwd_all,
+                dgwd_dt_all,
+                n_bootstrap,
+                bootstrap_seed,
+                workers,
+            )
+        )
     return output
 
 
@@ -399,6 +905,9 @@ def project(
     dcyear_end,
     dcrate_lo,
     dcrate_hi,
+    kernels="auto",
+    dtype=np.float64,
+    components=False,
 ):
     """ssp_project_landwaterstorage.py
 
@@ -411,12 +920,323 @@ def project(
     Parameters:
     Nsamps = Number of samples to project
     rng_seed = Seed value for the random number generator
+    kernels = Kernels backend, see get_kernels
+    dtype = Precision the samples are combined in, one of COMPUTE_DTYPES
+    components = Split the samples into the contributions in COMPONENTS
     pipeline_id = Unique identifier for the pipeline running this code
 
     Output:
-    "%PIPELINE_ID%_projections.pkl" = Pickle file that contains the global LWS projections
+    Global LWS projections, shape (samples, target years), or (components, samples, target years)
 
     """
+    settings = {
+        "dcyear_start": [dcyear_start],
+        "dcyear_end": [dcyear_end],
+        "dcrate_lo": [dcrate_lo],
+        "dcrate_hi": [dcrate_hi],
+    }
+    (lwssamps,) = project_sweep(
+        my_fit, my_config, Nsamps, rng_seed, settings, kernels, dtype, components
+    )
+    return lwssamps
+
+
+def parameter_grid(defaults: dict, sweep: dict) -> dict[str, np.ndarray]:
+    """
+    Expand swept parameter values into every combination.
+
+    Parameters
+    ----------
+    defaults: Value of each parameter in ``SWEEP_PARAMETERS`` that is not swept.
+    sweep: Values to sweep, keyed by parameter name.
+
+    Returns
+    -------
+    One array per parameter, each with one entry per combination. The last
+    swept parameter varies fastest.
+    """
+    unknown = set(sweep) - set(SWEEP_PARAMETERS)
+    if unknown:
+        raise ValueError(
+            f"cannot sweep {sorted(unknown)}, choose from {list(SWEEP_PARAMETERS)}"
+        )
+    values = [
+        np.atleast_1d(sweep.get(name, defaults[name])) for name in SWEEP_PARAMETERS
+    ]
+    grid = np.meshgrid(*values, indexing="ij")
+    return {name: g.ravel() for name, g in zip(SWEEP_PARAMETERS, grid)}
+
+
+def project_sweep(
+    my_fit,
+    my_config,
+    Nsamps,
+    rng_seed,
+    settings: dict,
+    kernels: str = "auto",
+    dtype=np.float64,
+    components: bool = False,
+):
+    """
+    Project global samples for several uncertainty settings at once.
+
+    All settings share the fit, the population-driven base curves and the
+    random draws, so they differ only through the settings themselves. See
+    ``project_sweep_batches`` for the parameters.
+
+    Returns
+    -------
+    Samples with shape (settings, samples, target years), or (settings,
+    components, samples, target years) with ``components``.
+    """
+    ((_, lwssamps),) = project_sweep_batches(
+        my_fit,
+        my_config,
+        Nsamps,
+        rng_seed,
+        settings,
+        kernels=kernels,
+        dtype=dtype,
+        components=components,
+    )
+    return lwssamps
+
+
+def project_batches(
+    my_fit,
+    my_config,
+    Nsamps,
+    rng_seed,
+    dcyear_start,
+    dcyear_end,
+    dcrate_lo,
+    dcrate_hi,
+    batch_size,
+    kernels="auto",
+    dtype=np.float64,
+    components=False,
+):
+    """
+    Project global samples a batch at a time.
+
+    Gives the same samples as ``project``, but only holds one batch of
+    samples x years at a time.
+
+    Yields
+    ------
+    Index of the batch's first sample, and the batch with shape (samples,
+    target years), or (components, samples, target years) with
+    ``components``.
+    """
+    settings = {
+        "dcyear_start": [dcyear_start],
+        "dcyear_end": [dcyear_end],
+        "dcrate_lo": [dcrate_lo],
+        "dcrate_hi": [dcrate_hi],
+    }
+    for start, lwssamps in project_sweep_batches(
+        my_fit,
+        my_config,
+        Nsamps,
+        rng_seed,
+        settings,
+        batch_size,
+        kernels,
+        dtype,
+        components,
+    ):
+        yield start, lwssamps[0]
+
+
+def interp_rows(x, xp, fp) -> np.ndarray:
+    """
+    Linearly interpolate every row of ``fp`` at once.
+
+    Gives exactly ``np.interp(x, xp, row)`` for each row, including holding
+    the end values outside ``xp``.
+
+    Parameters
+    ----------
+    x: Points to interpolate at.
+    xp: Increasing points the rows are given at.
+    fp: Values at ``xp``, shape (rows, len(xp)).
+
+    Returns
+    -------
+    Interpolated values, shape (rows, len(x)).
+    """
+    x = np.asarray(x, dtype=float)
+    xp = np.asarray(xp, dtype=float)
+    j = np.searchsorted(xp, x, side="right") - 1
+    k = np.clip(j, 0, len(xp) - 2)
+    slope = (fp[:, k + 1] - fp[:, k]) / (xp[k + 1] - xp[k])
+    out = slope * (x - xp[k]) + fp[:, k]
+    # Exact at the points themselves and held beyond the ends, like np.interp.
+    out = np.where(x == xp[k], fp[:, k], out)
+    out = np.where(j < 0, fp[:, :1], out)
+    return np.where(j >= len(xp) - 1, fp[:, -1:], out)
+
+
+def quantile_error(samples, quantiles) -> np.ndarray:
+    """
+    Estimate the Monte Carlo standard error of sample quantiles.
+
+    Uses half the spread of the order statistics one binomial standard
+    deviation either side of each quantile, which assumes nothing about the
+    distribution of the samples.
+
+    Parameters
+    ----------
+    samples: Samples along the first axis, like shape (samples, years).
+    quantiles: Quantiles, each in (0, 1).
+
+    Returns
+    -------
+    Standard errors with shape (quantiles, ...). Infinite for quantiles too
+    far in the tails to bracket with this many samples.
+    """
+    nsamps = len(samples)
+    q = np.asarray(quantiles, dtype=float)
+    half_width = np.sqrt(nsamps * q * (1 - q))
+    lo = np.floor(nsamps * q - half_width).astype(int)
+    hi = np.ceil(nsamps * q + half_width).astype(int)
+    bracketed = (lo >= 0) & (hi < nsamps)
+    lo = np.clip(lo, 0, nsamps - 1)
+    hi = np.clip(hi, 0, nsamps - 1)
+
+    ordered = np.partition(samples, np.unique(np.concatenate([lo, hi])), axis=0)
+    out = (ordered[hi] - ordered[lo]) / 2
+    out[~bracketed] = np.inf
+    return out
+
+
+def project_adaptive(
+    my_fit,
+    my_config,
+    max_samps,
+    rng_seed,
+    dcyear_start,
+    dcyear_end,
+    dcrate_lo,
+    dcrate_hi,
+    tolerance,
+    quantiles=DEFAULT_QUANTILES,
+    batch_size=ADAPTIVE_BATCH_SIZE,
+    kernels="auto",
+    dtype=np.float64,
+    components=False,
+):
+    """
+    Project global samples in batches until their quantiles converge.
+
+    After each batch, the Monte Carlo standard error of ``quantiles`` is
+    estimated with ``quantile_error`` in every target year. Projection stops
+    once the largest is within ``tolerance``, or at ``max_samps`` samples.
+    Checks are spaced so each adds at least a quarter to the samples checked
+    before, keeping their cost to about that of one check over all samples.
+
+    The samples are the first ones ``project`` gives for ``max_samps``.
+
+    Parameters
+    ----------
+    my_fit: Output of ``fit``.
+    my_config: Configuration from ``preprocess``.
+    max_samps: Most samples to project.
+    rng_seed: Seed value for the random number generator.
+    dcyear_start, dcyear_end, dcrate_lo, dcrate_hi: Dam correction, as for
+        ``project``.
+    tolerance: Largest standard error of the quantiles to accept, in mm.
+    quantiles: Quantiles to converge, each in (0, 1).
+    batch_size: Number of samples generated before the first check.
+    kernels: Kernels backend, see ``get_kernels``.
+    dtype: Precision the samples are combined in, one of ``COMPUTE_DTYPES``.
+    components: Split the samples into the contributions in ``COMPONENTS``.
+        Convergence is checked on their total.
+
+    Returns
+    -------
+    Samples with shape (samples, target years), or (components, samples,
+    target years) with ``components``, and the largest standard error of the
+    quantiles at the last check.
+    """
+    if tolerance <= 0:
+        raise ValueError(f"tolerance must be positive, got {tolerance}")
+    if not all(0 < q < 1 for q in quantiles):
+        raise ValueError(f"quantiles must be within (0, 1), got {quantiles}")
+
+    batches = project_batches(
+        my_fit,
+        my_config,
+        max_samps,
+        rng_seed,
+        dcyear_start,
+        dcyear_end,
+        dcrate_lo,
+        dcrate_hi,
+        batch_size,
+        kernels,
+        dtype,
+        components,
+    )
+    done = []
+    nsamps = checked = 0
+    for _, lwssamps in batches:
+        done.append(lwssamps)
+        nsamps += lwssamps.shape[-2]
+        if nsamps < max_samps and nsamps - checked < max(batch_size, checked // 4):
+            continue
+        done = [np.concatenate(done, axis=-2)]
+        total = done[0].sum(axis=0) if components else done[0]
+        error = quantile_error(total, quantiles).max()
+        checked = nsamps
+        if error <= tolerance:
+            break
+    return done[0], error
+
+
+def project_sweep_batches(
+    my_fit,
+    my_config,
+    Nsamps,
+    rng_seed,
+    settings: dict,
+    batch_size: int | None = None,
+    kernels: str = "auto",
+    dtype=np.float64,
+    components: bool = False,
+):
+    """
+    Project global samples for several uncertainty settings, a batch of samples at a time.
+
+    The random draws for all samples are made up front, a few numbers per
+    sample, so every batch size gives the same samples. Only the samples x
+    years output is built per batch.
+
+    Parameters
+    ----------
+    my_fit: Output of ``fit``.
+    my_config: Configuration from ``preprocess``.
+    Nsamps: Number of samples to project.
+    rng_seed: Seed value for the random number generator.
+    settings: Arrays of parameter values, one entry per setting, keyed by
+        names in ``SWEEP_PARAMETERS``, like the output of ``parameter_grid``.
+        Missing ``dgwd_dt_dpop_pcterr`` and ``dam_pcterr`` default to the
+        configured values.
+    batch_size: Number of samples per batch. Defaults to all of them.
+    kernels: Kernels backend, see ``get_kernels``.
+    dtype: Precision the samples are combined in, one of ``COMPUTE_DTYPES``.
+        The fit, base curves and random draws are always float64, and only
+        cast to ``dtype`` for the samples x years combination.
+    components: Split the samples into the contributions in ``COMPONENTS``,
+        which sum to the total up to rounding.
+
+    Yields
+    ------
+    Index of the batch's first sample, and the batch with shape (settings,
+    samples, target years), the order they are written to disk in. With
+    ``components``, (settings, components, samples, target years).
+    """
+    dtype = _compute_dtype(dtype)
     popscen = my_fit["popscen"]
     popscenyr = my_fit["popscenyr"]
     dams_popt = my_fit["dams_popt"]
@@ -425,17 +1245,24 @@ def project(
 
     t0 = my_config["t0"]
     pop0 = my_config["pop0"]
-    dgwd_dt_dpop_pcterr = my_config["dgwd_dt_dpop_pcterr"]
-    dam_pcterr = my_config["dam_pcterr"]
     yrs = my_config["yrs"]
     baseyear = my_config["baseyear"]
     targyears = my_config["targyears"]
     scen = my_config["scen"]
     dotriangular = my_config["dotriangular"]
 
-    # optimisation problem, least squares of fitting dams with sigmoidal function of population
-    def sigmoidal(pop0, a, b, c, I0):
-        return a * erf((pop0 / 1e6 - b) / c) + I0  # see Kopp et al. 2014 eq.1
+    dcyear_start = np.asarray(settings["dcyear_start"])[:, np.newaxis]
+    dcyear_end = np.asarray(settings["dcyear_end"])[:, np.newaxis]
+    dcrate_lo = np.asarray(settings["dcrate_lo"])[:, np.newaxis]
+    dcrate_hi = np.asarray(settings["dcrate_hi"])[:, np.newaxis]
+    nsettings = len(dcyear_start)
+    dgwd_dt_dpop_pcterr = np.broadcast_to(
+        settings.get("dgwd_dt_dpop_pcterr", my_config["dgwd_dt_dpop_pcterr"]),
+        nsettings,
+    )[:, np.newaxis]
+    dam_pcterr = np.broadcast_to(
+        settings.get("dam_pcterr", my_config["dam_pcterr"]), nsettings
+    )[:, np.newaxis]
 
     ##################################################
     # select scenario population using target RCP or SSP scenario
@@ -458,170 +1285,240 @@ def project(
         "ssp3": 4,
     }
 
-    # extract SSP scenario from configured target RCP or SSP scenario
-    if scen[0:3] == "rcp":
-        targetSSP = RCPtoSSP[scen]
-        if scen not in RCPtoSSP:
-            raise Exception(
-                "Configured RCP scenario does not have a preferred SSP combination."
-            )
+    if my_config.get("population_ensemble", False):
+        # Each sample draws one of the ensemble's trajectories below.
+        popdraw = popscen.T
     else:
-        targetSSP = scen
+        # extract SSP scenario from configured target RCP or SSP scenario
+        if scen[0:3] == "rcp":
+            targetSSP = RCPtoSSP[scen]
+            if scen not in RCPtoSSP:
+                raise Exception(
+                    "Configured RCP scenario does not have a preferred SSP combination."
+                )
+        else:
+            targetSSP = scen
 
-    # draw scenario population from target scenario
-    popdraw = popscen[:, SSPorder[targetSSP]]
+        # draw scenario population from target scenario, as the only trajectory
+        popdraw = popscen[np.newaxis, :, SSPorder[targetSSP]]
 
-    # interpolate to annual means
-    popdraw = np.interp(np.linspace(2000, 2300, 301), popscenyr, popdraw)
+    # interpolate to annual means, every trajectory at once
+    popdraw = interp_rows(np.linspace(2000, 2300, 301), popscenyr, popdraw)
     popscenyr = np.linspace(2000, 2300, 301)
 
-    # random draw functions for reservoirs and gwd
-
-    # symbolic function interpolating the cumulative sum of population for a
-    # certain probability x1 times the normal distribution with mean dgwd/dt/dpopmGWD
-    # and standard deviation stdGWD defined earlier, onto desired years
-    if dotriangular == 0:
-
-        def gwddraw(seed1):
-            return np.interp(
-                yrs,
-                popscenyr,
-                np.cumsum(
-                    np.multiply(
-                        popdraw,
-                        (mean_dgwd_dt_dpop + norm.ppf(seed1) * std_dgwd_dt_dpop),
-                    )
-                ),
-            )
-    else:
-
-        def gwddraw(seed1, seed2):
-            return np.interp(
-                yrs,
-                popscenyr,
-                np.cumsum(
-                    np.multiply(
-                        popdraw,
-                        np.interp(
-                            seed1,
-                            np.array([0, 0.5, 1]),
-                            np.array(
-                                [
-                                    std_dgwd_dt_dpop[0],
-                                    mean_dgwd_dt_dpop,
-                                    std_dgwd_dt_dpop[-1],
-                                ]
-                            ),
-                        ),
-                    )
-                )
-                * (1 + norm.ppf(seed2) * dgwd_dt_dpop_pcterr),
-            )
-
-    # random draw from reservoir storage: sigmoidal function with
-    # randomly drawn population as input (>t=2000, see Kopp 2014)
-    # and subtracts the sigmoidal function with the population at t=2000 (this
-    # will then be the origin).
-
-    # This is multiplied with a normal distribution with a mean of 1 and a std of
-    # 25% (default defined error elated to the impoundment rate. Kopp 2014: 2sigma=50%):
+    # Samples of a trajectory scale the same base curves, so build those once
+    # per trajectory, shape (trajectories, years).
+    # GWD: cumulative population onto the desired years, to be multiplied by
+    # a random draw of dgwd/dt/dpop.
+    gwd_base = interp_rows(yrs, popscenyr, np.cumsum(popdraw, axis=1))
+
+    # Reservoir storage: sigmoidal function of population (>t=2000, see Kopp 2014)
+    # minus the sigmoidal function with the population at t=2000 (this will then
+    # be the origin), to be multiplied with a normal distribution with a mean of
+    # 1 and a std of 25% (default defined error elated to the impoundment rate.
+    # Kopp 2014: 2sigma=50%).
     # - minus sign since reservoir storage leads to GSL drop -
-
     pop2000 = pop0[t0 == 2000]  # population at 2000
-
-    def damdraw(seed1):  ###decide max of sigmoid or pop2000->choose
-        poprand = np.array([popdraw])  # random draw from population
-        poprand[poprand < pop2000] = (
-            pop2000  # impoundment is not allowed to be reduced below yr 2000 levels (Kopp et al., 2014)
-        )
-
-        X = np.multiply(
-            -1
-            * (
-                sigmoidal(
-                    poprand, dams_popt[0], dams_popt[1], dams_popt[2], dams_popt[3]
-                )
-                - sigmoidal(
-                    pop2000[0], dams_popt[0], dams_popt[1], dams_popt[2], dams_popt[3]
-                )
-            ),
-            1 + norm.ppf(seed1) * dam_pcterr,
-        )
-
-        # X = np.multiply(-1*(sigmoidal(np.array([popdraw(seed1)]),dams_popt[0],dams_popt[1],dams_popt[2],dams_popt[3])\
-        #                    - sigmoidal(pop2000[0],dams_popt[0],dams_popt[1],dams_popt[2],dams_popt[3])), 1+norm.ppf(seed2)*dam_pcterr )
-
-        return np.interp(yrs, popscenyr, X[0])
+    poprand = popdraw.copy()
+    poprand[poprand < pop2000] = (
+        pop2000  # impoundment is not allowed to be reduced below yr 2000 levels (Kopp et al., 2014)
+    )
+    dam_base = interp_rows(
+        yrs,
+        popscenyr,
+        -1
+        * (
+            sigmoidal(poprand, dams_popt[0], dams_popt[1], dams_popt[2], dams_popt[3])
+            - sigmoidal(
+                pop2000[0], dams_popt[0], dams_popt[1], dams_popt[2], dams_popt[3]
+            )
+        ),
+    )
 
     ##################################################
     # generate seeds and draw samples
     rng = np.random.default_rng(rng_seed)
-    if isinstance(Nsamps, int):  # if only given a single number Nsamps
-        seeds0 = np.linspace(0, 1, Nsamps + 2)
-        seeds0 = seeds0[1:-1]
-    else:
-        seeds = Nsamps
-        seeds0 = Nsamps
-
-    if seeds0.ndim == 1:  # if seeds is a vector
-        seeds = np.empty((4, len(seeds0)))
-        for j in range(0, 4):
-            seeds[j, :] = seeds0[rng.permutation(len(seeds0))]
-
-    # draw the samples
-    damsamps = np.empty((len(yrs), Nsamps))
-    gwdsamps = np.empty((len(yrs), Nsamps))
+    seeds0 = np.linspace(0, 1, Nsamps + 2)
+    seeds0 = seeds0[1:-1]
+    seeds = np.empty((4, len(seeds0)))
+    for j in range(0, 4):
+        seeds[j, :] = seeds0[rng.permutation(len(seeds0))]
 
+    # Per-sample factors for each setting
     if dotriangular == 0:
-        for ii in range(0, np.shape(seeds)[1]):
-            damsamps[:, ii] = damdraw(seeds[3, ii])
-            gwdsamps[:, ii] = gwddraw(seeds[1, ii])
+        # The fitted spread includes the configured GWD slope error, swap in
+        # each setting's error instead.
+        fit_pcterr = my_config["dgwd_dt_dpop_pcterr"]
+        std = np.where(
+            dgwd_dt_dpop_pcterr == fit_pcterr,
+            std_dgwd_dt_dpop,
+            np.sqrt(
+                np.maximum(
+                    std_dgwd_dt_dpop**2 - (mean_dgwd_dt_dpop * fit_pcterr) ** 2, 0
+                )
+                + (mean_dgwd_dt_dpop * dgwd_dt_dpop_pcterr) ** 2
+            ),
+        )
+        gwd_factor = mean_dgwd_dt_dpop + norm.ppf(seeds[1]) * std
     else:
-        for ii in range(0, np.shape(seeds)[1]):
-            damsamps[:, ii] = damdraw(seeds[3, ii])
-            gwdsamps[:, ii] = gwddraw(seeds[1, ii], seeds[2, ii])
-
-    # add to total lws equivalent gsl
-    # Note: Only 80% of ground water depletion makes it to the ocean
-    # Wada et al. 2016
-    lwssamps = (gwdsamps * 0.8) + damsamps
-    # lwssamps = gwdsamps + damsamps
+        gwd_factor = np.interp(
+            seeds[1],
+            np.array([0, 0.5, 1]),
+            np.array([std_dgwd_dt_dpop[0], mean_dgwd_dt_dpop, std_dgwd_dt_dpop[-1]]),
+        ) * (1 + norm.ppf(seeds[2]) * dgwd_dt_dpop_pcterr)
+    dam_factor = 1 + norm.ppf(seeds[3]) * dam_pcterr
 
     # Apply correction for planned dam construction -------------------
-    # Which years overlap?
-    dc_year_idx = np.flatnonzero(np.logical_and(yrs >= dcyear_start, yrs <= dcyear_end))
-    dc_eyear_idx = np.flatnonzero(yrs > dcyear_end)
-
-    # Generate samples of the rates
-    dc_rates = rng.uniform(dcrate_lo, dcrate_hi, Nsamps)
+    # Generate samples of the rates, as rng.uniform(dcrate_lo, dcrate_hi) would
+    dc_rates = dcrate_lo + (dcrate_hi - dcrate_lo) * rng.random(Nsamps)
 
-    # Expand these rates into sea-level change over time
-    dc_samps = np.zeros((len(yrs), Nsamps))
-    dc_samps[dc_year_idx, :] += dc_rates[np.newaxis, :] * (
-        yrs[dc_year_idx, np.newaxis] - dcyear_start
-    )
-    dc_samps[dc_eyear_idx, :] = (
-        dc_rates[np.newaxis, :] * (dcyear_end - dcyear_start)
-    ) * np.ones((len(dc_eyear_idx), 1))
+    # Population trajectory of each sample
+    if len(popdraw) > 1:
+        traj = rng.integers(len(popdraw), size=Nsamps)
+    else:
+        traj = np.zeros(Nsamps, dtype=np.intp)
+
+    # Member of a bootstrap fit ensemble of each sample, see bootstrap_fit.
+    # The ensemble stands in for the percent errors: a sample scales the GWD
+    # curve by its member's slope, and the dam curve is its member's sigmoid.
+    if "dams_popt_ensemble" in my_fit:
+        if dotriangular:
+            raise ValueError(
+                "a bootstrap ensemble replaces the triangular GWD distribution, "
+                "it cannot be combined with dotriangular"
+            )
+        overridden = [
+            k
+            for k in ("dgwd_dt_dpop_pcterr", "dam_pcterr")
+            if np.any(np.asarray(settings.get(k, my_config[k])) != my_config[k])
+        ]
+        if overridden:
+            raise ValueError(
+                "a bootstrap ensemble replaces the percent errors, it cannot be "
+                f"combined with other values of {', '.join(overridden)}"
+            )
+        dams_popt_ensemble = my_fit["dams_popt_ensemble"]
+        nmembers = len(dams_popt_ensemble)
+        member = rng.integers(nmembers, size=Nsamps)
+        gwd_factor = my_fit["dgwd_dt_dpop_ensemble"][member]
+        dam_factor = np.ones(Nsamps)
+        # Only build base curves for the (trajectory, member) pairs drawn.
+        pairs, traj = np.unique(traj * nmembers + member, return_inverse=True)
+        pair_traj, pair_member = np.divmod(pairs, nmembers)
+        a, b, c, I0 = dams_popt_ensemble[pair_member].T[:, :, np.newaxis]
+        gwd_base = gwd_base[pair_traj]
+        dam_base = interp_rows(
+            yrs,
+            popscenyr,
+            -1
+            * (
+                sigmoidal(poprand[pair_traj], a, b, c, I0)
+                - sigmoidal(pop2000[0], a, b, c, I0)
+            ),
+        )
 
-    # Add these dam correction samples back to the projections
-    lwssamps += dc_samps
+    # Years of dam correction, to be multiplied by the rates
+    dc_years = np.where(
+        yrs > dcyear_end,
+        dcyear_end - dcyear_start,
+        np.where(yrs >= dcyear_start, yrs - dcyear_start, 0),
+    ).astype(float)
 
     # -----------------------------------------------------------------
 
-    # Center the samples to the baseyear
-    baseyear_idx = np.isin(yrs, baseyear)
-    center_values = lwssamps[baseyear_idx, :]
-    lwssamps -= center_values
-
-    # Subset for the target years
-    targyear_idx = np.isin(yrs, targyears)
-    lwssamps = lwssamps[targyear_idx, :]
-
-    return lwssamps
+    # Add up the contributions, centered to the baseyear, for the target years
+    baseyear_idx = np.flatnonzero(np.isin(yrs, baseyear))[0]
+    targyear_idx = np.flatnonzero(np.isin(yrs, targyears))
+    gwd_base, dam_base, dc_years, dc_rates = (
+        np.asarray(a, dtype=dtype) for a in (gwd_base, dam_base, dc_years, dc_rates)
+    )
+    gwd_factor = np.broadcast_to(np.asarray(gwd_factor, dtype=dtype), dc_rates.shape)
+    dam_factor = np.broadcast_to(np.asarray(dam_factor, dtype=dtype), dc_rates.shape)
+    sample_curves = get_kernels(kernels).sample_curves
+    if batch_size is None:
+        batch_size = Nsamps
+    for start in range(0, Nsamps, batch_size):
+        batch = slice(start, start + batch_size)
+        gwd = np.ascontiguousarray(gwd_factor[:, batch])
+        dam = np.ascontiguousarray(dam_factor[:, batch])
+        rates = np.ascontiguousarray(dc_rates[:, batch])
+        if not components:
+            lwssamps = sample_curves(
+                gwd_base,
+                gwd,
+                dam_base,
+                dam,
+                dc_years,
+                rates,
+                traj[batch],
+                baseyear_idx,
+                targyear_idx,
+            )
+        else:
+            # Each component on its own, with the others' factors zeroed.
+            zeros = np.zeros_like(gwd)
+            lwssamps = np.stack(
+                [
+                    sample_curves(
+                        gwd_base,
+                        gwd,
+                        dam_base,
+                        zeros,
+                        dc_years,
+                        zeros,
+                        traj[batch],
+                        baseyear_idx,
+                        targyear_idx,
+                    ),
+                    sample_curves(
+                        gwd_base,
+                        zeros,
+                        dam_base,
+                        dam,
+                        dc_years,
+                        rates,
+                        traj[batch],
+                        baseyear_idx,
+                        targyear_idx,
+                    ),
+                ],
+                axis=1,
+            )
+        yield start, lwssamps
 
 
-def postprocess(lwssamps, fingerprints: Fingerprints, sites: Locations, chunksize):
+def _from_array(arr, chunks, client=None):
+    """
+    A dask array of ``arr`` in ``chunks``, with its chunks scattered to ``client``'s workers if given.
+    """
+    if client is None:
+        return da.from_array(arr, chunks=chunks)
+    chunks = da.core.normalize_chunks(chunks, arr.shape, dtype=arr.dtype)
+    bounds = [np.cumsum((0,) + c) for c in chunks]
+    numblocks = tuple(len(c) for c in chunks)
+    regions = [
+        tuple(slice(b[i], b[i + 1]) for b, i in zip(bounds, idx))
+        for idx in np.ndindex(numblocks)
+    ]
+    # Unique keys, so releasing one call's chunks can't drop another's.
+    futures = client.scatter([arr[region] for region in regions], hash=False)
+    blocks = np.empty(numblocks, dtype=object)
+    for idx, region, future in zip(np.ndindex(numblocks), regions, futures):
+        shape = tuple(r.stop - r.start for r in region)
+        blocks[idx] = da.from_delayed(future, shape, dtype=arr.dtype)
+    return da.block(blocks.tolist())
+
+
+def postprocess(
+    lwssamps,
+    fingerprints: Fingerprints,
+    sites: Locations,
+    chunksize,
+    kernels="auto",
+    coefficients=None,
+    dtype=np.float64,
+    client=None,
+):
     """ssp_postprocess_landwaterstorage.py
 
     This script runs the land water storage postprocessing task from the SSP module set.
@@ -631,15 +1528,61 @@ def postprocess(lwssamps, fingerprints: Fingerprints, sites: Locations, chunksiz
     locationfile = File that contains points for localization
     pipeline_id = Unique identifier for the pipeline running this code
 
-    Output: NetCDF file containing the local sea-level rise projections
+    lwssamps = Global samples, shape (samples, years), or (components, samples, years)
+               to localize each component with its own fingerprint
+    chunksize = Number of locations per chunk, or (samples, locations) per chunk
+    kernels = Kernels backend, see get_kernels
+    coefficients = Fingerprint coefficients at sites, if already interpolated, with
+                   shape (components, sites) for split global samples
+    dtype = Precision to localize in, one of COMPUTE_DTYPES
+    client = Dask distributed client to scatter the global samples and coefficients
+             to, once per chunk, rather than embedding them in every graph computed
+
+    Output: Local sea-level rise projections, shape (samples, years, locations)
     """
-    lwssamps = np.transpose(lwssamps)
+    dtype = _compute_dtype(dtype)
+    lwssamps = np.asarray(lwssamps, dtype=dtype)
+    # Components, if any, stay in one chunk to be summed in one pass.
+    leading = (-1,) * (lwssamps.ndim - 2)
+    if isinstance(chunksize, tuple):
+        samp_chunksize, loc_chunksize = chunksize
+        lwssamps = _from_array(lwssamps, (*leading, samp_chunksize, -1), client)
+    else:
+        loc_chunksize = chunksize
+        lwssamps = _from_array(lwssamps, -1, client)
 
     # Apply the fingerprints
-    fpsites = da.array(fingerprints.interpolate_coefficients(sites))
-    fpsites = fpsites.rechunk(chunksize)
+    if coefficients is None:
+        coefficients = fingerprints.interpolate_coefficients(sites)
+    coefficients = np.asarray(coefficients, dtype=dtype)
+    if coefficients.ndim != lwssamps.ndim - 1:
+        raise ValueError(
+            "need one row of fingerprint coefficients per component of the global "
+            f"samples, got shapes {coefficients.shape} and {lwssamps.shape}"
+        )
+    fpsites = _from_array(coefficients, (*leading, loc_chunksize), client)
 
     # Calculate the local sl samples
-    local_sl = np.multiply.outer(lwssamps, fpsites)
+    if lwssamps.ndim == 2:
+        local_sl = da.blockwise(
+            get_kernels(kernels).outer,
+            "syl",
+            lwssamps,
+            "sy",
+            fpsites,
+            "l",
+            dtype=np.result_type(lwssamps, fpsites),
+        )
+    else:
+        local_sl = da.blockwise(
+            get_kernels(kernels).outer_sum,
+            "syl",
+            lwssamps,
+            "csy",
+            fpsites,
+            "cl",
+            dtype=np.result_type(lwssamps, fpsites),
+            concatenate=True,
+        )
 
     return local_sl
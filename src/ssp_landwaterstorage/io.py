@@ -2,12 +2,24 @@
 Logic for application IO.
 """
 
+import contextlib
 import csv
+import itertools
+import json
+import logging
 import os
+import queue
 import re
+import shutil
+import tempfile
+import threading
 import time
+import tomllib
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from typing import Sequence
 
+import dask.array as da
 import numpy as np
 from netCDF4 import Dataset
 import xarray as xr
@@ -18,9 +30,18 @@ from ssp_landwaterstorage.core import (
     GroundwaterDepletion,
     PopulationScenarios,
     Locations,
+    LocationMap,
     Fingerprints,
 )
 
+logger = logging.getLogger(__name__)
+
+# The netCDF-C library is not thread-safe. Every netCDF call here, including
+# xarray writes, which don't lock opening and closing files, holds this lock,
+# so files can be read and written from several threads. It is reentrant since
+# xarray takes its own lock inside.
+_NETCDF_LOCK = threading.RLock()
+
 
 def read_locations(fl: str | os.PathLike) -> Locations:
     """
@@ -180,19 +201,259 @@ def read_population_scenarios(popscen_file: str | os.PathLike) -> PopulationScen
     return out
 
 
-def read_fingerprints(fl: str | os.PathLike) -> Fingerprints:
+def read_population_ensemble(fl: str | os.PathLike) -> PopulationScenarios:
     """
-    Read Fingerprints from NetCDF.
+    Read population trajectories of a probabilistic projection from file.
+
+    The CSV file has a header row, then a row per year with the year and the
+    population of each trajectory, in the units of the population scenarios.
+    Trajectories end up as the columns of ``scenarios``.
     """
-    nc_fid = Dataset(fl, "r")
-    out = Fingerprints(
-        fp=nc_fid.variables["GROUND"][0, :, :],
-        lat=nc_fid.variables["lat"][:],
-        lon=nc_fid.variables["lon"][:],
+    data = np.loadtxt(fl, delimiter=",", skiprows=1, ndmin=2)
+    out = PopulationScenarios(
+        yr=data[:, 0],
+        scenarios=data[:, 1:],
     )
     return out
 
 
+def read_fingerprints(
+    fl: str | os.PathLike, variables: tuple[str, ...] = ("GROUND",)
+) -> Fingerprints:
+    """
+    Read Fingerprints from NetCDF.
+
+    Each of ``variables`` is read as one field on the file's grid. A single
+    variable gives a (lat, lon) field, several give (fields, lat, lon).
+    """
+    with _NETCDF_LOCK:
+        nc_fid = Dataset(fl, "r")
+        missing = [v for v in variables if v not in nc_fid.variables]
+        if missing:
+            nc_fid.close()
+            raise ValueError(f"{fl} has no fingerprint variables {missing}")
+        fields = [nc_fid.variables[v][0, :, :] for v in variables]
+        out = Fingerprints(
+            fp=fields[0] if len(fields) == 1 else np.ma.stack(fields),
+            lat=nc_fid.variables["lat"][:],
+            lon=nc_fid.variables["lon"][:],
+            names=tuple(variables),
+        )
+        nc_fid.close()
+    return out
+
+
+def read_manifest(fl: str | os.PathLike) -> list[dict]:
+    """
+    Read the runs of a batch manifest from a JSON or TOML file.
+
+    The manifest has a list of ``runs``, each a table of options by their
+    argument names, like ``scenario`` or ``location_file``, and optionally
+    ``defaults`` that every run starts from. A JSON manifest may also be just
+    the list of runs. TOML is used for files ending in ".toml".
+
+    Relative paths in options ending in ``_file``, ``_files`` or ``_dir`` are
+    taken relative to the manifest's directory.
+    """
+    with open(fl, "rb") as f:
+        if os.fspath(fl).endswith(".toml"):
+            manifest = tomllib.load(f)
+        else:
+            manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {"runs": manifest}
+    if not isinstance(manifest.get("runs"), list):
+        raise ValueError(f"{fl} has no list of runs")
+
+    root = os.path.dirname(os.path.abspath(fl))
+    defaults = manifest.get("defaults", {})
+    return [_resolve_paths({**defaults, **run}, root) for run in manifest["runs"]]
+
+
+def read_job(fl: str | os.PathLike) -> dict:
+    """
+    Read a job for the ``serve`` daemon from a JSON file.
+
+    A job is a table of run options by their argument names, like a run in a
+    manifest, and relative paths are likewise taken relative to the job
+    file's directory.
+    """
+    with open(fl, "rb") as f:
+        job = json.load(f)
+    if not isinstance(job, dict):
+        raise ValueError(f"{fl} is not a table of run options")
+    return _resolve_paths(job, os.path.dirname(os.path.abspath(fl)))
+
+
+def _resolve_paths(run: dict, root: str) -> dict:
+    """Join relative paths in options ending in _file, _files or _dir to root."""
+
+    def resolve(key, value):
+        if not key.endswith(("_file", "_files", "_dir")) or value is None:
+            return value
+        if isinstance(value, list):
+            return [os.path.normpath(os.path.join(root, v)) for v in value]
+        return os.path.normpath(os.path.join(root, value))
+
+    return {k: resolve(k, v) for k, v in run.items()}
+
+
+def save_stage(path: str | os.PathLike, values: dict) -> None:
+    """
+    Save a stage's intermediate values to a directory.
+
+    Arrays are stored as ``.npy`` files. Scalars, strings, and the layout of
+    nested dicts go into a ``meta.json`` sidecar. The directory is written
+    under a temporary name and renamed into place, so it only ever appears
+    complete.
+    """
+
+    def _flatten(values, prefix, outdir):
+        meta = {}
+        for k, v in values.items():
+            name = f"{prefix}{k}"
+            if isinstance(v, dict):
+                meta[k] = {"dict": _flatten(v, f"{name}.", outdir)}
+            elif isinstance(v, np.ndarray):
+                np.save(os.path.join(outdir, f"{name}.npy"), v, allow_pickle=False)
+                meta[k] = {"array": f"{name}.npy"}
+            else:
+                meta[k] = {"value": v.item() if isinstance(v, np.generic) else v}
+        return meta
+
+    path = os.fspath(path)
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        meta = _flatten(values, "", tmpdir)
+        with open(os.path.join(tmpdir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmpdir, path)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+
+def load_stage(path: str | os.PathLike, mmap_mode: str | None = None) -> dict | None:
+    """
+    Load intermediate values saved with ``save_stage``.
+
+    Returns ``None`` if there is no complete stage at ``path``. Pass
+    ``mmap_mode`` (e.g. "r") to memory-map arrays instead of reading them.
+    """
+    path = os.fspath(path)
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    def _unflatten(meta):
+        out = {}
+        for k, v in meta.items():
+            if "dict" in v:
+                out[k] = _unflatten(v["dict"])
+            elif "array" in v:
+                out[k] = np.load(
+                    os.path.join(path, v["array"]),
+                    mmap_mode=mmap_mode,
+                    allow_pickle=False,
+                )
+            else:
+                out[k] = v["value"]
+        return out
+
+    return _unflatten(meta)
+
+
+CHUNK_LAYOUTS = ("by-location", "by-sample")
+
+
+def chunk_shape(
+    layout: str | None,
+    n_samps: int,
+    n_years: int,
+    n_locations: int,
+    target_bytes: int = 2**20,
+) -> tuple[int, int, int] | None:
+    """
+    On-disk (samples, years, locations) chunk shape of ``sea_level_change`` for a layout.
+
+    Parameters
+    ----------
+    layout: ``None`` leaves chunking to the NetCDF library. "by-location"
+        chunks hold all samples of a year at a few locations, for reading
+        full distributions at a location and year. "by-sample" chunks hold
+        all years at a few samples and locations, for reading sample paths
+        across years. Otherwise, an explicit shape like "1000,1,10".
+    n_samps: Number of samples.
+    n_years: Number of years.
+    n_locations: Number of locations.
+    target_bytes: Approximate size of a float32 chunk for the presets.
+
+    Returns
+    -------
+    Chunk shape, clipped to the variable shape, or ``None``.
+    """
+    if layout is None:
+        return None
+
+    target = max(1, target_bytes // 4)
+    if layout == "by-location":
+        n_loc = max(1, target // n_samps)
+        shape = (n_samps, 1, n_loc)
+    elif layout == "by-sample":
+        n_loc = max(1, target // n_years)
+        n_samp = max(1, target // (n_years * min(n_loc, n_locations)))
+        shape = (n_samp, n_years, n_loc)
+    else:
+        try:
+            shape = tuple(int(x) for x in layout.split(","))
+        except ValueError:
+            shape = ()
+        if len(shape) != 3 or min(shape) < 1:
+            raise ValueError(
+                f"chunk layout must be one of {CHUNK_LAYOUTS} or three positive "
+                f"integers like '1000,1,10', got {layout!r}"
+            )
+
+    return tuple(int(min(c, n)) for c, n in zip(shape, (n_samps, n_years, n_locations)))
+
+
+# Size of sea_level_change compressed with shuffle and deflate at level 4,
+# relative to float32, measured on a 20,000-sample, 11-year, 200-location run.
+COMPRESSION_RATIO = 0.7
+
+
+def estimate_output_bytes(
+    n_samps: int,
+    n_years: int,
+    n_locations: int,
+    chunk_layout: str | None = None,
+    compressed: bool = False,
+) -> int:
+    """
+    Predict the size, in bytes, of a global or local SLR file.
+
+    ``sea_level_change`` is stored as float32, padded out to whole chunks
+    for ``chunk_layout``. By default, the size is before compression, an
+    upper bound. With ``compressed``, it is the typical size written, with
+    the data compressed by ``COMPRESSION_RATIO``.
+    """
+    shape = (n_samps, n_years, n_locations)
+    chunks = chunk_shape(chunk_layout, *shape) or shape
+    padded = np.prod([-(-n // c) * c for n, c in zip(shape, chunks)])
+    data = padded * 4
+    if compressed:
+        data *= COMPRESSION_RATIO
+    # Coordinate variables, plus lat and lon per location.
+    coords = n_samps * 8 + n_years * 8 + n_locations * (8 + 8 + 8)
+    return int(data + coords)
+
+
 def write_gslr(
     fl: str | os.PathLike,
     *,
@@ -202,70 +463,151 @@ def write_gslr(
     pipeline_id,
     baseyear,
     scenario,
+    chunk_layout: str | None = None,
+    provenance: str | None = None,
+    parameters: dict | None = None,
+    attrs: dict | None = None,
+    compression_threads: int | None = None,
 ) -> None:
     """
     Write global sealevel rise data to a NetCDF4 file.
-    """
-    # Write the total global projections to a netcdf file
-    rootgrp = Dataset(fl, "w", format="NETCDF4")
-
-    # Define Dimensions
-    _year_dim = rootgrp.createDimension("years", len(targyears))
-    _samp_dim = rootgrp.createDimension("samples", n_samps)
-    _loc_dim = rootgrp.createDimension("locations", 1)
-
-    # Populate dimension variables
-    year_var = rootgrp.createVariable("years", "i4", ("years",))
-    samp_var = rootgrp.createVariable("samples", "i8", ("samples",))
-    loc_var = rootgrp.createVariable("locations", "i8", ("locations",))
-    lat_var = rootgrp.createVariable("lat", "f4", ("locations",))
-    lon_var = rootgrp.createVariable("lon", "f4", ("locations",))
-
-    # Create a data variable
-    samps = rootgrp.createVariable(
-        "sea_level_change",
-        "f4",
-        ("samples", "years", "locations"),
-        zlib=True,
-        complevel=4,
-    )
 
-    # Assign attributes
-    rootgrp.description = "Global SLR contribution from land water storage according to Kopp 2014 workflow"
-    rootgrp.history = "Created " + time.ctime(time.time())
-    rootgrp.source = "FACTS: {0}".format(pipeline_id)
-    rootgrp.baseyear = baseyear
-    rootgrp.scenario = scenario
-    samps.units = "mm"
+    ``lwssamps`` has shape (samples, years), the order written to disk, so
+    it is written without a copy.
 
-    # Put the data into the netcdf variables
-    year_var[:] = targyears
-    samp_var[:] = np.arange(0, n_samps)
-    samps[:, :, :] = lwssamps.T[:, :, np.newaxis]
-    lat_var[:] = np.inf
-    lon_var[:] = np.inf
-    loc_var[:] = -1
+    ``chunk_layout`` sets the on-disk chunking, see ``chunk_shape``.
+    ``provenance`` is stored as a global attribute once the data is written,
+    see ``read_provenance``.
 
-    # Close the netcdf
-    rootgrp.close()
+    ``parameters`` holds the settings of a parameter sweep, one array per
+    parameter with an entry per setting. The samples then have a leading
+    settings axis, written along a ``parameters`` dimension with a variable
+    for each parameter.
 
+    ``attrs`` are extra global attributes, like how adaptive projection
+    converged.
 
-def write_lslr(
+    With ``compression_threads``, ``sea_level_change`` chunks are compressed
+    by that many threads and written pre-compressed with h5py, instead of by
+    the NetCDF library's single-threaded filters. The file is the same
+    NetCDF4 either way.
+    """
+    with gslr_writer(
+        fl,
+        targyears=targyears,
+        n_samps=n_samps,
+        pipeline_id=pipeline_id,
+        baseyear=baseyear,
+        scenario=scenario,
+        chunk_layout=chunk_layout,
+        provenance=provenance,
+        parameters=parameters,
+        attrs=attrs,
+        compression_threads=compression_threads,
+    ) as write:
+        write(0, lwssamps)
+
+
+@contextlib.contextmanager
+def gslr_writer(
     fl: str | os.PathLike,
     *,
-    local_sl,
     targyears,
     n_samps,
+    pipeline_id,
     baseyear,
     scenario,
-    locations: Locations,
-) -> None:
+    chunk_layout: str | None = None,
+    provenance: str | None = None,
+    parameters: dict | None = None,
+    attrs: dict | None = None,
+    compression_threads: int | None = None,
+):
     """
-    Write local sealevel rise data to a NetCDF4 file.
+    Open a global sealevel rise NetCDF4 file to be written a batch of samples at a time.
+
+    Yields a function ``write(start, lwssamps)`` writing samples ``start``
+    onward. ``provenance`` is only stored if the block exits without error.
+    Other arguments are as for ``write_gslr``.
     """
-    # Define the missing value for the netCDF files
-    nc_missing_value = np.nan  # np.iinfo(np.int16).min
+    with _NETCDF_LOCK:
+        # Write the total global projections to a netcdf file
+        rootgrp = Dataset(fl, "w", format="NETCDF4")
+
+        # Define Dimensions
+        _year_dim = rootgrp.createDimension("years", len(targyears))
+        _samp_dim = rootgrp.createDimension("samples", n_samps)
+        _loc_dim = rootgrp.createDimension("locations", 1)
+
+        # Populate dimension variables
+        year_var = rootgrp.createVariable("years", "i4", ("years",))
+        samp_var = rootgrp.createVariable("samples", "i8", ("samples",))
+        loc_var = rootgrp.createVariable("locations", "i8", ("locations",))
+        lat_var = rootgrp.createVariable("lat", "f4", ("locations",))
+        lon_var = rootgrp.createVariable("lon", "f4", ("locations",))
+
+        dims = ("samples", "years", "locations")
+        chunksizes = chunk_shape(chunk_layout, n_samps, len(targyears), 1)
+        if parameters is not None:
+            rootgrp.createDimension("parameters", len(next(iter(parameters.values()))))
+            for name, values in parameters.items():
+                rootgrp.createVariable(name, "f8", ("parameters",))[:] = values
+            dims = ("parameters", *dims)
+            if chunksizes is not None:
+                chunksizes = (1, *chunksizes)
+
+        # Create a data variable
+        samps = rootgrp.createVariable(
+            "sea_level_change",
+            "f4",
+            dims,
+            zlib=True,
+            complevel=4,
+            chunksizes=chunksizes,
+        )
+
+        # Assign attributes
+        rootgrp.description = "Global SLR contribution from land water storage according to Kopp 2014 workflow"
+        rootgrp.history = "Created " + time.ctime(time.time())
+        rootgrp.source = "FACTS: {0}".format(pipeline_id)
+        rootgrp.baseyear = baseyear
+        rootgrp.scenario = scenario
+        if attrs:
+            rootgrp.setncatts(attrs)
+        samps.units = "mm"
+
+        # Put the coordinates into the netcdf variables
+        year_var[:] = targyears
+        samp_var[:] = np.arange(0, n_samps)
+        lat_var[:] = np.inf
+        lon_var[:] = np.inf
+        loc_var[:] = -1
+
+    def write(start, lwssamps):
+        if parameters is None:
+            data = lwssamps[:, :, np.newaxis]
+            region = (slice(start, start + data.shape[0]), slice(None), slice(None))
+        else:
+            data = lwssamps[..., np.newaxis]
+            region = (slice(None), slice(start, start + data.shape[1]))
+        with _lock_for(target):
+            target[region] = data
+
+    with _sea_level_change_target(
+        fl, rootgrp, provenance, compression_threads
+    ) as target:
+        yield write
 
+
+def _lslr_dataset(
+    targyears,
+    n_samps,
+    baseyear,
+    scenario,
+    locations: Locations,
+    location_map: LocationMap | None,
+) -> xr.Dataset:
+    """Local SLR dataset with everything but the samples."""
     # Create the xarray data structures for the localized projections
     ncvar_attributes = {
         "description": "Local SLR contributions from land water storage according to Kopp 2014 workflow",
@@ -277,11 +619,6 @@ def write_lslr(
 
     lws_out = xr.Dataset(
         {
-            "sea_level_change": (
-                ("samples", "years", "locations"),
-                local_sl,
-                {"units": "mm", "missing_value": nc_missing_value},
-            ),
             "lat": (("locations"), locations.lat),
             "lon": (("locations"), locations.lon),
         },
@@ -293,15 +630,416 @@ def write_lslr(
         attrs=ncvar_attributes,
     )
 
-    lws_out.to_netcdf(
+    if location_map is not None:
+        lws_out["site_id"] = (("sites"), location_map.original.id)
+        lws_out["site_index"] = (
+            ("sites"),
+            location_map.index,
+            {"description": "Index along locations holding each original site"},
+        )
+    return lws_out
+
+
+def write_lslr(
+    fl: str | os.PathLike,
+    *,
+    local_sl,
+    targyears,
+    n_samps,
+    baseyear,
+    scenario,
+    locations: Locations,
+    location_map: LocationMap | None = None,
+    overlap: bool = False,
+    chunk_layout: str | None = None,
+    provenance: str | None = None,
+    client=None,
+    attrs: dict | None = None,
+    compression_threads: int | None = None,
+) -> None:
+    """
+    Write local sealevel rise data to a NetCDF4 file.
+
+    ``chunk_layout`` sets the on-disk chunking, see ``chunk_shape``.
+    ``provenance`` is stored as a global attribute once the data is written,
+    see ``read_provenance``.
+
+    With ``overlap``, chunks of ``local_sl`` are computed in the calling thread
+    while a background thread compresses and writes the previous chunk.
+
+    With a distributed ``client``, chunks are computed on the cluster and
+    gathered as they finish, and only the calling process writes to the
+    file, so workers never need access to it.
+
+    If ``location_map`` is given, ``locations`` are its deduplicated slots and
+    the file also gets ``site_id`` and ``site_index`` along a ``sites``
+    dimension, in the original location order. Select
+    ``locations=site_index`` to expand the output back to the original sites.
+
+    ``attrs`` and ``compression_threads`` are as for ``write_gslr``.
+    """
+    with lslr_writer(
         fl,
-        encoding={
-            "sea_level_change": {
-                "dtype": "f4",
-                "zlib": True,
-                "complevel": 4,
-                "_FillValue": nc_missing_value,
-            }
-        },
+        targyears=targyears,
+        n_samps=n_samps,
+        baseyear=baseyear,
+        scenario=scenario,
+        locations=locations,
+        location_map=location_map,
+        overlap=overlap,
+        chunk_layout=chunk_layout,
+        provenance=provenance,
+        client=client,
+        attrs=attrs,
+        compression_threads=compression_threads,
+    ) as write:
+        write(0, local_sl)
+
+
+@contextlib.contextmanager
+def lslr_writer(
+    fl: str | os.PathLike,
+    *,
+    targyears,
+    n_samps,
+    baseyear,
+    scenario,
+    locations: Locations,
+    location_map: LocationMap | None = None,
+    overlap: bool = False,
+    chunk_layout: str | None = None,
+    provenance: str | None = None,
+    client=None,
+    attrs: dict | None = None,
+    compression_threads: int | None = None,
+):
+    """
+    Open a local sealevel rise NetCDF4 file to be written a batch of samples at a time.
+
+    Yields a function ``write(start, local_sl)`` writing samples ``start``
+    onward, chunk by chunk. Without ``overlap`` or ``client``, chunks are
+    computed in parallel and written under a lock. ``provenance`` is only
+    stored if the block exits without error. Other arguments are as for
+    ``write_lslr``.
+    """
+    # Define the missing value for the netCDF files
+    nc_missing_value = np.nan  # np.iinfo(np.int16).min
+
+    # Write everything but the samples, then fill those in chunk by chunk.
+    lws_out = _lslr_dataset(
+        targyears, n_samps, baseyear, scenario, locations, location_map
+    )
+    if attrs:
+        lws_out.attrs.update(attrs)
+    with _NETCDF_LOCK:
+        lws_out.to_netcdf(fl)
+        rootgrp = Dataset(fl, "a")
+        samps = rootgrp.createVariable(
+            "sea_level_change",
+            "f4",
+            ("samples", "years", "locations"),
+            zlib=True,
+            complevel=4,
+            fill_value=nc_missing_value,
+            chunksizes=chunk_shape(
+                chunk_layout, n_samps, len(targyears), len(locations.id)
+            ),
+        )
+        samps.units = "mm"
+        samps.missing_value = np.float32(nc_missing_value)
+
+    def write(start, local_sl):
+        if client is not None:
+            _write_gathered(target, local_sl, client, offset=start)
+        elif overlap:
+            _write_overlapped(target, local_sl, offset=start)
+        else:
+            local_sl = da.asarray(local_sl)
+            da.store(
+                local_sl.astype("f4"),
+                target,
+                regions=(slice(start, start + local_sl.shape[0]),),
+                # Compressed chunks are written under the lock, not compressed.
+                lock=not isinstance(target, _ChunkCompressor) and _NETCDF_LOCK,
+            )
+
+    with _sea_level_change_target(
+        fl, rootgrp, provenance, compression_threads
+    ) as target:
+        yield write
+
+
+def read_provenance(fl: str | os.PathLike) -> str | None:
+    """
+    Read the provenance attribute of an output file.
+
+    Returns ``None`` if the file is missing, unreadable, or was written
+    without provenance.
+    """
+    try:
+        with _NETCDF_LOCK, Dataset(fl, "r") as rootgrp:
+            return getattr(rootgrp, "provenance", None)
+    except OSError:
+        return None
+
+
+def _block_regions(chunks):
+    """
+    Yield the region of each block of a dask array with the given chunks.
+    """
+    bounds = [np.cumsum((0,) + c) for c in chunks]
+    for idx in itertools.product(*(range(len(c)) for c in chunks)):
+        yield tuple(slice(b[i], b[i + 1]) for b, i in zip(bounds, idx))
+
+
+def _offset_region(region, offset):
+    """Shift a block region along the first (samples) axis."""
+    first = slice(region[0].start + offset, region[0].stop + offset)
+    return (first, *region[1:])
+
+
+def _deflate_chunk(chunk: np.ndarray, level: int, shuffle: bool) -> bytes:
+    """Compress a chunk the way HDF5's shuffle and deflate filters do."""
+    chunk = np.ascontiguousarray(chunk)
+    if shuffle and chunk.itemsize > 1:
+        # Byte shuffle: all first bytes of the elements, then all second bytes...
+        chunk = np.ascontiguousarray(
+            chunk.reshape(-1).view(np.uint8).reshape(-1, chunk.itemsize).T
+        )
+    return zlib.compress(chunk, level)
+
+
+class _ChunkCompressor:
+    """
+    Write blocks to an h5py dataset as chunks compressed by a thread pool.
+
+    Chunks a block covers completely are compressed in ``pool``, zlib
+    releasing the GIL, and written as is with ``write_direct_chunk``, skipping
+    HDF5's single-threaded filter pipeline. Chunks a block covers only in part
+    are written through HDF5, which merges them with what is already stored.
+    Either way the file holds ordinary deflated chunks.
+
+    Supports ``target[region] = block`` like a netCDF4 variable, and takes
+    ``_NETCDF_LOCK`` itself only while writing.
+    """
+
+    def __init__(self, dset, pool: ThreadPoolExecutor):
+        if (
+            dset.chunks is None
+            or dset.compression != "gzip"
+            or dset.fletcher32
+            or dset.scaleoffset is not None
+        ):
+            raise ValueError(
+                f"{dset.name} must be chunked with only shuffle and deflate filters"
+            )
+        self.dset = dset
+        self.pool = pool
+        self.level = dset.compression_opts
+        self.shuffle = dset.shuffle
+        self.shape = dset.shape
+        self.chunks = dset.chunks
+
+    def __setitem__(self, region, block):
+        region = tuple(region) + (slice(None),) * (len(self.shape) - len(region))
+        region = tuple(slice(*r.indices(n)) for r, n in zip(region, self.shape))
+        block = np.asarray(block, dtype=self.dset.dtype).reshape(
+            [r.stop - r.start for r in region]
+        )
+
+        full, partial = [], []
+        for corner in itertools.product(
+            *(range(r.start // c * c, r.stop, c) for r, c in zip(region, self.chunks))
+        ):
+            inner = tuple(
+                slice(max(c0, r.start), min(c0 + c, n, r.stop))
+                for c0, c, n, r in zip(corner, self.chunks, self.shape, region)
+            )
+            local = tuple(
+                slice(i.start - r.start, i.stop - r.start)
+                for i, r in zip(inner, region)
+            )
+            covered = all(
+                i.start == c0 and i.stop == min(c0 + c, n)
+                for i, c0, c, n in zip(inner, corner, self.chunks, self.shape)
+            )
+            (full if covered else partial).append((corner, inner, local))
+
+        def compress(item):
+            corner, inner, local = item
+            chunk = block[local]
+            if chunk.shape != self.chunks:
+                # Edge chunks are stored whole; the padding is never read.
+                padded = np.zeros(self.chunks, dtype=chunk.dtype)
+                padded[tuple(slice(0, n) for n in chunk.shape)] = chunk
+                chunk = padded
+            return corner, _deflate_chunk(chunk, self.level, self.shuffle)
+
+        for corner, data in self.pool.map(compress, full):
+            with _NETCDF_LOCK:
+                self.dset.id.write_direct_chunk(corner, data)
+        for _, inner, local in partial:
+            with _NETCDF_LOCK:
+                self.dset[inner] = block[local]
+
+
+def _lock_for(target):
+    """The lock to hold while writing to ``target``; a ``_ChunkCompressor`` takes it itself."""
+    if isinstance(target, _ChunkCompressor):
+        return contextlib.nullcontext()
+    return _NETCDF_LOCK
+
+
+@contextlib.contextmanager
+def _sea_level_change_target(
+    fl, rootgrp, provenance: str | None, compression_threads: int | None
+):
+    """
+    Yield where to write ``sea_level_change`` of the open ``rootgrp``, then close the file.
+
+    ``provenance`` is stored only if the block exits without error. With
+    ``compression_threads``, ``rootgrp`` is closed and the file reopened with
+    h5py, to write the variable as chunks compressed by that many threads,
+    see ``_ChunkCompressor``.
+    """
+    if compression_threads is None:
+        try:
+            yield rootgrp["sea_level_change"]
+
+            # Only mark the file with its provenance once it is complete.
+            if provenance is not None:
+                with _NETCDF_LOCK:
+                    rootgrp.provenance = provenance
+        finally:
+            with _NETCDF_LOCK:
+                rootgrp.close()
+        return
+
+    with _NETCDF_LOCK:
+        rootgrp.close()
+    try:
+        import h5py
+    except ImportError as e:
+        raise ImportError(
+            "compression_threads requires the optional h5py package"
+        ) from e
+
+    with ThreadPoolExecutor(
+        max_workers=compression_threads, thread_name_prefix="compress"
+    ) as pool:
+        with _NETCDF_LOCK:
+            h5file = h5py.File(fl, "r+")
+        try:
+            yield _ChunkCompressor(h5file["sea_level_change"], pool)
+        finally:
+            with _NETCDF_LOCK:
+                h5file.close()
+
+    if provenance is not None:
+        with _NETCDF_LOCK, Dataset(fl, "a") as rootgrp:
+            rootgrp.provenance = provenance
+
+
+def _write_overlapped(var, arr, queue_size: int = 1, offset: int = 0) -> None:
+    """
+    Compute blocks of ``arr`` and write them to the netCDF4 ``var`` from a background thread.
+
+    At most ``queue_size`` computed blocks wait for the writer, so besides the
+    block being computed and the block being written, memory stays bounded.
+    ``arr`` is written from sample ``offset`` onward.
+    """
+    arr = da.asarray(arr)
+    blocks = queue.Queue(maxsize=queue_size)
+    write_time = 0.0
+    error = None
+
+    def writer():
+        nonlocal write_time, error
+        while (item := blocks.get()) is not None:
+            # Keep draining after a failure so the producer never blocks.
+            if error is not None:
+                continue
+            region, block = item
+            try:
+                t0 = time.perf_counter()
+                with _lock_for(var):
+                    var[_offset_region(region, offset)] = block
+                write_time += time.perf_counter() - t0
+            except BaseException as e:
+                error = e
+
+    compute_time = 0.0
+    start = time.perf_counter()
+    thread = threading.Thread(target=writer, name="write_lslr")
+    thread.start()
+    try:
+        for region in _block_regions(arr.chunks):
+            if error is not None:
+                break
+            t0 = time.perf_counter()
+            block = np.asarray(arr[region].compute(), dtype="f4")
+            compute_time += time.perf_counter() - t0
+            blocks.put((region, block))
+    finally:
+        blocks.put(None)
+        thread.join()
+    if error is not None:
+        raise error
+
+    wall_time = time.perf_counter() - start
+    logger.info(
+        "Localized and wrote in %.2fs (compute %.2fs, write %.2fs); overlap saved %.2fs",
+        wall_time,
+        compute_time,
+        write_time,
+        compute_time + write_time - wall_time,
+    )
+
+
+def _write_gathered(
+    var, arr, client, max_in_flight: int | None = None, offset: int = 0
+) -> None:
+    """
+    Compute blocks of ``arr`` on a distributed cluster and write them to the netCDF4 ``var``.
+
+    Blocks are written by the calling process in the order they finish. At
+    most ``max_in_flight`` blocks, by default twice the cluster's threads,
+    are submitted or waiting to be written at a time. ``arr`` is written from
+    sample ``offset`` onward.
+    """
+    from distributed import as_completed
+
+    arr = da.asarray(arr)
+    if max_in_flight is None:
+        max_in_flight = 2 * max(sum(client.nthreads().values()), 1)
+
+    regions = _block_regions(arr.chunks)
+    pending = {}
+
+    def submit():
+        region = next(regions, None)
+        if region is not None:
+            future = client.compute(arr[region])
+            pending[future] = region
+            return future
+
+    futures = as_completed(
+        [f for f in (submit() for _ in range(max_in_flight)) if f is not None]
+    )
+    write_time = 0.0
+    start = time.perf_counter()
+    for future in futures:
+        region = pending.pop(future)
+        block = np.asarray(future.result(), dtype="f4")
+        t0 = time.perf_counter()
+        with _lock_for(var):
+            var[_offset_region(region, offset)] = block
+        write_time += time.perf_counter() - t0
+        if (nxt := submit()) is not None:
+            futures.add(nxt)
+
+    logger.info(
+        "Gathered and wrote in %.2fs (write %.2fs)",
+        time.perf_counter() - start,
+        write_time,
     )
-    pass
@@ -0,0 +1,188 @@
+"""
+Fused kernels for the hot loops, with an optional compiled backend.
+
+The "numba" backend is used when numba is installed. The "numpy" backend is
+always available and gives identical results. Both compute in the precision
+of their array inputs, float64 or float32, and release the GIL while they
+run, so dask's threads localize chunks in parallel.
+"""
+
+from collections.abc import Callable
+from dataclasses import dataclass
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+BACKENDS = ("auto", "numpy", "numba")
+
+
+@dataclass
+class Kernels:
+    name: str
+    sample_curves: Callable
+    outer: Callable
+    outer_sum: Callable
+
+
+def _sample_curves_numpy(
+    gwd_base,
+    gwd_factor,
+    dam_base,
+    dam_factor,
+    dc_years,
+    dc_rates,
+    traj,
+    base_idx,
+    targ_idx,
+):
+    """
+    Combine base curves and per-sample factors into centered samples.
+
+    Parameters
+    ----------
+    gwd_base: GWD base curve of each population trajectory, shape (trajectories, years).
+    gwd_factor: GWD factor for each setting and sample, shape (settings, samples).
+    dam_base: Reservoir base curve of each trajectory, shape (trajectories, years).
+    dam_factor: Reservoir factor, shape (settings, samples).
+    dc_years: Years of dam correction for each setting, shape (settings, years).
+    dc_rates: Dam correction rates, shape (settings, samples).
+    traj: Population trajectory of each sample, shape (samples,).
+    base_idx: Index of the base year the samples are centered to.
+    targ_idx: Indices of the years to return.
+
+    Returns
+    -------
+    Samples with shape (settings, samples, target years), the order they are
+    written to disk in.
+    """
+    samples = np.ix_(traj, targ_idx)
+    # Only 80% of ground water depletion makes it to the ocean (Wada et al. 2016).
+    out = gwd_factor[:, :, np.newaxis] * gwd_base[samples]
+    out *= 0.8
+    tmp = np.multiply(dam_factor[:, :, np.newaxis], dam_base[samples])
+    out += tmp
+    np.multiply(dc_rates[:, :, np.newaxis], dc_years[:, np.newaxis, targ_idx], out=tmp)
+    out += tmp
+
+    center = (
+        gwd_base[traj, base_idx] * gwd_factor * 0.8
+        + dam_base[traj, base_idx] * dam_factor
+        + dc_rates * dc_years[:, base_idx, np.newaxis]
+    )
+    out -= center[:, :, np.newaxis]
+    return out
+
+
+def _outer_numpy(a, b):
+    return np.multiply.outer(a, b)
+
+
+def _outer_sum_numpy(a, b):
+    """
+    Sum of outer products over the first axis of both inputs.
+
+    Parameters
+    ----------
+    a: Global samples of each component, shape (components, samples, years).
+    b: Fingerprint coefficients of each component, shape (components, locations).
+
+    Returns
+    -------
+    Local samples with shape (samples, years, locations).
+    """
+    out = np.multiply.outer(a[0], b[0])
+    # Accumulate a year at a time, so the temporary is a small part of a chunk.
+    tmp = np.empty((out.shape[0], out.shape[2]), dtype=out.dtype)
+    for c in range(1, len(a)):
+        for j in range(out.shape[1]):
+            np.multiply.outer(a[c, :, j], b[c], out=tmp)
+            out[:, j] += tmp
+    return out
+
+
+if numba is not None:
+
+    @numba.njit(cache=True, nogil=True)
+    def _sample_curves_numba(
+        gwd_base,
+        gwd_factor,
+        dam_base,
+        dam_factor,
+        dc_years,
+        dc_rates,
+        traj,
+        base_idx,
+        targ_idx,
+    ):
+        nsettings, nsamps = gwd_factor.shape
+        out = np.empty((nsettings, nsamps, len(targ_idx)), dtype=gwd_factor.dtype)
+        # The 80% factor in the inputs' precision, as numpy casts the literal.
+        wada = np.full(1, 0.8, dtype=gwd_factor.dtype)[0]
+        for p in range(nsettings):
+            for s in range(nsamps):
+                t = traj[s]
+                center = (
+                    gwd_base[t, base_idx] * gwd_factor[p, s] * wada
+                    + dam_base[t, base_idx] * dam_factor[p, s]
+                    + dc_rates[p, s] * dc_years[p, base_idx]
+                )
+                for j in range(len(targ_idx)):
+                    y = targ_idx[j]
+                    out[p, s, j] = (
+                        gwd_base[t, y] * gwd_factor[p, s] * wada
+                        + dam_base[t, y] * dam_factor[p, s]
+                        + dc_rates[p, s] * dc_years[p, y]
+                        - center
+                    )
+        return out
+
+    @numba.njit(cache=True, nogil=True)
+    def _outer_numba(a, b):
+        out = np.empty((a.shape[0], a.shape[1], b.shape[0]), dtype=a.dtype)
+        for i in range(a.shape[0]):
+            for j in range(a.shape[1]):
+                for k in range(b.shape[0]):
+                    out[i, j, k] = a[i, j] * b[k]
+        return out
+
+    @numba.njit(cache=True, nogil=True)
+    def _outer_sum_numba(a, b):
+        ncomponents, nsamps, nyears = a.shape
+        out = np.empty((nsamps, nyears, b.shape[1]), dtype=a.dtype)
+        for i in range(nsamps):
+            for j in range(nyears):
+                for k in range(b.shape[1]):
+                    acc = a[0, i, j] * b[0, k]
+                    for c in range(1, ncomponents):
+                        acc += a[c, i, j] * b[c, k]
+                    out[i, j, k] = acc
+        return out
+
+
+def get_kernels(backend: str = "auto") -> Kernels:
+    """
+    Select the kernels of a backend.
+
+    Parameters
+    ----------
+    backend: One of ``BACKENDS``. "auto" picks "numba" if it is installed and
+        "numpy" otherwise.
+
+    Returns
+    -------
+    The backend's kernels.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown kernels backend {backend!r}, choose from {BACKENDS}")
+    if backend == "auto":
+        backend = "numpy" if numba is None else "numba"
+    if backend == "numba":
+        if numba is None:
+            raise ValueError("the numba kernels backend requires numba to be installed")
+        return Kernels("numba", _sample_curves_numba, _outer_numba, _outer_sum_numba)
+    return Kernels("numpy", _sample_curves_numpy, _outer_numpy, _outer_sum_numpy)
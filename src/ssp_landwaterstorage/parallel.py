@@ -0,0 +1,135 @@
+"""
+Process-pool localization over shared memory.
+"""
+
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import dask.array as da
+import numpy as np
+
+from ssp_landwaterstorage.core import Fingerprints, Locations
+from ssp_landwaterstorage.kernels import get_kernels
+
+logger = logging.getLogger(__name__)
+
+# Arrays a worker process attached to in _attach.
+_worker = {}
+
+
+def _to_shared(arr: np.ndarray) -> tuple[SharedMemory, tuple]:
+    """Copy an array into a new shared memory block, returning it and how to attach to it."""
+    shm = SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def _attach(gslr_spec, coef_spec, out_path, backend) -> None:
+    """Worker initializer: map the shared inputs and the output buffer once."""
+    for key, (name, shape, dtype) in (("gslr", gslr_spec), ("coef", coef_spec)):
+        shm = SharedMemory(name=name)
+        _worker[key + "_shm"] = shm
+        _worker[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker["out"] = np.load(out_path, mmap_mode="r+")
+    kernels = get_kernels(backend)
+    # Split global samples are localized one fingerprint per component.
+    _worker["outer"] = kernels.outer if len(gslr_spec[1]) == 2 else kernels.outer_sum
+
+
+def _localize_tile(s0, s1, l0, l1) -> None:
+    """Localize one (samples, locations) tile straight into the output buffer."""
+    _worker["out"][s0:s1, :, l0:l1] = _worker["outer"](
+        _worker["gslr"][..., s0:s1, :], _worker["coef"][..., l0:l1]
+    )
+
+
+def postprocess_processes(
+    lwssamps,
+    fingerprints: Fingerprints,
+    sites: Locations,
+    chunksize,
+    processes: int,
+    out_path: str | os.PathLike,
+    kernels: str = "auto",
+    coefficients=None,
+    dtype=np.float64,
+):
+    """
+    Localize global samples with a pool of worker processes.
+
+    Like ``core.postprocess``, but the global samples and fingerprint
+    coefficients are put in shared memory once, and each worker writes its
+    tiles into a memory-mapped ``.npy`` output buffer at ``out_path``. Nothing
+    but tile bounds is pickled between processes.
+
+    Parameters
+    ----------
+    lwssamps: Global samples, shape (samples, years), or (components, samples,
+        years) with one row of ``coefficients`` per component.
+    fingerprints: Fingerprints to localize with.
+    sites: Locations to localize to.
+    chunksize: Number of locations per tile, or (samples, locations) per tile.
+    processes: Number of worker processes.
+    out_path: Path of the output buffer. It must stay until the result is written.
+    kernels: Kernels backend, see ``get_kernels``.
+    coefficients: Fingerprint coefficients at ``sites``, if already interpolated.
+    dtype: Precision to localize in, one of ``core.COMPUTE_DTYPES``.
+
+    Returns
+    -------
+    Dask array of local samples with shape (samples, years, locations), read
+    from the output buffer in tiles. The buffer holds float32, the precision
+    written to output files.
+    """
+    gslr = np.ascontiguousarray(lwssamps, dtype=dtype)
+    if coefficients is None:
+        coefficients = fingerprints.interpolate_coefficients(sites)
+    coef = np.ascontiguousarray(coefficients, dtype=dtype)
+    nsamps, nyears = gslr.shape[-2:]
+    nlocations = coef.shape[-1]
+    if isinstance(chunksize, tuple):
+        samp_chunksize, loc_chunksize = chunksize
+    else:
+        samp_chunksize, loc_chunksize = nsamps, chunksize
+
+    out = np.lib.format.open_memmap(
+        out_path, mode="w+", dtype="f4", shape=(nsamps, nyears, nlocations)
+    )
+    del out
+
+    tiles = [
+        (s0, min(s0 + samp_chunksize, nsamps), l0, min(l0 + loc_chunksize, nlocations))
+        for s0 in range(0, nsamps, samp_chunksize)
+        for l0 in range(0, nlocations, loc_chunksize)
+    ]
+
+    start = time.perf_counter()
+    gslr_shm, gslr_spec = _to_shared(gslr)
+    coef_shm, coef_spec = _to_shared(coef)
+    try:
+        # Spawn rather than fork, the parent may be running dask threads.
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_attach,
+            initargs=(gslr_spec, coef_spec, os.fspath(out_path), kernels),
+        ) as pool:
+            for f in [pool.submit(_localize_tile, *tile) for tile in tiles]:
+                f.result()
+    finally:
+        for shm in (gslr_shm, coef_shm):
+            shm.close()
+            shm.unlink()
+    logger.info(
+        "Localized %d tiles with %d processes in %.2fs",
+        len(tiles),
+        processes,
+        time.perf_counter() - start,
+    )
+
+    out = np.load(out_path, mmap_mode="r")
+    return da.from_array(out, chunks=(samp_chunksize, -1, loc_chunksize))
@@ -0,0 +1,217 @@
+"""
+Per-stage profiles and dask task traces of a run, for offline analysis.
+"""
+
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from dask.utils import key_split
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+# Thread ids of the trace, the dask worker threads come after these.
+_STAGES_TID = 0
+_MEMORY_TID = 1
+
+
+class RunProfiler:
+    """
+    Record profiles of a run's stages and a trace of its dask tasks into ``profile_dir``.
+
+    Each ``stage`` is profiled deterministically with cProfile and saved to
+    "<stage>.prof" for ``pstats`` or viewers like snakeviz. cProfile sees
+    every thread, including dask's, but only one profile can run at a time,
+    so a stage starting while another runs is not profiled.
+    Stage spans, the dask tasks computed inside ``tasks`` blocks
+    and the resident memory sampled every ``memory_interval`` seconds while
+    they run all go into "trace.json", in the Chrome trace event format that
+    Perfetto and chrome://tracing open. The trace is rewritten as each block
+    ends, so a run that fails or is killed still leaves one behind.
+
+    Memory is read with psutil if it is installed, or else from
+    /proc/self/statm, where the system has one. Elsewhere, the peak resident
+    memory so far is sampled instead. Without a ``profile_dir``, nothing is
+    recorded.
+    """
+
+    def __init__(self, profile_dir=None, memory_interval=0.05):
+        self.profile_dir = profile_dir
+        self.memory_interval = memory_interval
+        self._events = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": 0,
+                "tid": tid,
+                "args": {"name": n},
+            }
+            for tid, n in [(_STAGES_TID, "stages"), (_MEMORY_TID, "memory")]
+        ]
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._wall_origin = time.time()
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.profile_dir is not None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Profile the code inside as stage ``name``."""
+        if not self.enabled:
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            logger.warning("Not profiling %s stage: %s", name, e)
+            profile = None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self._record([self._span(name, "stage", start, end, _STAGES_TID)])
+            if profile is not None:
+                profile.disable()
+                fl = os.path.join(self.profile_dir, f"{name}.prof")
+                profile.dump_stats(fl)
+                logger.info("Profiled %s stage (%.2fs) to %s", name, end - start, fl)
+
+    @contextlib.contextmanager
+    def tasks(self, name, client=None):
+        """
+        Trace the dask tasks computed inside, and sample memory while they run.
+
+        Tasks are those of the local scheduler, or of ``client``'s cluster if
+        given, labelled with ``name``.
+        """
+        if not self.enabled:
+            yield
+            return
+        samples = []
+        done = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample_memory, args=(samples, done), name="memory"
+        )
+        sampler.start()
+        try:
+            if client is None:
+                from dask.diagnostics import Profiler
+
+                with Profiler() as prof:
+                    yield
+                tasks = [
+                    (r.key, r.start_time, r.end_time, r.worker_id) for r in prof.results
+                ]
+            else:
+                from distributed import get_task_stream
+
+                with get_task_stream(client) as stream:
+                    yield
+                tasks = [
+                    (
+                        t["key"],
+                        s["start"] - self._wall_origin + self._origin,
+                        s["stop"] - self._wall_origin + self._origin,
+                        f"{t['worker']}/{t['thread']}",
+                    )
+                    for t in stream.data
+                    for s in t["startstops"]
+                    if s["action"] == "compute"
+                ]
+        finally:
+            done.set()
+            sampler.join()
+        # Number worker threads after the stage and memory rows of the trace.
+        tids = {}
+        events = [
+            self._span(
+                key_split(key),
+                name,
+                start,
+                end,
+                tids.setdefault(worker, len(tids) + 2),
+                key=str(key),
+            )
+            for key, start, end, worker in tasks
+        ]
+        events += [
+            {
+                "name": "memory",
+                "ph": "C",
+                "ts": self._us(t),
+                "pid": 0,
+                "tid": _MEMORY_TID,
+                "args": {"rss_mib": rss / 2**20},
+            }
+            for t, rss in samples
+        ]
+        self._record(events)
+        logger.info("Traced %d dask tasks of %s", len(tasks), name)
+
+    def _sample_memory(self, samples, done) -> None:
+        rss = _rss_reader()
+        while True:
+            samples.append((time.perf_counter(), rss()))
+            if done.wait(self.memory_interval):
+                return
+
+    def _us(self, t) -> float:
+        """Microseconds since the profiler started, the trace's time unit."""
+        return (t - self._origin) * 1e6
+
+    def _span(self, name, cat, start, end, tid, **args) -> dict:
+        return {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": self._us(start),
+            "dur": self._us(end) - self._us(start),
+            "pid": 0,
+            "tid": tid,
+            "args": args,
+        }
+
+    def _record(self, events) -> None:
+        with self._lock:
+            self._events.extend(events)
+            trace = {"traceEvents": self._events, "displayTimeUnit": "ms"}
+            tmpfl = os.path.join(self.profile_dir, ".trace.json")
+            with open(tmpfl, "w") as f:
+                json.dump(trace, f)
+            os.replace(tmpfl, os.path.join(self.profile_dir, "trace.json"))
+
+
+def _rss_reader():
+    """A function returning this process's resident memory in bytes."""
+    if psutil is not None:
+        process = psutil.Process()
+        return lambda: process.memory_info().rss
+    if os.path.exists("/proc/self/statm"):
+        page_size = os.sysconf("SC_PAGE_SIZE")
+
+        def statm():
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * page_size
+
+        return statm
+    import resource
+
+    # Peak rather than current memory, in bytes on macOS and KiB elsewhere.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
@@ -2,18 +2,271 @@
 Services the UI provides to our lovely users.
 """
 
-from ssp_landwaterstorage.core import preprocess, fit, project, postprocess
+import collections
+import contextlib
+import hashlib
+import inspect
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from importlib.metadata import version
+
+import dask.array as da
+import numpy as np
+
+from ssp_landwaterstorage.core import (
+    preprocess,
+    fit,
+    project,
+    project_adaptive,
+    project_batches,
+    project_sweep,
+    parameter_grid,
+    postprocess,
+    deduplicate_locations,
+    plan_chunks,
+    estimate_memory,
+    estimate_runtime,
+    target_years,
+    ADAPTIVE_BATCH_SIZE,
+    DEFAULT_QUANTILES,
+)
+from ssp_landwaterstorage.parallel import postprocess_processes
+from ssp_landwaterstorage.profiling import RunProfiler
 from ssp_landwaterstorage.io import (
     read_fingerprints,
     read_population_history,
     read_population_scenarios,
+    read_population_ensemble,
     read_locations,
     read_reservoir_impoundment,
     read_groundwater_depletion,
     write_gslr,
     write_lslr,
+    gslr_writer,
+    lslr_writer,
+    save_stage,
+    load_stage,
+    estimate_output_bytes,
+    read_provenance,
+    read_job,
 )
 
+logger = logging.getLogger(__name__)
+
+
+def _file_signature(fl):
+    """Cheap identity of an input file: its path, size and modification time."""
+    if fl is None:
+        return None
+    st = os.stat(fl)
+    return [os.fspath(fl), st.st_size, st.st_mtime_ns]
+
+
+def _stage_key(*parts) -> str:
+    """Hash run parameters into a short checkpoint key."""
+    blob = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.sha256(blob).hexdigest()[:16]
+
+
+# Parameters that name files or only control how a run executes, not what it writes.
+_PROVENANCE_EXCLUDE = {
+    "pophist_file",
+    "reservoir_file",
+    "popscen_file",
+    "population_ensemble_file",
+    "gwd_files",
+    "fp_file",
+    "location_file",
+    "output_gslr_file",
+    "output_lslr_file",
+    "checkpoint_dir",
+    "resume",
+    "skip_if_current",
+    "kernels",
+    "processes",
+    "scheduler_address",
+    "batch_size",
+    "compression_threads",
+    "cache",
+    "fit_workers",
+    "profile_dir",
+}
+
+
+def provenance_hash(input_files, params: dict) -> str:
+    """
+    Hash the contents of input files, run parameters and the package version.
+
+    Input files that are None, like unused optional inputs, are skipped.
+    """
+    h = hashlib.sha256()
+    h.update(version("ssp-landwaterstorage").encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    for fl in input_files:
+        if fl is None:
+            continue
+        with open(fl, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+class StageCache:
+    """
+    Stage outputs kept in memory, to share between runs in one process.
+
+    Outputs are keyed like checkpoints, by stage name and a hash of everything
+    the stage depends on, so a run only reuses what it would have computed
+    itself. ``hits`` counts reuses by stage name, across all runs sharing the
+    cache; ``for_run`` gives a view counting the reuses of one run alone.
+
+    With ``max_entries``, the least recently used outputs are dropped to keep
+    at most that many.
+    """
+
+    def __init__(self, max_entries=None):
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+        self.hits = collections.Counter()
+
+    def get(self, name, key, compute, hits=None):
+        """
+        Return the stored output of stage ``name`` for ``key``, computing it if missing.
+
+        A reuse is also counted in ``hits``, a ``collections.Counter``, if given.
+        """
+        with self._lock:
+            if (name, key) in self._values:
+                self.hits[name] += 1
+                if hits is not None:
+                    hits[name] += 1
+                self._values.move_to_end((name, key))
+                return self._values[(name, key)]
+        values = compute()
+        with self._lock:
+            self._values[(name, key)] = values
+            self._values.move_to_end((name, key))
+            while self.max_entries is not None and len(self._values) > self.max_entries:
+                (evicted, _), _ = self._values.popitem(last=False)
+                logger.debug("Evicted a %s stage output from the cache", evicted)
+        return values
+
+    def export(self, names) -> dict:
+        """The stored outputs of the stages ``names``, to ``update`` another cache with."""
+        with self._lock:
+            return {k: v for k, v in self._values.items() if k[0] in names}
+
+    def update(self, entries) -> None:
+        """Store the outputs in ``entries``, as returned by ``export``."""
+        with self._lock:
+            self._values.update(entries)
+
+    def for_run(self) -> "_RunCache":
+        """A view of the cache whose ``hits`` only count the reuses made through it."""
+        return _RunCache(self)
+
+    def __len__(self):
+        return len(self._values)
+
+
+class _RunCache:
+    """One run's view of a ``StageCache``, shared with concurrent runs."""
+
+    def __init__(self, cache):
+        self._cache = cache
+        self.hits = collections.Counter()
+
+    def get(self, name, key, compute):
+        return self._cache.get(name, key, compute, hits=self.hits)
+
+    def __len__(self):
+        return len(self._cache)
+
+
+def _cached(cache, name, key, compute):
+    """Compute a stage, or share it through ``cache``, a ``StageCache``, if given."""
+    if cache is None:
+        return compute()
+    return cache.get(name, key, compute)
+
+
+def _run_stage(checkpoint_dir, resume, name, key, compute, cache=None):
+    """
+    Run a pipeline stage, saving its output as a checkpoint and reusing a valid one on resume.
+
+    With a ``StageCache``, outputs already in memory are reused before
+    checkpoints.
+    """
+    if cache is not None:
+        return cache.get(
+            name, key, lambda: _run_stage(checkpoint_dir, resume, name, key, compute)
+        )
+    if checkpoint_dir is None:
+        return compute()
+
+    path = os.path.join(checkpoint_dir, f"{name}-{key}")
+    if resume:
+        values = load_stage(path)
+        if values is not None:
+            logger.info("Resuming %s stage from checkpoint %s", name, path)
+            return values
+
+    values = compute()
+    save_stage(path, values)
+    logger.info("Saved %s stage checkpoint to %s", name, path)
+    return values
+
+
+def _preprocess_key(
+    pophist_file,
+    reservoir_file,
+    popscen_file,
+    population_ensemble_file,
+    gwd_files,
+    scenario,
+    dotriangular,
+    baseyear,
+    pyear_start,
+    pyear_end,
+    pyear_step,
+) -> str:
+    """Key of the preprocess stage, from its input files and settings."""
+    return _stage_key(
+        [
+            _file_signature(f)
+            for f in (
+                pophist_file,
+                reservoir_file,
+                popscen_file,
+                population_ensemble_file,
+            )
+        ],
+        [_file_signature(f) for f in gwd_files],
+        scenario,
+        dotriangular,
+        baseyear,
+        pyear_start,
+        pyear_end,
+        pyear_step,
+    )
+
+
+def _fit_key(preprocess_key, pipeline_id, bootstrap=None, bootstrap_seed=0) -> str:
+    """Key of the fit stage of the ``preprocess_key`` stage's output."""
+    fit_key = _stage_key(preprocess_key, pipeline_id)
+    if bootstrap is not None:
+        fit_key = _stage_key(fit_key, bootstrap, bootstrap_seed)
+    return fit_key
+
 
 def project_landwaterstorage(
     pophist_file,
@@ -38,18 +291,1034 @@ def project_landwaterstorage(
     chunksize,
     output_gslr_file,
     output_lslr_file,
+    dedupe_locations=False,
+    location_tolerance=0.0,
+    max_memory=None,
+    overlap_writes=False,
+    chunk_layout=None,
+    checkpoint_dir=None,
+    resume=False,
+    skip_if_current=False,
+    kernels="auto",
+    processes=None,
+    scheduler_address=None,
+    batch_size=None,
+    quantile_tolerance=None,
+    quantiles=DEFAULT_QUANTILES,
+    population_ensemble_file=None,
+    compression_threads=None,
+    cache=None,
+    bootstrap=None,
+    bootstrap_seed=0,
+    fit_workers=None,
+    compute_dtype="float64",
+    gwd_fp_variable="GROUND",
+    dam_fp_variable="GROUND",
+    profile_dir=None,
 ) -> None:
-    """Project landwaterstorage"""
-    pophist = read_population_history(pophist_file)
-    dams = read_reservoir_impoundment(reservoir_file)
-    gwd = read_groundwater_depletion(gwd_files)
-    popscen = read_population_scenarios(popscen_file)
+    """Project landwaterstorage
+
+    If ``max_memory`` (bytes) is given, it overrides ``chunksize`` with
+    sample and location chunk sizes derived from the problem shape.
+
+    If ``checkpoint_dir`` is given, the preprocess, fit and project stage
+    outputs are saved there, keyed by the run parameters. With ``resume``,
+    stages with a valid checkpoint are loaded instead of recomputed.
+
+    Both output files carry a provenance hash of the input file contents, the
+    run parameters and the package version. With ``skip_if_current``, the run
+    returns early if both outputs already exist with a matching hash.
+
+    ``kernels`` selects the backend of the projection and localization
+    kernels, see ``get_kernels``. With ``processes``, localization runs in a
+    pool of that many worker processes sharing memory. With
+    ``scheduler_address``, it runs on that dask distributed scheduler instead.
+
+    The location and fingerprint files are read in a background thread while
+    the projection runs, and the global SLR file is written in the background
+    while the local samples are computed.
+
+    With ``batch_size``, samples are projected, written and localized that
+    many at a time, so memory doesn't grow with ``nsamps``. The outputs are
+    the same, but the project stage is not checkpointed.
+
+    With ``quantile_tolerance``, samples are projected in batches of
+    ``batch_size`` until the standard error of ``quantiles`` is within it, up
+    to ``nsamps`` samples, see ``project_adaptive``. Both outputs record how
+    that went in their global attributes.
+
+    With ``population_ensemble_file`` instead of ``popscen_file``, each sample
+    draws a population trajectory from that ensemble, see
+    ``read_population_ensemble``.
+
+    With ``compression_threads``, output chunks are compressed by that many
+    threads and written pre-compressed, see ``write_gslr``.
+
+    With a ``StageCache``, parsed inputs, the preprocess and fit stages and
+    fingerprint coefficients are shared with other runs using the same cache,
+    see ``batch_landwaterstorage``.
+
+    With ``bootstrap``, the fit also resamples the historical points that
+    many times, seeded by ``bootstrap_seed``, and each sample draws its GWD
+    slope and dam sigmoid from the resulting ensemble, see ``bootstrap_fit``.
+    ``fit_workers`` runs the sigmoid fits in a pool of that many processes,
+    by default one per CPU.
+
+    ``compute_dtype`` is the precision global and local samples are computed
+    and held in, one of ``COMPUTE_DTYPES``. Both outputs store float32, so
+    "float32" halves the memory of the largest arrays at little cost in
+    accuracy.
+
+    Groundwater depletion is localized with the ``gwd_fp_variable``
+    fingerprint in ``fp_file``, and reservoir impoundment and dam correction
+    with ``dam_fp_variable``. If they differ, the two components are
+    projected separately and localized together in one pass.
+
+    ``location_file`` and ``output_lslr_file`` may also be sequences of the
+    same length, to localize the same global samples at several sets of
+    sites. Samples are projected and fingerprints read once, and each
+    location set is localized and written to its own file concurrently.
+
+    With ``profile_dir``, each stage is profiled and the dask tasks of
+    localization traced there, see ``RunProfiler``. Location sets are then
+    localized one after another, so their traces don't mix.
+    """
+    params = {k: v for k, v in locals().items() if k not in _PROVENANCE_EXCLUDE}
+    location_files, output_lslr_files = _location_sets(location_file, output_lslr_file)
+    if quantile_tolerance is not None:
+        # Where convergence is checked, and so the sample count, depends on it.
+        params["batch_size"] = batch_size
+    if resume and checkpoint_dir is None:
+        raise ValueError("resume requires a checkpoint_dir")
+    if processes is not None and scheduler_address is not None:
+        raise ValueError("use either processes or scheduler_address, not both")
+    if batch_size is not None and processes is not None:
+        raise ValueError("batch_size cannot be combined with processes")
+
+    provenance = provenance_hash(
+        [
+            pophist_file,
+            reservoir_file,
+            popscen_file,
+            population_ensemble_file,
+            *gwd_files,
+            fp_file,
+            *location_files,
+        ],
+        params,
+    )
+    if skip_if_current and all(
+        read_provenance(fl) == provenance
+        for fl in (output_gslr_file, *output_lslr_files)
+    ):
+        logger.info(
+            "Outputs are up to date with provenance %s, skipping run", provenance
+        )
+        return
 
     # Why?
     # Should at least log when this happens.
     if len(gwd_files) != 3:
         dotriangular = 0
+    if bootstrap is not None and dotriangular:
+        raise ValueError(
+            "bootstrap replaces the triangular GWD distribution, it cannot be "
+            "combined with dotriangular"
+        )
+
+    fp_variables = _fp_variables(gwd_fp_variable, dam_fp_variable)
+    components = len(fp_variables) > 1
+    profiler = RunProfiler(profile_dir)
+
+    def _preprocess():
+        return _read_and_preprocess(
+            pophist_file,
+            reservoir_file,
+            popscen_file,
+            gwd_files,
+            scenario,
+            dotriangular,
+            baseyear,
+            pyear_start,
+            pyear_end,
+            pyear_step,
+            population_ensemble_file,
+            cache=cache,
+        )
+
+    preprocess_key = _preprocess_key(
+        pophist_file,
+        reservoir_file,
+        popscen_file,
+        population_ensemble_file,
+        gwd_files,
+        scenario,
+        dotriangular,
+        baseyear,
+        pyear_start,
+        pyear_end,
+        pyear_step,
+    )
+
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="io") as io_pool:
+        # Localization inputs don't depend on the projection, so read them
+        # while it runs.
+        localizations = io_pool.submit(
+            _read_localizations,
+            fp_file,
+            location_files,
+            dedupe_locations,
+            location_tolerance,
+            fp_variables,
+            cache=cache,
+        )
+
+        with profiler.stage("preprocess"):
+            stage = _run_stage(
+                checkpoint_dir,
+                resume,
+                "preprocess",
+                preprocess_key,
+                _preprocess,
+                cache=cache,
+            )
+        out_data, out_conf = stage["data"], stage["config"]
+
+        fit_key = _fit_key(preprocess_key, pipeline_id, bootstrap, bootstrap_seed)
+        with profiler.stage("fit"):
+            out_fit = _run_stage(
+                checkpoint_dir,
+                resume,
+                "fit",
+                fit_key,
+                lambda: _fit(
+                    out_data,
+                    out_conf,
+                    pipeline_id,
+                    bootstrap,
+                    bootstrap_seed,
+                    fit_workers,
+                ),
+                cache=cache,
+            )
+
+        if batch_size is not None and quantile_tolerance is None:
+            with profiler.stage("project_batches"):
+                _project_batches(
+                    out_fit,
+                    out_conf,
+                    localizations.result(),
+                    io_pool,
+                    provenance=provenance,
+                    nsamps=nsamps,
+                    seed=seed,
+                    pipeline_id=pipeline_id,
+                    baseyear=baseyear,
+                    scenario=scenario,
+                    dcyear_start=dcyear_start,
+                    dcyear_end=dcyear_end,
+                    dcrate_lo=dcrate_lo,
+                    dcrate_hi=dcrate_hi,
+                    output_gslr_file=output_gslr_file,
+                    output_lslr_files=output_lslr_files,
+                    chunksize=chunksize,
+                    max_memory=max_memory,
+                    overlap_writes=overlap_writes,
+                    chunk_layout=chunk_layout,
+                    kernels=kernels,
+                    scheduler_address=scheduler_address,
+                    batch_size=batch_size,
+                    compression_threads=compression_threads,
+                    compute_dtype=compute_dtype,
+                    components=components,
+                    profiler=profiler,
+                )
+            return
+
+        project_key = _stage_key(
+            fit_key, nsamps, seed, dcyear_start, dcyear_end, dcrate_lo, dcrate_hi
+        )
+        if quantile_tolerance is not None:
+            project_key = _stage_key(
+                project_key, quantile_tolerance, quantiles, batch_size
+            )
+        if compute_dtype != "float64":
+            project_key = _stage_key(project_key, compute_dtype)
+        if components:
+            project_key = _stage_key(project_key, "components")
+        with profiler.stage("project"):
+            stage = _run_stage(
+                checkpoint_dir,
+                resume,
+                "project",
+                project_key,
+                lambda: _project(
+                    out_fit,
+                    out_conf,
+                    nsamps,
+                    seed,
+                    dcyear_start,
+                    dcyear_end,
+                    dcrate_lo,
+                    dcrate_hi,
+                    kernels=kernels,
+                    quantile_tolerance=quantile_tolerance,
+                    quantiles=quantiles,
+                    batch_size=batch_size,
+                    compute_dtype=compute_dtype,
+                    components=components,
+                ),
+            )
+        lwssamps = stage["lwssamps"]
+        gslr = _total(lwssamps)
+        attrs = stage.get("attrs")
+        nsamps = len(gslr)
+
+        # The global file is written while the local samples are computed.
+        gslr_written = io_pool.submit(
+            write_gslr,
+            output_gslr_file,
+            targyears=out_conf["targyears"],
+            n_samps=nsamps,
+            pipeline_id=pipeline_id,
+            baseyear=baseyear,
+            scenario=scenario,
+            lwssamps=gslr,
+            chunk_layout=chunk_layout,
+            provenance=provenance,
+            attrs=attrs,
+            compression_threads=compression_threads,
+        )
+
+        with profiler.stage("localize"):
+            _localize_sets(
+                lwssamps,
+                localizations.result(),
+                output_lslr_files,
+                provenance=provenance,
+                attrs=attrs,
+                targyears=out_conf["targyears"],
+                nsamps=nsamps,
+                baseyear=baseyear,
+                scenario=scenario,
+                chunksize=chunksize,
+                max_memory=max_memory,
+                overlap_writes=overlap_writes,
+                chunk_layout=chunk_layout,
+                kernels=kernels,
+                processes=processes,
+                scheduler_address=scheduler_address,
+                compression_threads=compression_threads,
+                compute_dtype=compute_dtype,
+                profiler=profiler,
+            )
+        gslr_written.result()
+
+
+def sweep_landwaterstorage(
+    pophist_file,
+    reservoir_file,
+    popscen_file,
+    gwd_files,
+    scenario,
+    dotriangular,
+    baseyear,
+    pyear_start,
+    pyear_end,
+    pyear_step,
+    nsamps,
+    seed,
+    pipeline_id,
+    dcyear_start,
+    dcyear_end,
+    dcrate_lo,
+    dcrate_hi,
+    sweep,
+    output_gslr_file,
+    chunk_layout=None,
+    kernels="auto",
+    population_ensemble_file=None,
+    compression_threads=None,
+    compute_dtype="float64",
+) -> None:
+    """
+    Project global samples over a grid of uncertainty settings.
+
+    ``sweep`` maps names in ``SWEEP_PARAMETERS`` to the values to try. Every
+    combination is projected from one fit with the same random draws and
+    written to a single global SLR file along a ``parameters`` dimension.
+    Parameters that are not swept keep their given or configured value.
+    """
+    params = {k: v for k, v in locals().items() if k not in _PROVENANCE_EXCLUDE}
+    provenance = provenance_hash(
+        [
+            pophist_file,
+            reservoir_file,
+            popscen_file,
+            population_ensemble_file,
+            *gwd_files,
+        ],
+        params,
+    )
+
+    # Same as in project_landwaterstorage.
+    if len(gwd_files) != 3:
+        dotriangular = 0
+
+    stage = _read_and_preprocess(
+        pophist_file,
+        reservoir_file,
+        popscen_file,
+        gwd_files,
+        scenario,
+        dotriangular,
+        baseyear,
+        pyear_start,
+        pyear_end,
+        pyear_step,
+        population_ensemble_file,
+    )
+    out_data, out_conf = stage["data"], stage["config"]
+    out_fit = fit(out_data, out_conf, pipeline_id)
+
+    defaults = {
+        "dcyear_start": dcyear_start,
+        "dcyear_end": dcyear_end,
+        "dcrate_lo": dcrate_lo,
+        "dcrate_hi": dcrate_hi,
+        "dgwd_dt_dpop_pcterr": out_conf["dgwd_dt_dpop_pcterr"],
+        "dam_pcterr": out_conf["dam_pcterr"],
+    }
+    settings = parameter_grid(defaults, sweep)
+    logger.info(
+        "Projecting %d parameter settings of %d samples",
+        len(settings["dcyear_start"]),
+        nsamps,
+    )
+    gslr = project_sweep(
+        out_fit, out_conf, nsamps, seed, settings, kernels, compute_dtype
+    )
+    write_gslr(
+        output_gslr_file,
+        targyears=out_conf["targyears"],
+        n_samps=nsamps,
+        pipeline_id=pipeline_id,
+        baseyear=baseyear,
+        scenario=scenario,
+        lwssamps=gslr,
+        chunk_layout=chunk_layout,
+        provenance=provenance,
+        parameters=settings,
+        compression_threads=compression_threads,
+    )
+
+
+def batch_landwaterstorage(runs, workers=None) -> list[dict]:
+    """
+    Run ``project_landwaterstorage`` for each of many configurations.
+
+    ``runs`` are dicts of ``project_landwaterstorage`` arguments, optionally
+    with a "name" to report them by. Runs in one process share a
+    ``StageCache``, so inputs are parsed, fits made and fingerprint
+    coefficients interpolated once for all runs that need the same ones.
+
+    Without ``workers``, runs go one after another in this process. With
+    ``workers``, they are spread over a pool of that many worker processes
+    and run as workers free up. The stages runs share are then computed once
+    in this process, and each worker's cache starts out with them.
+
+    A failed run doesn't stop the others. Returns a report per run, in the
+    order of ``runs``, with its "status" ("ok" or "failed"), "error",
+    "seconds", the stages it "reused" from the cache, and the
+    "output_bytes" of its output files.
+    """
+    _check_batch(runs)
+    reports = [None] * len(runs)
+    if workers is None:
+        cache = StageCache()
+        for index, run in enumerate(runs):
+            reports[index] = _batch_run(index, run, cache)
+            _log_batch_report(reports[index], len(runs))
+        return reports
+
+    cache = StageCache()
+    for index, run in enumerate(runs):
+        try:
+            _prepare_shared_stages(run, cache)
+        except Exception as e:
+            # The run fails again in its worker, and is reported there.
+            logger.debug("Could not prepare batch run %d: %s", index, e)
+    shared = cache.export(_SHARED_STAGES)
+    logger.info("Prepared %d shared stage outputs for the workers", len(shared))
+
+    # Spawn rather than fork, the parent may be running dask threads.
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_batch_worker,
+        initargs=(logging.getLogger().getEffectiveLevel(), shared),
+    ) as pool:
+        futures = [
+            pool.submit(_batch_run, index, run) for index, run in enumerate(runs)
+        ]
+        for future in as_completed(futures):
+            report = future.result()
+            reports[report["index"]] = report
+            _log_batch_report(report, len(runs))
+    return reports
+
+
+def _check_batch(runs) -> None:
+    """Check batch runs name only valid arguments, all required ones, and distinct outputs."""
+    params = inspect.signature(project_landwaterstorage).parameters
+    required = {k for k, p in params.items() if p.default is inspect.Parameter.empty}
+    allowed = (set(params) - {"cache"}) | {"name"}
+    outputs = set()
+    for index, run in enumerate(runs):
+        if unknown := set(run) - allowed:
+            raise ValueError(f"run {index} has unknown options {sorted(unknown)}")
+        if missing := required - set(run):
+            raise ValueError(f"run {index} is missing options {sorted(missing)}")
+        for fl in (run["output_gslr_file"], *_as_list(run["output_lslr_file"])):
+            path = os.path.abspath(fl)
+            if path in outputs:
+                raise ValueError(f"run {index} writes {fl}, like an earlier run")
+            outputs.add(path)
+
+
+# Stages batch runs share, prepared once for all worker processes. Parsed
+# inputs and fingerprints are only needed to compute these.
+_SHARED_STAGES = ("preprocess", "fit", "localization")
+
+
+def _prepare_shared_stages(run, cache) -> None:
+    """Compute the ``_SHARED_STAGES`` of a batch run into ``cache``, as the run would."""
+    options = {
+        k: p.default
+        for k, p in inspect.signature(project_landwaterstorage).parameters.items()
+        if p.default is not inspect.Parameter.empty
+    }
+    options.update(run)
+    preprocess_options = {
+        k: options[k]
+        for k in (
+            "pophist_file",
+            "reservoir_file",
+            "popscen_file",
+            "gwd_files",
+            "scenario",
+            "dotriangular",
+            "baseyear",
+            "pyear_start",
+            "pyear_end",
+            "pyear_step",
+            "population_ensemble_file",
+        )
+    }
+    # Same as in project_landwaterstorage.
+    if len(options["gwd_files"]) != 3:
+        preprocess_options["dotriangular"] = 0
+    if options["bootstrap"] is not None and preprocess_options["dotriangular"]:
+        # The run is rejected before fitting.
+        return
+    preprocess_key = _preprocess_key(**preprocess_options)
+    stage = cache.get(
+        "preprocess",
+        preprocess_key,
+        lambda: _read_and_preprocess(**preprocess_options, cache=cache),
+    )
+    cache.get(
+        "fit",
+        _fit_key(
+            preprocess_key,
+            options["pipeline_id"],
+            options["bootstrap"],
+            options["bootstrap_seed"],
+        ),
+        lambda: _fit(
+            stage["data"],
+            stage["config"],
+            options["pipeline_id"],
+            options["bootstrap"],
+            options["bootstrap_seed"],
+            options["fit_workers"],
+        ),
+    )
+    _read_localizations(
+        options["fp_file"],
+        _as_list(options["location_file"]),
+        options["dedupe_locations"],
+        options["location_tolerance"],
+        _fp_variables(options["gwd_fp_variable"], options["dam_fp_variable"]),
+        cache=cache,
+    )
+
+
+def _init_batch_worker(log_level, shared=None) -> None:
+    """Worker initializer: log like the parent process and seed the worker's cache with ``shared``."""
+    logging.basicConfig(level=log_level)
+    if shared:
+        _worker_cache.update(shared)
+
+
+# Stage outputs shared by the batch runs of a worker process.
+_worker_cache = StageCache()
+
+
+def _batch_run(index, run, cache=None) -> dict:
+    """Run one batch entry sharing ``cache``, by default the worker's, reporting how it went."""
+    if cache is None:
+        cache = _worker_cache
+    kwargs = {k: v for k, v in run.items() if k != "name"}
+    outputs = (run["output_gslr_file"], *_as_list(run["output_lslr_file"]))
+    run_cache = cache.for_run()
+    report = {"index": index, "name": run.get("name"), "pid": os.getpid()}
+    start = time.perf_counter()
+    try:
+        project_landwaterstorage(**kwargs, cache=run_cache)
+        report.update(status="ok", error=None)
+    except Exception as e:
+        logger.exception("Batch run %d failed", index)
+        report.update(status="failed", error=f"{type(e).__name__}: {e}")
+    report["seconds"] = time.perf_counter() - start
+    report["reused"] = dict(run_cache.hits)
+    report["output_bytes"] = {
+        fl: os.path.getsize(fl) for fl in outputs if os.path.exists(fl)
+    }
+    return report
+
+
+def _log_batch_report(report, nruns) -> None:
+    """Log how a batch run went."""
+    label = report["name"] or report["index"]
+    if report["status"] == "ok":
+        logger.info(
+            "Batch run %s (%d of %d) finished in %.2fs, reusing %s",
+            label,
+            report["index"] + 1,
+            nruns,
+            report["seconds"],
+            ", ".join(report["reused"]) or "nothing",
+        )
+    else:
+        logger.error(
+            "Batch run %s (%d of %d) failed: %s",
+            label,
+            report["index"] + 1,
+            nruns,
+            report["error"],
+        )
+
+
+def serve_landwaterstorage(
+    spool_dir=None,
+    socket_path=None,
+    workers=1,
+    cache_size=32,
+    poll_interval=1.0,
+    prepare=None,
+    stop=None,
+) -> None:
+    """
+    Run ``project_landwaterstorage`` jobs as they arrive, keeping stages warm between them.
+
+    Jobs are dicts of ``project_landwaterstorage`` arguments, optionally with
+    a "name", like ``batch_landwaterstorage`` runs. They all share one
+    ``StageCache`` of at most ``cache_size`` stage outputs, so parsed inputs,
+    fits and fingerprint coefficients are reused until they are the least
+    recently used. At most ``workers`` jobs run at a time, in threads.
+
+    With ``spool_dir``, JSON job files dropped into it are picked up every
+    ``poll_interval`` seconds, see ``read_job``. Write them under a name
+    starting with "." and rename them into place, so they are only picked up
+    complete. A job "name.json" is claimed by renaming it to
+    "name.json.running", its report is written to "name.report.json", and it
+    is then renamed to "name.json.done" or "name.json.failed". Several
+    daemons can share a spool directory. Each holds a lock on the jobs it
+    runs, so jobs left running by a daemon that died are queued again when a
+    daemon starts.
+
+    With ``socket_path``, clients connect to a Unix socket there and send a
+    job as one line of JSON, then read its report back as one line of JSON
+    once it has run.
+
+    ``prepare`` turns a job into ``project_landwaterstorage`` arguments, like
+    the command line filling in its defaults. Jobs it rejects fail without
+    running. Serves until ``stop``, a ``threading.Event``, is set.
+    """
+    if spool_dir is None and socket_path is None:
+        raise ValueError("need a spool_dir, a socket_path or both to take jobs from")
+    if stop is None:
+        stop = threading.Event()
+    cache = StageCache(max_entries=cache_size)
+    counter = itertools.count()
+    slots = threading.BoundedSemaphore(workers)
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+
+    def run_job(load):
+        # Runs in a worker slot taken by whoever queued the job.
+        index = next(counter)
+        job = None
+        try:
+            job = load()
+            run = dict(job) if prepare is None else prepare(job)
+            _check_batch([run])
+        except Exception as e:
+            report = _failed_report(
+                index, job.get("name") if isinstance(job, dict) else None, e
+            )
+        else:
+            report = _batch_run(index, run, cache)
+        finally:
+            slots.release()
+        _log_job_report(report, len(cache))
+        return report
+
+    if spool_dir is not None:
+        _recover_spool(spool_dir)
+    socket_thread = None
+    if socket_path is not None:
+        socket_thread = threading.Thread(
+            target=_serve_socket,
+            args=(
+                _listen(socket_path),
+                socket_path,
+                pool,
+                slots,
+                run_job,
+                poll_interval,
+                stop,
+            ),
+            name="socket",
+        )
+        socket_thread.start()
+    logger.info(
+        "Serving jobs from %s with %d workers",
+        " and ".join(str(src) for src in (spool_dir, socket_path) if src is not None),
+        workers,
+    )
+    try:
+        while not stop.is_set():
+            if spool_dir is not None:
+                _poll_spool(spool_dir, pool, slots, run_job)
+            stop.wait(poll_interval)
+    finally:
+        stop.set()
+        if socket_thread is not None:
+            socket_thread.join()
+        pool.shutdown(wait=True)
+        logger.info("Stopped serving jobs")
+
+
+def _failed_report(index, name, error) -> dict:
+    """Report of a job that failed before it could run."""
+    return {
+        "index": index,
+        "name": name,
+        "pid": os.getpid(),
+        "status": "failed",
+        "error": f"{type(error).__name__}: {error}",
+        "seconds": 0.0,
+        "reused": {},
+        "output_bytes": {},
+    }
+
+
+def _lock_job(fl):
+    """
+    Open and lock the job file ``fl``, or return None if it is gone or another daemon holds it.
+
+    The lock lasts until the returned file is closed, or its daemon dies.
+    """
+    import fcntl
+
+    try:
+        lock = open(fl, "rb")
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+def _recover_spool(spool_dir) -> None:
+    """Queue again the jobs left running by daemons that died, whose locks are gone."""
+    for entry in sorted(os.listdir(spool_dir)):
+        if entry.startswith(".") or not entry.endswith(".json.running"):
+            continue
+        fl = os.path.join(spool_dir, entry)
+        lock = _lock_job(fl)
+        if lock is None:
+            continue
+        with lock:
+            os.rename(fl, fl[: -len(".running")])
+        logger.warning("Queued job %s again, its daemon stopped running it", entry)
+
+
+def _poll_spool(spool_dir, pool, slots, run_job) -> None:
+    """Claim and start the spooled jobs there are free workers for, oldest name first."""
+    for entry in sorted(os.listdir(spool_dir)):
+        if entry.startswith(".") or not entry.endswith(".json"):
+            continue
+        if entry.endswith(".report.json"):
+            continue
+        if not slots.acquire(blocking=False):
+            return
+        fl = os.path.join(spool_dir, entry)
+        # The lock moves with the file, so it is never running unlocked.
+        lock = _lock_job(fl)
+        if lock is None:
+            slots.release()
+            continue
+        try:
+            # Renaming is atomic, so only one daemon claims each job.
+            os.rename(fl, fl + ".running")
+        except FileNotFoundError:
+            lock.close()
+            slots.release()
+            continue
+        try:
+            pool.submit(_run_spooled, fl, lock, run_job)
+        except RuntimeError:
+            # Shutting down, leave the job for the next daemon.
+            os.rename(fl + ".running", fl)
+            lock.close()
+            slots.release()
+            return
+
+
+def _run_spooled(fl, lock, run_job) -> None:
+    """Run a claimed spool job, writing its report next to it and then releasing its ``lock``."""
+    with lock:
+        report = run_job(lambda: read_job(fl + ".running"))
+        stem = fl[: -len(".json")]
+        tmpfl = os.path.join(
+            os.path.dirname(fl), f".{os.path.basename(stem)}.report.json"
+        )
+        with open(tmpfl, "w") as f:
+            json.dump(report, f, indent=2)
+        os.replace(tmpfl, stem + ".report.json")
+        os.replace(
+            fl + ".running", f"{fl}.{'done' if report['status'] == 'ok' else 'failed'}"
+        )
 
+
+def _listen(socket_path):
+    """Listen on a Unix socket, replacing a stale one left behind at socket_path."""
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+            except ConnectionRefusedError:
+                os.unlink(socket_path)
+            else:
+                raise ValueError(f"another daemon is serving at {socket_path}")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    return server
+
+
+def _serve_socket(
+    server, socket_path, pool, slots, run_job, poll_interval, stop
+) -> None:
+    """Accept connections until stop is set, each sending a job and getting its report back."""
+    server.settimeout(poll_interval)
+    with server:
+        try:
+            while not stop.is_set():
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
+                threading.Thread(
+                    target=_handle_connection,
+                    args=(conn, pool, slots, run_job),
+                    name="connection",
+                    daemon=True,
+                ).start()
+        finally:
+            os.unlink(socket_path)
+
+
+def _handle_connection(conn, pool, slots, run_job) -> None:
+    """Read a job from a connection, wait for a free worker to run it and send its report."""
+    with conn, conn.makefile("rwb") as stream:
+        line = stream.readline()
+
+        def load():
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError("a job must be a table of run options")
+            return job
+
+        slots.acquire()
+        try:
+            future = pool.submit(run_job, load)
+        except RuntimeError as e:
+            # The daemon is shutting down.
+            slots.release()
+            report = _failed_report(None, None, e)
+        else:
+            report = future.result()
+        stream.write(json.dumps(report).encode() + b"\n")
+        stream.flush()
+
+
+def _log_job_report(report, cached) -> None:
+    """Log how a served job went."""
+    label = report["name"] or report["index"]
+    if report["status"] == "ok":
+        logger.info(
+            "Job %s finished in %.2fs, reusing %s, %d stage outputs cached",
+            label,
+            report["seconds"],
+            ", ".join(report["reused"]) or "nothing",
+            cached,
+        )
+    else:
+        logger.error("Job %s failed: %s", label, report["error"])
+
+
+def estimate_landwaterstorage(
+    location_file,
+    baseyear,
+    pyear_start,
+    pyear_end,
+    pyear_step,
+    nsamps,
+    chunksize,
+    dedupe_locations=False,
+    location_tolerance=0.0,
+    max_memory=None,
+    chunk_layout=None,
+    processes=None,
+    batch_size=None,
+    compute_dtype="float64",
+    gwd_fp_variable="GROUND",
+    dam_fp_variable="GROUND",
+    kernels="auto",
+    compression_threads=None,
+) -> dict:
+    """
+    Predict the resources a run will use, reading only the location file.
+
+    Returns a dict with the problem shape, the localization chunks, the peak
+    memory, the output file sizes in bytes, both before compression, an
+    upper bound, and typically compressed as "gslr_compressed_bytes" and
+    "lslr_compressed_bytes", and the runtime in seconds of each stage. With ``batch_size``, chunks and peak memory are
+    those of one batch of samples. Global samples are split into a component
+    per fingerprint if ``gwd_fp_variable`` and ``dam_fp_variable`` differ.
+    """
+    targyears = target_years(baseyear, pyear_start, pyear_end, pyear_step)
+    sites = read_locations(location_file)
+    if dedupe_locations:
+        sites = deduplicate_locations(sites, tolerance=location_tolerance).locations
+    nyears = len(targyears)
+    nlocations = len(sites.id)
+    resident = nsamps if batch_size is None else min(batch_size, nsamps)
+    itemsize = np.dtype(compute_dtype).itemsize
+    ncomponents = len(_fp_variables(gwd_fp_variable, dam_fp_variable))
+    if max_memory is not None:
+        chunksize = plan_chunks(
+            resident, nyears, nlocations, max_memory, processes, itemsize, ncomponents
+        )
+
+    out = {
+        "nsamps": nsamps,
+        "nyears": nyears,
+        "nlocations": nlocations,
+        "chunksize": chunksize,
+        "peak_memory": estimate_memory(
+            resident, nyears, nlocations, chunksize, processes, itemsize, ncomponents
+        ),
+        "gslr_bytes": estimate_output_bytes(nsamps, nyears, 1, chunk_layout),
+        "lslr_bytes": estimate_output_bytes(nsamps, nyears, nlocations, chunk_layout),
+        "gslr_compressed_bytes": estimate_output_bytes(
+            nsamps, nyears, 1, chunk_layout, compressed=True
+        ),
+        "lslr_compressed_bytes": estimate_output_bytes(
+            nsamps, nyears, nlocations, chunk_layout, compressed=True
+        ),
+        "runtime": estimate_runtime(
+            nsamps,
+            nyears,
+            nlocations,
+            processes,
+            kernels,
+            compute_dtype,
+            compression_threads,
+        ),
+    }
+    return out
+
+
+def _fit(data, config, pipeline_id, bootstrap, bootstrap_seed, fit_workers) -> dict:
+    """Fit the submodel, with a bootstrap ensemble if ``bootstrap`` is given."""
+    out_fit = fit(data, config, pipeline_id, bootstrap, bootstrap_seed, fit_workers)
+    if bootstrap is not None:
+        nmembers = len(out_fit["dams_popt_ensemble"])
+        logger.info(
+            "Fit a bootstrap ensemble of %d members, %d sigmoid fits did not converge",
+            nmembers,
+            bootstrap - nmembers,
+        )
+    return out_fit
+
+
+def _read_and_preprocess(
+    pophist_file,
+    reservoir_file,
+    popscen_file,
+    gwd_files,
+    scenario,
+    dotriangular,
+    baseyear,
+    pyear_start,
+    pyear_end,
+    pyear_step,
+    population_ensemble_file=None,
+    cache=None,
+) -> dict:
+    """
+    Read the CSV inputs and preprocess them into the "data" and "config" for fitting.
+
+    Exactly one of ``popscen_file`` and ``population_ensemble_file`` is used.
+    With a ``StageCache``, parsed inputs are shared between runs.
+    """
+    if (popscen_file is None) == (population_ensemble_file is None):
+        raise ValueError(
+            "give exactly one of popscen_file and population_ensemble_file"
+        )
+
+    def _read():
+        if population_ensemble_file is None:
+            popscen = read_population_scenarios(popscen_file)
+        else:
+            popscen = read_population_ensemble(population_ensemble_file)
+        return (
+            read_population_history(pophist_file),
+            read_reservoir_impoundment(reservoir_file),
+            read_groundwater_depletion(gwd_files),
+            popscen,
+        )
+
+    inputs_key = _stage_key(
+        [
+            _file_signature(f)
+            for f in (
+                pophist_file,
+                reservoir_file,
+                popscen_file,
+                population_ensemble_file,
+                *gwd_files,
+            )
+        ]
+    )
+    pophist, dams, gwd, popscen = _cached(cache, "inputs", inputs_key, _read)
     out_data, out_conf = preprocess(
         pophist,
         dams,
@@ -61,11 +1330,348 @@ def project_landwaterstorage(
         pyear_start,
         pyear_end,
         pyear_step,
+        population_ensemble=population_ensemble_file is not None,
     )
+    return {"data": out_data, "config": out_conf}
+
+
+def _fp_variables(gwd_fp_variable, dam_fp_variable) -> tuple[str, ...]:
+    """
+    Fingerprint variables to localize with, one per component if they differ.
+    """
+    if gwd_fp_variable == dam_fp_variable:
+        return (gwd_fp_variable,)
+    return (gwd_fp_variable, dam_fp_variable)
+
+
+def _total(lwssamps):
+    """Global samples summed over their components, if split into them."""
+    return lwssamps if lwssamps.ndim == 2 else lwssamps.sum(axis=0)
+
+
+def _as_list(paths) -> list:
+    """A path, or a sequence of them, as a list."""
+    if isinstance(paths, (str, os.PathLike)):
+        return [paths]
+    return list(paths)
 
-    out_fit = fit(out_data, out_conf, pipeline_id)
 
-    gslr = project(
+def _location_sets(location_file, output_lslr_file) -> tuple[list, list]:
+    """
+    Location files and the local SLR files to write for each, as lists.
+
+    Either may be a path or a sequence of paths, but they must pair up.
+    """
+    location_files = _as_list(location_file)
+    output_lslr_files = _as_list(output_lslr_file)
+    if not location_files:
+        raise ValueError("need at least one location file")
+    if len(location_files) != len(output_lslr_files):
+        raise ValueError(
+            f"got {len(location_files)} location files but "
+            f"{len(output_lslr_files)} local SLR output files"
+        )
+    return location_files, output_lslr_files
+
+
+def _read_localizations(
+    fp_file,
+    location_files,
+    dedupe_locations,
+    location_tolerance,
+    fp_variables=("GROUND",),
+    cache=None,
+) -> list[dict]:
+    """
+    ``_read_localization`` for each of ``location_files``, reading fingerprints once.
+    """
+    if cache is None:
+        cache = StageCache()
+    return [
+        _read_localization(
+            fp_file,
+            location_file,
+            dedupe_locations,
+            location_tolerance,
+            fp_variables,
+            cache=cache,
+        )
+        for location_file in location_files
+    ]
+
+
+def _read_localization(
+    fp_file,
+    location_file,
+    dedupe_locations,
+    location_tolerance,
+    fp_variables=("GROUND",),
+    cache=None,
+) -> dict:
+    """
+    Read the sites to localize to and interpolate fingerprint coefficients at them.
+
+    The coefficients of several ``fp_variables`` come from one set of
+    interpolation weights, with one row per variable.
+
+    With a ``StageCache``, fingerprints and their coefficients at the sites
+    are shared between runs.
+    """
+
+    def _read():
+        sites = read_locations(location_file)
+        location_map = None
+        if dedupe_locations:
+            location_map = deduplicate_locations(sites, tolerance=location_tolerance)
+            sites = location_map.locations
+        fingerprints = _cached(
+            cache,
+            "fingerprints",
+            _stage_key(_file_signature(fp_file), fp_variables),
+            lambda: read_fingerprints(fp_file, fp_variables),
+        )
+        coefficients = fingerprints.interpolate_coefficients(sites)
+        return {
+            "sites": sites,
+            "location_map": location_map,
+            "coefficients": coefficients,
+        }
+
+    key = _stage_key(
+        _file_signature(fp_file),
+        fp_variables,
+        _file_signature(location_file),
+        dedupe_locations,
+        location_tolerance,
+    )
+    return _cached(cache, "localization", key, _read)
+
+
+def _localize(
+    gslr,
+    localization,
+    *,
+    targyears,
+    nsamps,
+    baseyear,
+    scenario,
+    output_lslr_file,
+    chunksize,
+    max_memory,
+    overlap_writes,
+    chunk_layout,
+    provenance=None,
+    kernels="auto",
+    processes=None,
+    scheduler_address=None,
+    attrs=None,
+    compression_threads=None,
+    compute_dtype="float64",
+    profiler=None,
+) -> None:
+    """
+    Localize global samples with the output of ``_read_localization`` and write them.
+
+    Global samples split into components are localized with one fingerprint
+    each, or summed if ``localization`` has only one.
+
+    With ``processes``, a pool of worker processes writes the local samples
+    into a temporary memory-mapped buffer next to ``output_lslr_file``.
+
+    With ``scheduler_address``, (samples, locations) tiles are computed on
+    that dask distributed scheduler, from global samples and coefficients
+    scattered to its workers once, and gathered back to this process, the
+    only one writing to ``output_lslr_file``.
+
+    With a ``RunProfiler``, the localization and writing are traced.
+    """
+    if profiler is None:
+        profiler = RunProfiler()
+    sites = localization["sites"]
+    coefficients = localization["coefficients"]
+    if coefficients.ndim == 1:
+        gslr = _total(gslr)
+    elif gslr.ndim == 2:
+        raise ValueError(
+            "fingerprints per component need global samples projected with "
+            "split_components"
+        )
+    chunksize = _localization_chunks(
+        nsamps,
+        len(targyears),
+        len(sites.id),
+        chunksize,
+        max_memory,
+        processes,
+        scheduler_address,
+        compute_dtype,
+        _ncomponents(coefficients),
+    )
+    client = None
+    with contextlib.ExitStack() as stack:
+        if scheduler_address is not None:
+            client = stack.enter_context(_connect(scheduler_address))
+        stack.enter_context(profiler.tasks(os.path.basename(output_lslr_file), client))
+        if processes is None:
+            lslr = postprocess(
+                gslr,
+                None,
+                sites,
+                chunksize,
+                kernels,
+                coefficients=coefficients,
+                dtype=compute_dtype,
+                client=client,
+            )
+        else:
+            scratch = stack.enter_context(
+                tempfile.TemporaryDirectory(
+                    prefix=".localize-",
+                    dir=os.path.dirname(os.path.abspath(output_lslr_file)),
+                )
+            )
+            lslr = postprocess_processes(
+                gslr,
+                None,
+                sites,
+                chunksize,
+                processes,
+                os.path.join(scratch, "lslr.npy"),
+                kernels,
+                coefficients=coefficients,
+                dtype=compute_dtype,
+            )
+        write_lslr(
+            output_lslr_file,
+            local_sl=lslr,
+            targyears=targyears,
+            n_samps=nsamps,
+            baseyear=baseyear,
+            scenario=scenario,
+            locations=sites,
+            location_map=localization["location_map"],
+            overlap=overlap_writes,
+            chunk_layout=chunk_layout,
+            provenance=provenance,
+            client=client,
+            attrs=attrs,
+            compression_threads=compression_threads,
+        )
+
+
+def _localize_sets(
+    gslr,
+    localizations,
+    output_lslr_files,
+    *,
+    processes=None,
+    profiler=None,
+    **kwargs,
+) -> None:
+    """
+    ``_localize`` the same global samples with each localization, writing each to its file.
+
+    Location sets are localized concurrently in threads sharing the dask
+    scheduler, except with ``processes``, whose pool already keeps the CPUs
+    busy for one set at a time, or while ``profiler`` traces them.
+    """
+    if (
+        len(localizations) == 1
+        or processes is not None
+        or (profiler is not None and profiler.enabled)
+    ):
+        for localization, output_lslr_file in zip(localizations, output_lslr_files):
+            _localize(
+                gslr,
+                localization,
+                output_lslr_file=output_lslr_file,
+                processes=processes,
+                profiler=profiler,
+                **kwargs,
+            )
+        return
+
+    with ThreadPoolExecutor(
+        max_workers=len(localizations), thread_name_prefix="localize"
+    ) as pool:
+        futures = [
+            pool.submit(
+                _localize,
+                gslr,
+                localization,
+                output_lslr_file=output_lslr_file,
+                **kwargs,
+            )
+            for localization, output_lslr_file in zip(localizations, output_lslr_files)
+        ]
+        for future in futures:
+            future.result()
+
+
+def _project(
+    out_fit,
+    out_conf,
+    nsamps,
+    seed,
+    dcyear_start,
+    dcyear_end,
+    dcrate_lo,
+    dcrate_hi,
+    kernels="auto",
+    quantile_tolerance=None,
+    quantiles=DEFAULT_QUANTILES,
+    batch_size=None,
+    compute_dtype="float64",
+    components=False,
+) -> dict:
+    """
+    Project global samples, adaptively if ``quantile_tolerance`` is given.
+
+    Otherwise, with ``batch_size``, projects that many samples at a time
+    into the output array, so projection temporaries don't grow with
+    ``nsamps``. Returns a dict with the samples as "lwssamps", split into ``COMPONENTS``
+    if ``components``, and "attrs" for the output files recording how
+    adaptive projection converged.
+    """
+    if quantile_tolerance is None and batch_size is not None:
+        lwssamps = None
+        for start, batch in project_batches(
+            out_fit,
+            out_conf,
+            nsamps,
+            seed,
+            dcyear_start,
+            dcyear_end,
+            dcrate_lo,
+            dcrate_hi,
+            batch_size,
+            kernels=kernels,
+            dtype=compute_dtype,
+            components=components,
+        ):
+            if lwssamps is None:
+                shape = batch.shape[:-2] + (nsamps, batch.shape[-1])
+                lwssamps = np.empty(shape, dtype=batch.dtype)
+            lwssamps[..., start : start + batch.shape[-2], :] = batch
+        return {"lwssamps": lwssamps, "attrs": {}}
+
+    if quantile_tolerance is None:
+        lwssamps = project(
+            out_fit,
+            out_conf,
+            nsamps,
+            seed,
+            dcyear_start,
+            dcyear_end,
+            dcrate_lo,
+            dcrate_hi,
+            kernels=kernels,
+            dtype=compute_dtype,
+            components=components,
+        )
+        return {"lwssamps": lwssamps, "attrs": {}}
+
+    lwssamps, error = project_adaptive(
         out_fit,
         out_conf,
         nsamps,
@@ -74,26 +1680,429 @@ def project_landwaterstorage(
         dcyear_end,
         dcrate_lo,
         dcrate_hi,
+        quantile_tolerance,
+        quantiles=quantiles,
+        batch_size=batch_size or ADAPTIVE_BATCH_SIZE,
+        kernels=kernels,
+        dtype=compute_dtype,
+        components=components,
     )
-    write_gslr(
-        output_gslr_file,
-        targyears=out_conf["targyears"],
-        n_samps=nsamps,
-        pipeline_id=pipeline_id,
-        baseyear=baseyear,
-        scenario=scenario,
-        lwssamps=gslr,
+    nsamps = lwssamps.shape[-2]
+    converged = bool(error <= quantile_tolerance)
+    if converged:
+        logger.info("Quantiles converged to %.3g mm with %d samples", error, nsamps)
+    else:
+        logger.warning(
+            "Quantiles only converged to %.3g mm, not %.3g mm, with all %d samples",
+            error,
+            quantile_tolerance,
+            nsamps,
+        )
+    attrs = {
+        "nsamps": nsamps,
+        "quantiles": list(quantiles),
+        "quantile_tolerance": quantile_tolerance,
+        "quantile_error": float(error),
+        "converged": int(converged),
+    }
+    return {"lwssamps": lwssamps, "attrs": attrs}
+
+
+def _localization_chunks(
+    nsamps,
+    nyears,
+    nlocations,
+    chunksize,
+    max_memory,
+    processes=None,
+    scheduler_address=None,
+    compute_dtype="float64",
+    ncomponents=1,
+):
+    """Localization chunk sizes for ``nsamps`` samples of ``ncomponents`` at a time."""
+    if max_memory is not None:
+        chunksize = plan_chunks(
+            nsamps,
+            nyears,
+            nlocations,
+            max_memory,
+            processes,
+            np.dtype(compute_dtype).itemsize,
+            ncomponents,
+        )
+        logger.info(
+            "Localizing in chunks of %d samples x %d locations to fit within %d bytes",
+            chunksize[0],
+            chunksize[1],
+            max_memory,
+        )
+    else:
+        logger.info("Localizing in chunks of %d locations", chunksize)
+        if scheduler_address is not None:
+            # Tile the global samples too, so each task only needs its own
+            # samples, in tiles of dask's configured array chunk size.
+            samp_chunks = da.core.normalize_chunks(
+                ("auto", -1, chunksize),
+                (nsamps, nyears, nlocations),
+                dtype=compute_dtype,
+            )[0]
+            chunksize = (samp_chunks[0], chunksize)
+            logger.info("Tiling samples in chunks of %d", chunksize[0])
+    return chunksize
+
+
+def _project_batches(
+    out_fit,
+    out_conf,
+    localizations,
+    io_pool,
+    *,
+    provenance,
+    nsamps,
+    seed,
+    pipeline_id,
+    baseyear,
+    scenario,
+    dcyear_start,
+    dcyear_end,
+    dcrate_lo,
+    dcrate_hi,
+    output_gslr_file,
+    output_lslr_files,
+    chunksize,
+    max_memory,
+    overlap_writes,
+    chunk_layout,
+    kernels,
+    scheduler_address,
+    batch_size,
+    compression_threads=None,
+    compute_dtype="float64",
+    components=False,
+    profiler=None,
+) -> None:
+    """
+    Project, write and localize ``batch_size`` samples at a time.
+
+    Each batch of global samples is appended to the global SLR file in
+    ``io_pool`` while it is localized with each of ``localizations``, in a
+    thread each, and appended to their local SLR files. With a
+    ``RunProfiler``, the batches are traced.
+    """
+    if profiler is None:
+        profiler = RunProfiler()
+    targyears = out_conf["targyears"]
+    chunksizes = [
+        _localization_chunks(
+            min(batch_size, nsamps),
+            len(targyears),
+            len(localization["sites"].id),
+            chunksize,
+            max_memory,
+            scheduler_address=scheduler_address,
+            compute_dtype=compute_dtype,
+            ncomponents=_ncomponents(localization["coefficients"]),
+        )
+        for localization in localizations
+    ]
+    with contextlib.ExitStack() as stack:
+        client = None
+        if scheduler_address is not None:
+            client = stack.enter_context(_connect(scheduler_address))
+        write_gslr_batch = stack.enter_context(
+            gslr_writer(
+                output_gslr_file,
+                targyears=targyears,
+                n_samps=nsamps,
+                pipeline_id=pipeline_id,
+                baseyear=baseyear,
+                scenario=scenario,
+                chunk_layout=chunk_layout,
+                provenance=provenance,
+                compression_threads=compression_threads,
+            )
+        )
+        lslr_writers = [
+            stack.enter_context(
+                lslr_writer(
+                    output_lslr_file,
+                    targyears=targyears,
+                    n_samps=nsamps,
+                    baseyear=baseyear,
+                    scenario=scenario,
+                    locations=localization["sites"],
+                    location_map=localization["location_map"],
+                    overlap=overlap_writes,
+                    chunk_layout=chunk_layout,
+                    provenance=provenance,
+                    client=client,
+                    compression_threads=compression_threads,
+                )
+            )
+            for localization, output_lslr_file in zip(localizations, output_lslr_files)
+        ]
+        localize_pool = stack.enter_context(
+            ThreadPoolExecutor(
+                max_workers=len(localizations), thread_name_prefix="localize"
+            )
+        )
+
+        def localize_batch(start, lwssamps, index):
+            lslr_writers[index](
+                start,
+                postprocess(
+                    lwssamps,
+                    None,
+                    localizations[index]["sites"],
+                    chunksizes[index],
+                    kernels,
+                    coefficients=localizations[index]["coefficients"],
+                    dtype=compute_dtype,
+                    client=client,
+                ),
+            )
+
+        batches = project_batches(
+            out_fit,
+            out_conf,
+            nsamps,
+            seed,
+            dcyear_start,
+            dcyear_end,
+            dcrate_lo,
+            dcrate_hi,
+            batch_size,
+            kernels=kernels,
+            dtype=compute_dtype,
+            components=components,
+        )
+        stack.enter_context(profiler.tasks("batches", client))
+        for start, lwssamps in batches:
+            gslr_written = io_pool.submit(write_gslr_batch, start, _total(lwssamps))
+            localized = [
+                localize_pool.submit(localize_batch, start, lwssamps, index)
+                for index in range(len(localizations))
+            ]
+            for future in localized:
+                future.result()
+            gslr_written.result()
+            logger.info(
+                "Wrote samples %d to %d", start, min(start + batch_size, nsamps)
+            )
+
+
+def _ncomponents(coefficients) -> int:
+    """Components localized with the fingerprint ``coefficients``."""
+    return 1 if coefficients.ndim == 1 else len(coefficients)
+
+
+def _connect(scheduler_address):
+    """Connect a client to a dask distributed scheduler."""
+    try:
+        from distributed import Client
+    except ImportError as e:
+        raise ImportError(
+            "scheduler_address requires the optional distributed package"
+        ) from e
+    logger.info("Connecting to dask scheduler at %s", scheduler_address)
+    return Client(scheduler_address)
+
+
+def _load_stage_dir(path, name):
+    """Memory-map the intermediates written by an earlier stage command."""
+    values = load_stage(path, mmap_mode="r")
+    if values is None:
+        raise FileNotFoundError(f"no complete {name} stage output found in {path}")
+    return values
+
+
+def run_preprocess_stage(
+    pophist_file,
+    reservoir_file,
+    popscen_file,
+    gwd_files,
+    scenario,
+    dotriangular,
+    baseyear,
+    pyear_start,
+    pyear_end,
+    pyear_step,
+    output_dir,
+    population_ensemble_file=None,
+) -> None:
+    """Read and preprocess inputs, saving the intermediates to output_dir."""
+    # Same as in project_landwaterstorage.
+    if len(gwd_files) != 3:
+        dotriangular = 0
+
+    values = _read_and_preprocess(
+        pophist_file,
+        reservoir_file,
+        popscen_file,
+        gwd_files,
+        scenario,
+        dotriangular,
+        baseyear,
+        pyear_start,
+        pyear_end,
+        pyear_step,
+        population_ensemble_file,
     )
+    save_stage(output_dir, values)
 
-    sites = read_locations(location_file)
-    fingerprints = read_fingerprints(fp_file)
-    lslr = postprocess(gslr, fingerprints, sites, chunksize)
-    write_lslr(
-        output_lslr_file,
-        local_sl=lslr,
-        targyears=out_conf["targyears"],
-        n_samps=nsamps,
-        baseyear=baseyear,
-        scenario=scenario,
-        locations=sites,
+
+def run_fit_stage(
+    preprocess_dir,
+    pipeline_id,
+    output_dir,
+    bootstrap=None,
+    bootstrap_seed=0,
+    fit_workers=None,
+) -> None:
+    """Fit the submodel to preprocessed data, saving the fit to output_dir."""
+    stage = _load_stage_dir(preprocess_dir, "preprocess")
+    save_stage(
+        output_dir,
+        _fit(
+            stage["data"],
+            stage["config"],
+            pipeline_id,
+            bootstrap,
+            bootstrap_seed,
+            fit_workers,
+        ),
+    )
+
+
+def run_project_stage(
+    preprocess_dir,
+    fit_dir,
+    nsamps,
+    seed,
+    pipeline_id,
+    dcyear_start,
+    dcyear_end,
+    dcrate_lo,
+    dcrate_hi,
+    output_dir,
+    output_gslr_file=None,
+    chunk_layout=None,
+    kernels="auto",
+    quantile_tolerance=None,
+    quantiles=DEFAULT_QUANTILES,
+    batch_size=None,
+    compression_threads=None,
+    compute_dtype="float64",
+    split_components=False,
+) -> None:
+    """
+    Project global samples from a fit, saving them to output_dir.
+
+    The saved stage carries the target years, base year and scenario, so
+    ``run_localize_stage`` needs nothing else. Optionally also writes the
+    global SLR file. With ``quantile_tolerance``, projects adaptively as in
+    ``project_landwaterstorage``. With ``split_components``, the saved
+    samples are split into ``COMPONENTS``, so they can be localized with a
+    fingerprint each.
+    """
+    out_conf = _load_stage_dir(preprocess_dir, "preprocess")["config"]
+    out_fit = _load_stage_dir(fit_dir, "fit")
+    projected = _project(
+        out_fit,
+        out_conf,
+        nsamps,
+        seed,
+        dcyear_start,
+        dcyear_end,
+        dcrate_lo,
+        dcrate_hi,
+        kernels=kernels,
+        quantile_tolerance=quantile_tolerance,
+        quantiles=quantiles,
+        batch_size=batch_size,
+        compute_dtype=compute_dtype,
+        components=split_components,
+    )
+    lwssamps = projected["lwssamps"]
+    gslr = _total(lwssamps)
+    save_stage(
+        output_dir,
+        {
+            "lwssamps": lwssamps,
+            "attrs": projected["attrs"],
+            "targyears": out_conf["targyears"],
+            "baseyear": out_conf["baseyear"],
+            "scenario": out_conf["scen"],
+            "pipeline_id": pipeline_id,
+        },
+    )
+    if output_gslr_file is not None:
+        write_gslr(
+            output_gslr_file,
+            targyears=out_conf["targyears"],
+            n_samps=len(gslr),
+            pipeline_id=pipeline_id,
+            baseyear=out_conf["baseyear"],
+            scenario=out_conf["scen"],
+            lwssamps=gslr,
+            chunk_layout=chunk_layout,
+            attrs=projected["attrs"],
+            compression_threads=compression_threads,
+        )
+
+
+def run_localize_stage(
+    project_dir,
+    fp_file,
+    location_file,
+    output_lslr_file,
+    chunksize,
+    dedupe_locations=False,
+    location_tolerance=0.0,
+    max_memory=None,
+    overlap_writes=False,
+    chunk_layout=None,
+    kernels="auto",
+    processes=None,
+    scheduler_address=None,
+    compression_threads=None,
+    compute_dtype="float64",
+    gwd_fp_variable="GROUND",
+    dam_fp_variable="GROUND",
+) -> None:
+    """
+    Localize memory-mapped global samples from project_dir and write them.
+
+    Like in ``project_landwaterstorage``, ``location_file`` and
+    ``output_lslr_file`` may be sequences of paired files.
+    """
+    if processes is not None and scheduler_address is not None:
+        raise ValueError("use either processes or scheduler_address, not both")
+    location_files, output_lslr_files = _location_sets(location_file, output_lslr_file)
+    stage = _load_stage_dir(project_dir, "project")
+    gslr = stage["lwssamps"]
+    _localize_sets(
+        gslr,
+        _read_localizations(
+            fp_file,
+            location_files,
+            dedupe_locations,
+            location_tolerance,
+            _fp_variables(gwd_fp_variable, dam_fp_variable),
+        ),
+        output_lslr_files,
+        targyears=stage["targyears"],
+        nsamps=gslr.shape[-2],
+        baseyear=stage["baseyear"],
+        scenario=stage["scenario"],
+        chunksize=chunksize,
+        max_memory=max_memory,
+        overlap_writes=overlap_writes,
+        chunk_layout=chunk_layout,
+        kernels=kernels,
+        processes=processes,
+        scheduler_address=scheduler_address,
+        attrs=stage.get("attrs"),
+        compression_threads=compression_threads,
+        compute_dtype=compute_dtype,
     )
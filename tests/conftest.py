@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+
+@pytest.fixture
+def input_files(tmp_path):
+    """
+    Small, synthetic input files for a full projection run.
+    """
+    indir = tmp_path / "input"
+    indir.mkdir()
+
+    years = np.arange(1950, 2011)
+    pophist = indir / "pophist.csv"
+    pophist.write_text(
+        "year,pop\n" + "".join(f"{y},{2.5e6 + (y - 1950) * 7.5e4}\n" for y in years)
+    )
+
+    tdams = np.linspace(1900, 2010, 60)
+    reservoir = indir / "reservoir.csv"
+    reservoir.write_text(
+        "year,mm\n"
+        + "".join(f"{t},{0.05 + 15 * (1 + np.tanh((t - 1970) / 15))}\n" for t in tdams)
+    )
+
+    gwd_files = []
+    for i in range(3):
+        tgwd = np.linspace(1900 + i, 2008, 80)
+        fl = indir / f"gwd_{i}.csv"
+        fl.write_text(
+            "year,mm\n"
+            + "".join(f"{t},{(t - 1900) ** 2 * 1e-3 * (i + 1)}\n" for t in tgwd)
+        )
+        gwd_files.append(str(fl))
+
+    popscen = indir / "popscen.csv"
+    popscen.write_text(
+        "year,SSP1,SSP5,SSP2,SSP4,SSP3\n"
+        + "".join(
+            f"{y},"
+            + ",".join(
+                str(6.5e9 + (y - 2005) * r) for r in (1e7, 1.2e7, 2e7, 2.5e7, 4e7)
+            )
+            + "\n"
+            for y in range(2005, 2101, 5)
+        )
+    )
+
+    fp_file = indir / "fingerprints.nc"
+    lat = np.linspace(-90, 90, 19)
+    lon = np.linspace(0, 340, 18)
+    with Dataset(fp_file, "w") as rootgrp:
+        rootgrp.createDimension("time", 1)
+        rootgrp.createDimension("lat", lat.size)
+        rootgrp.createDimension("lon", lon.size)
+        rootgrp.createVariable("lat", "f8", ("lat",))[:] = lat
+        rootgrp.createVariable("lon", "f8", ("lon",))[:] = lon
+        rootgrp.createVariable("GROUND", "f8", ("time", "lat", "lon"))[:] = (
+            100 + np.outer(np.cos(np.deg2rad(lat)), np.sin(np.deg2rad(lon)))[None]
+        )
+
+    location_file = indir / "location.lst"
+    location_file.write_text(
+        "New_York\t12\t40.70\t-74.01\nSydney\t13\t-33.86\t151.21\nOslo\t14\t59.91\t10.75\n"
+    )
+
+    return {
+        "pophist_file": str(pophist),
+        "reservoir_file": str(reservoir),
+        "popscen_file": str(popscen),
+        "gwd_files": gwd_files,
+        "fp_file": str(fp_file),
+        "location_file": str(location_file),
+    }
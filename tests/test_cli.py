@@ -0,0 +1,213 @@
+import json
+
+import numpy as np
+import xarray as xr
+from click.testing import CliRunner
+
+from ssp_landwaterstorage.cli import main
+
+
+def common_args(input_files):
+    """
+    Input file options shared by the run and preprocess commands.
+    """
+    args = [
+        f"--pophist-file={input_files['pophist_file']}",
+        f"--reservoir-file={input_files['reservoir_file']}",
+        f"--popscen-file={input_files['popscen_file']}",
+        "--scenario=ssp5",
+        "--baseyear=2005",
+        "--pyear-start=2020",
+        "--pyear-step=20",
+    ]
+    args += [f"--gwd-file={f}" for f in input_files["gwd_files"]]
+    return args
+
+
+def test_stage_commands_match_run(input_files, tmp_path):
+    """
+    Test that chaining the stage commands gives the same output as running without a command.
+    """
+    runner = CliRunner()
+    project_args = ["--nsamps=50", "--seed=42", "--dcrate-hi=0.1"]
+
+    result = runner.invoke(
+        main,
+        [
+            "--pipeline-id=test",
+            f"--output-gslr-file={tmp_path / 'run_gslr.nc'}",
+            f"--output-lslr-file={tmp_path / 'run_lslr.nc'}",
+            f"--fp-file={input_files['fp_file']}",
+            f"--location-file={input_files['location_file']}",
+            *common_args(input_files),
+            *project_args,
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    stages = [
+        ["preprocess", *common_args(input_files), f"--output-dir={tmp_path / 'pre'}"],
+        [
+            "fit",
+            f"--preprocess-dir={tmp_path / 'pre'}",
+            "--pipeline-id=test",
+            f"--output-dir={tmp_path / 'fit'}",
+        ],
+        [
+            "project",
+            f"--preprocess-dir={tmp_path / 'pre'}",
+            f"--fit-dir={tmp_path / 'fit'}",
+            "--pipeline-id=test",
+            *project_args,
+            "--batch-size=16",
+            f"--output-dir={tmp_path / 'project'}",
+            f"--output-gslr-file={tmp_path / 'stage_gslr.nc'}",
+        ],
+        [
+            "localize",
+            f"--project-dir={tmp_path / 'project'}",
+            f"--fp-file={input_files['fp_file']}",
+            f"--location-file={input_files['location_file']}",
+            f"--output-lslr-file={tmp_path / 'stage_lslr.nc'}",
+        ],
+    ]
+    for args in stages:
+        result = runner.invoke(main, args)
+        assert result.exit_code == 0, result.output
+
+    for kind in ("gslr", "lslr"):
+        with (
+            xr.open_dataset(tmp_path / f"run_{kind}.nc") as expected,
+            xr.open_dataset(tmp_path / f"stage_{kind}.nc") as actual,
+        ):
+            np.testing.assert_array_equal(
+                actual["sea_level_change"], expected["sea_level_change"]
+            )
+
+
+def test_run_dry_run(input_files, tmp_path):
+    """
+    Test that a dry run reports predicted resources without writing output.
+    """
+    result = CliRunner().invoke(
+        main,
+        [
+            "run",
+            "--pipeline-id=test",
+            f"--output-gslr-file={tmp_path / 'gslr.nc'}",
+            f"--output-lslr-file={tmp_path / 'lslr.nc'}",
+            f"--fp-file={input_files['fp_file']}",
+            f"--location-file={input_files['location_file']}",
+            *common_args(input_files),
+            "--nsamps=50",
+            "--dry-run",
+        ],
+    )
+
+    assert result.exit_code == 0, result.output
+    assert "50 samples x 6 years x 3 locations" in result.output
+    assert "Peak memory" in result.output
+    assert not (tmp_path / "gslr.nc").exists()
+    assert not (tmp_path / "lslr.nc").exists()
+
+
+def test_sweep_rejects_unknown_parameter(input_files, tmp_path):
+    """
+    Test that sweeping a parameter outside SWEEP_PARAMETERS is a usage error.
+    """
+    result = CliRunner().invoke(
+        main,
+        [
+            "sweep",
+            "--pipeline-id=test",
+            f"--output-gslr-file={tmp_path / 'sweep.nc'}",
+            *common_args(input_files),
+            "--sweep=nsamps=10,20",
+        ],
+    )
+
+    assert result.exit_code == 2
+    assert "nsamps=10,20" in result.output
+    assert not (tmp_path / "sweep.nc").exists()
+
+
+def test_batch_matches_run(input_files, tmp_path):
+    """
+    Test that a batch manifest run gives the same output as the run command, with CLI defaults.
+    """
+    runner = CliRunner()
+    result = runner.invoke(
+        main,
+        [
+            "--pipeline-id=test",
+            f"--output-gslr-file={tmp_path / 'run_gslr.nc'}",
+            f"--output-lslr-file={tmp_path / 'run_lslr.nc'}",
+            f"--fp-file={input_files['fp_file']}",
+            f"--location-file={input_files['location_file']}",
+            *common_args(input_files),
+            "--nsamps=50",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    defaults = {
+        k: input_files[k]
+        for k in ("pophist_file", "reservoir_file", "popscen_file", "fp_file")
+    }
+    defaults.update(
+        pipeline_id="test",
+        gwd_files=input_files["gwd_files"],
+        location_file=input_files["location_file"],
+        scenario="ssp5",
+        baseyear=2005,
+        pyear_start=2020,
+        pyear_step=20,
+        nsamps=50,
+    )
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(
+        json.dumps(
+            {
+                "defaults": defaults,
+                "runs": [
+                    {
+                        "name": "same",
+                        "output_gslr_file": "batch/same_gslr.nc",
+                        "output_lslr_file": "batch/same_lslr.nc",
+                    },
+                    {
+                        "seed": 7,
+                        "output_gslr_file": "batch/other_gslr.nc",
+                        "output_lslr_file": "batch/other_lslr.nc",
+                    },
+                ],
+            }
+        )
+    )
+    (tmp_path / "batch").mkdir()
+
+    result = runner.invoke(
+        main,
+        [
+            "batch",
+            f"--manifest={manifest}",
+            f"--report-file={tmp_path / 'report.json'}",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    for name in ("gslr", "lslr"):
+        expected = xr.open_dataset(tmp_path / f"run_{name}.nc")
+        actual = xr.open_dataset(tmp_path / "batch" / f"same_{name}.nc")
+        np.testing.assert_array_equal(
+            actual["sea_level_change"], expected["sea_level_change"]
+        )
+        assert actual.attrs["provenance"] == expected.attrs["provenance"]
+    reports = json.loads((tmp_path / "report.json").read_text())
+    assert [r["status"] for r in reports] == ["ok", "ok"]
+    assert reports[1]["reused"]["fit"] == 1
+
+    manifest.write_text(json.dumps([{**defaults, "nsamp": 10}]))
+    result = runner.invoke(main, ["batch", f"--manifest={manifest}"])
+    assert result.exit_code == 2
+    assert "unknown options ['nsamp']" in result.output
@@ -1,6 +1,23 @@
 import numpy as np
+import pytest
+from scipy import interpolate
+from scipy.stats import norm
 
-from ssp_landwaterstorage.core import Fingerprints, Locations
+from ssp_landwaterstorage import core
+from ssp_landwaterstorage.core import (
+    Fingerprints,
+    Locations,
+    bootstrap_fit,
+    deduplicate_locations,
+    estimate_memory,
+    estimate_runtime,
+    interp_rows,
+    parameter_grid,
+    plan_chunks,
+    postprocess,
+    quantile_error,
+    sigmoidal,
+)
 
 
 def test_fingerprints_interpolate_coefficients():
@@ -30,3 +47,375 @@ def test_fingerprints_interpolate_coefficients():
     expected = np.array([4.25, 5.125])
 
     np.testing.assert_allclose(actual, expected)
+
+
+def test_fingerprints_interpolation_weights():
+    """
+    Test that the sparse weights match RectBivariateSpline, clamping outside the grid, for every field.
+    """
+    rng = np.random.default_rng(0)
+    lat = np.linspace(-90, 90, 13)
+    lon = np.linspace(0, 350, 36)
+    fp = rng.uniform(50, 150, size=(2, 13, 36))
+    sites = Locations(
+        name=np.arange(200).astype(str),
+        id=np.arange(200),
+        lat=rng.uniform(-95, 95, 200),
+        lon=rng.uniform(-200, 400, 200),
+    )
+    fprints = Fingerprints(fp=fp, lat=lat, lon=lon, names=("gwd", "dam"))
+
+    weights = fprints.interpolation_weights(sites)
+    actual = fprints.interpolate_coefficients(sites)
+
+    assert weights.shape == (200, 13 * 36)
+    np.testing.assert_allclose(weights.sum(axis=1), 1)
+    assert actual.shape == (2, 200)
+    for field, row in zip(fp, actual):
+        spline = interpolate.RectBivariateSpline(lat, lon, field, kx=1, ky=1)
+        expected = spline.ev(sites.lat, np.mod(sites.lon, 360)) / 100
+        np.testing.assert_allclose(row, expected, rtol=1e-14)
+        single = Fingerprints(fp=field, lat=lat, lon=lon)
+        np.testing.assert_array_equal(single.interpolate_coefficients(sites), row)
+
+
+def test_deduplicate_locations():
+    """
+    Test that duplicate sites share a slot and map back to the original order.
+    """
+    sites = Locations(
+        name=np.array(["a", "b", "c", "d"]),
+        id=np.array([1, 2, 3, 4]),
+        lat=np.array([40.7, -33.9, 40.7, 40.7001]),
+        lon=np.array([-74.01, 151.2, 285.99, -74.01]),
+    )
+
+    actual = deduplicate_locations(sites)
+
+    # "a" and "c" are the same point on either side of the antimeridian convention.
+    assert actual.locations.id.size == 3
+    assert actual.index[0] == actual.index[2]
+    assert actual.index[0] != actual.index[3]
+    np.testing.assert_array_equal(
+        actual.locations.id[actual.index][[0, 1, 3]], [1, 2, 4]
+    )
+    np.testing.assert_allclose(actual.locations.lat[actual.index], sites.lat)
+
+
+def test_deduplicate_locations_tolerance():
+    """
+    Test that near-identical sites are collapsed within a tolerance.
+    """
+    sites = Locations(
+        name=np.array(["a", "b", "c"]),
+        id=np.array([1, 2, 3]),
+        lat=np.array([40.7, 40.7001, -33.9]),
+        lon=np.array([-74.01, -74.0101, 151.2]),
+    )
+
+    actual = deduplicate_locations(sites, tolerance=0.01)
+
+    assert actual.locations.id.size == 2
+    assert actual.index[0] == actual.index[1]
+    assert actual.locations.id[actual.index[0]] == 1
+
+    # Sites snapping to 360 and 0 degrees longitude meet across the wrap.
+    sites = Locations(
+        name=np.array(["a", "b", "c"]),
+        id=np.array([1, 2, 3]),
+        lat=np.array([10.0, 10.0, 10.0]),
+        lon=np.array([359.99, 0.01, -0.02]),
+    )
+    actual = deduplicate_locations(sites, tolerance=0.1)
+    assert actual.locations.id.size == 1
+
+
+def test_deduplicate_locations_spatial_order():
+    """
+    Test that slots follow a space-filling curve, keeping neighbors adjacent.
+    """
+    lat = np.array([-50.0, 50.0, -50.1, 50.1, -49.9, 49.9])
+    lon = np.array([10.0, 200.0, 10.1, 200.1, 9.9, 199.9])
+    sites = Locations(
+        name=np.array(list("abcdef")),
+        id=np.arange(6),
+        lat=lat,
+        lon=lon,
+    )
+
+    actual = deduplicate_locations(sites)
+
+    # The three southern sites and the three northern sites each form a contiguous run.
+    south = np.sort(actual.index[lat < 0])
+    north = np.sort(actual.index[lat > 0])
+    assert np.all(np.diff(south) == 1)
+    assert np.all(np.diff(north) == 1)
+
+
+def test_plan_chunks_splits_locations_first():
+    """
+    Test that a generous budget keeps whole samples and splits locations.
+    """
+    # 100 samples x 10 years resident = 8000 bytes, 12 bytes per chunk element.
+    actual = plan_chunks(100, 10, 50, max_memory=8000 + 12 * 100 * 10 * 5, nworkers=1)
+
+    assert actual == (100, 5)
+
+
+def test_plan_chunks_splits_samples():
+    """
+    Test that samples are split once one location no longer fits the budget.
+    """
+    actual = plan_chunks(100, 10, 50, max_memory=8000 + 12 * 10 * 30, nworkers=1)
+
+    assert actual == (30, 1)
+
+
+def test_plan_chunks_budget_too_small():
+    """
+    Test that an impossible budget is rejected.
+    """
+    with pytest.raises(ValueError):
+        plan_chunks(100, 10, 50, max_memory=8000, nworkers=1)
+
+
+def test_postprocess_sample_and_location_chunks():
+    """
+    Test that localizing with (samples, locations) chunks matches the outer product.
+    """
+    sites = Locations(
+        name=np.array(["a", "b", "c"]),
+        id=np.array([1, 2, 3]),
+        lat=np.array([42.5, 47.5, 45.0]),
+        lon=np.array([15.0, 22.5, 20.0]),
+    )
+    fprints = Fingerprints(
+        fp=np.array(
+            [
+                [350.0, 600.0, 850.0],
+                [250.0, 500.0, 750.0],
+                [150.0, 400.0, 650.0],
+            ]
+        ),
+        lat=np.array([40.0, 45.0, 50.0]),
+        lon=np.array([10.0, 20.0, 30.0]),
+    )
+    lwssamps = np.arange(12.0).reshape(4, 3)  # samples x years
+
+    actual = postprocess(lwssamps, fprints, sites, chunksize=(3, 2))
+
+    assert actual.chunks == ((3, 1), (3,), (2, 1))
+    expected = np.multiply.outer(lwssamps, fprints.interpolate_coefficients(sites))
+    np.testing.assert_allclose(actual.compute(), expected)
+
+
+def test_postprocess_components():
+    """
+    Test that split global samples are localized with one fingerprint per component.
+    """
+    rng = np.random.default_rng(0)
+    components = rng.normal(size=(2, 20, 4))
+    coefficients = rng.uniform(0.5, 1.5, size=(2, 7))
+    sites = Locations(
+        name=np.arange(7).astype(str),
+        id=np.arange(7),
+        lat=np.zeros(7),
+        lon=np.zeros(7),
+    )
+
+    actual = postprocess(components, None, sites, (8, 3), coefficients=coefficients)
+
+    assert actual.chunks == ((8, 8, 4), (4,), (3, 3, 1))
+    expected = np.einsum("csy,cl->syl", components, coefficients)
+    np.testing.assert_allclose(actual.compute(), expected)
+    with pytest.raises(ValueError, match="one row of fingerprint coefficients"):
+        postprocess(components, None, sites, 3, coefficients=coefficients[0])
+
+
+def test_postprocess_compute_dtype():
+    """
+    Test that float32 localization holds float32 within its precision of float64.
+    """
+    rng = np.random.default_rng(0)
+    lwssamps = rng.normal(scale=50, size=(20, 4))
+    coefficients = rng.uniform(0.5, 1.5, size=7)
+    sites = Locations(
+        name=np.arange(7).astype(str),
+        id=np.arange(7),
+        lat=np.zeros(7),
+        lon=np.zeros(7),
+    )
+
+    expected = postprocess(lwssamps, None, sites, 3, coefficients=coefficients)
+    actual = postprocess(
+        lwssamps, None, sites, 3, coefficients=coefficients, dtype="float32"
+    )
+
+    assert actual.dtype == np.float32
+    # Inputs and product each round once to float32.
+    atol = 2 * np.finfo(np.float32).eps * np.abs(expected).max().compute()
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=atol)
+    with pytest.raises(ValueError, match="unknown compute dtype"):
+        postprocess(lwssamps, None, sites, 3, coefficients=coefficients, dtype="f2")
+
+
+def test_estimate_memory_localization_chunks():
+    """
+    Test that peak memory grows with the localization chunks in flight.
+    """
+    small = estimate_memory(1000, 10, 100, chunksize=10, nworkers=2)
+    large = estimate_memory(1000, 10, 100, chunksize=50, nworkers=2)
+
+    # Two chunks in flight, each 1000 x 10 x 40 more elements at 12 bytes.
+    assert large - small == 2 * 1000 * 10 * 40 * 12
+    # Computed in float32, chunks are written as is.
+    small = estimate_memory(1000, 10, 100, chunksize=10, nworkers=2, itemsize=4)
+    large = estimate_memory(1000, 10, 100, chunksize=50, nworkers=2, itemsize=4)
+    assert large - small == 2 * 1000 * 10 * 40 * 4
+
+
+def test_estimate_memory_components():
+    """
+    Test that peak memory and chunk plans account for global samples split into components.
+    """
+    single = estimate_memory(1000, 10, 100, chunksize=10, nworkers=2)
+    split = estimate_memory(1000, 10, 100, chunksize=10, nworkers=2, ncomponents=2)
+
+    # A second component of 1000 x 10 resident samples.
+    assert split - single == 1000 * 10 * 8
+    budget = 8000 + 12 * 1000 * 5
+    assert plan_chunks(100, 10, 50, budget, nworkers=1) == (100, 5)
+    assert plan_chunks(100, 10, 50, budget, nworkers=1, ncomponents=2) == (100, 4)
+
+
+def test_estimate_runtime_scales_with_problem():
+    """
+    Test that predicted stage runtimes scale with the problem shape.
+    """
+    actual = estimate_runtime(1000, 10, 100, nworkers=1, kernels="numpy")
+    doubled = estimate_runtime(2000, 10, 100, nworkers=1, kernels="numpy")
+
+    assert set(actual) == {"project", "write_gslr", "localize", "write_lslr"}
+    for stage in actual:
+        assert doubled[stage] == pytest.approx(2 * actual[stage])
+
+
+def test_estimate_runtime_settings(monkeypatch):
+    """
+    Test that predicted runtimes depend on the workers, compression threads and compute dtype.
+    """
+    monkeypatch.setattr(core.os, "cpu_count", lambda: 4)
+    serial = estimate_runtime(1000, 10, 100, nworkers=1, kernels="numpy")
+    parallel = estimate_runtime(
+        1000, 10, 100, nworkers=8, kernels="numpy", compression_threads=2
+    )
+    single = estimate_runtime(
+        1000, 10, 100, nworkers=1, kernels="numpy", dtype="float32"
+    )
+
+    # Capped at the 4 cores.
+    assert parallel["localize"] == pytest.approx(serial["localize"] / 4)
+    assert parallel["write_lslr"] == pytest.approx(serial["write_lslr"] / 2)
+    assert parallel["project"] == serial["project"]
+    assert single["localize"] < serial["localize"]
+    assert single["write_lslr"] == serial["write_lslr"]
+
+
+def test_parameter_grid():
+    """
+    Test that swept values expand into every combination, last varying fastest.
+    """
+    defaults = {
+        "dcyear_start": 2020,
+        "dcyear_end": 2040,
+        "dcrate_lo": 0.0,
+        "dcrate_hi": 0.0,
+        "dgwd_dt_dpop_pcterr": 0.25,
+        "dam_pcterr": 0.25,
+    }
+
+    actual = parameter_grid(
+        defaults, {"dcrate_hi": [0.1, 0.2], "dam_pcterr": [0.2, 0.3, 0.4]}
+    )
+
+    np.testing.assert_array_equal(actual["dcrate_hi"], [0.1, 0.1, 0.1, 0.2, 0.2, 0.2])
+    np.testing.assert_array_equal(actual["dam_pcterr"], [0.2, 0.3, 0.4] * 2)
+    np.testing.assert_array_equal(actual["dcyear_start"], [2020] * 6)
+    with pytest.raises(ValueError, match="cannot sweep"):
+        parameter_grid(defaults, {"nsamps": [1, 2]})
+
+
+def test_quantile_error():
+    """
+    Test quantile_error against the asymptotic standard error of normal quantiles.
+    """
+    quantiles = [0.05, 0.5, 0.95]
+    nsamps = 100_000
+    samples = np.random.default_rng(0).normal(size=(nsamps, 2))
+
+    actual = quantile_error(samples, quantiles)
+
+    q = np.array(quantiles)
+    expected = np.sqrt(q * (1 - q) / nsamps) / norm.pdf(norm.ppf(q))
+    assert actual.shape == (3, 2)
+    np.testing.assert_allclose(
+        actual, np.repeat(expected[:, np.newaxis], 2, axis=1), rtol=0.2
+    )
+    # Too few samples to bracket the tails.
+    few = quantile_error(samples[:10], [0.01, 0.5])
+    assert np.isinf(few[0]).all()
+    assert np.isfinite(few[1]).all()
+
+
+def test_interp_rows():
+    """
+    Test that interp_rows matches np.interp on each row, bit for bit.
+    """
+    rng = np.random.default_rng(0)
+    xp = np.sort(rng.uniform(2000, 2100, size=12))
+    fp = rng.normal(size=(4, 12))
+    x = np.linspace(1990, 2110, 57)
+
+    actual = interp_rows(x, xp, fp)
+
+    assert actual.shape == (4, 57)
+    for row, expected in zip(actual, fp):
+        np.testing.assert_array_equal(row, np.interp(x, xp, expected))
+
+
+def test_bootstrap_fit(monkeypatch):
+    """
+    Test that bootstrap_fit recovers exact relations and that resamples spread noisy ones.
+    """
+    rng = np.random.default_rng(0)
+    pop0 = np.linspace(1e6, 7e6, 60)
+    popt = np.array([5000.0, 4.0, 2.0, 4000.0])
+    dams = sigmoidal(pop0, *popt)
+    pop2gwd = [np.linspace(2e9, 6e9, n) for n in (9, 14, 5)]
+    slopes = [2e-9, 3e-9, 4e-9]
+    exact = [s * x for s, x in zip(slopes, pop2gwd)]
+
+    out = bootstrap_fit(pop0, dams, popt * 1.1, pop2gwd, exact, 200, seed=1, workers=1)
+
+    assert out["dams_popt_ensemble"].shape == (200, 4)
+    np.testing.assert_allclose(
+        out["dams_popt_ensemble"], np.tile(popt, (200, 1)), rtol=1e-5
+    )
+    # Each member takes the slope of one dataset.
+    nearest = np.isclose(
+        out["dgwd_dt_dpop_ensemble"][:, np.newaxis], slopes, rtol=1e-6, atol=0
+    )
+    assert nearest.any(axis=1).all() and nearest.any(axis=0).all()
+
+    noisy = [y + rng.normal(scale=1, size=y.shape) for y in exact]
+    first = bootstrap_fit(pop0, dams, popt, pop2gwd, noisy, 200, seed=1, workers=1)
+    # By default, the sigmoids are fit in a pool of one process per CPU.
+    monkeypatch.setattr(core.os, "cpu_count", lambda: 2)
+    again = bootstrap_fit(pop0, dams, popt, pop2gwd, noisy, 200, seed=1)
+    for name in ("dgwd_dt_dpop_ensemble", "dams_popt_ensemble"):
+        np.testing.assert_array_equal(first[name], again[name])
+    # Resampled slopes spread around the full least squares fit of each dataset.
+    assert len(np.unique(first["dgwd_dt_dpop_ensemble"])) > 100
+    for x, y in zip(pop2gwd, noisy):
+        full = np.linalg.lstsq(x[:, np.newaxis], y, rcond=None)[0][0]
+        assert np.isclose(first["dgwd_dt_dpop_ensemble"], full, rtol=0.2, atol=0).any()
@@ -1,4 +1,8 @@
+import dask.array as da
 import numpy as np
+import pytest
+import xarray as xr
+from netCDF4 import Dataset
 
 from ssp_landwaterstorage.core import (
     ReservoirImpoundment,
@@ -6,6 +10,7 @@ from ssp_landwaterstorage.core import (
     PopulationHistory,
     GroundwaterDepletion,
     PopulationScenarios,
+    deduplicate_locations,
 )
 from ssp_landwaterstorage.io import (
     read_reservoir_impoundment,
@@ -13,6 +18,18 @@ from ssp_landwaterstorage.io import (
     read_population_history,
     read_groundwater_depletion,
     read_population_scenarios,
+    read_fingerprints,
+    write_gslr,
+    write_lslr,
+    lslr_writer,
+    chunk_shape,
+    estimate_output_bytes,
+    COMPRESSION_RATIO,
+    read_provenance,
+    read_job,
+    read_manifest,
+    save_stage,
+    load_stage,
 )
 
 
@@ -171,3 +188,364 @@ def test_read_population_scenarios(tmp_path):
 
     np.testing.assert_allclose(actual.yr, expected.yr)
     np.testing.assert_allclose(actual.scenarios, expected.scenarios)
+
+
+def test_read_fingerprints_variables(tmp_path):
+    """
+    Test that several fingerprint variables are read as fields on one grid.
+    """
+    fl = tmp_path / "fingerprints.nc"
+    ground = np.arange(12.0).reshape(1, 3, 4)
+    with Dataset(fl, "w") as rootgrp:
+        rootgrp.createDimension("time", 1)
+        rootgrp.createDimension("lat", 3)
+        rootgrp.createDimension("lon", 4)
+        rootgrp.createVariable("lat", "f8", ("lat",))[:] = [-10, 0, 10]
+        rootgrp.createVariable("lon", "f8", ("lon",))[:] = [0, 90, 180, 270]
+        for name, values in (("GROUND", ground), ("DAM", 2 * ground)):
+            rootgrp.createVariable(name, "f8", ("time", "lat", "lon"))[:] = values
+
+    single = read_fingerprints(fl)
+    both = read_fingerprints(fl, ("GROUND", "DAM"))
+
+    np.testing.assert_array_equal(single.fp, ground[0])
+    assert both.names == ("GROUND", "DAM")
+    np.testing.assert_array_equal(both.fp, [ground[0], 2 * ground[0]])
+    with pytest.raises(ValueError, match="no fingerprint variables"):
+        read_fingerprints(fl, ("GROUND", "RESERVOIR"))
+
+
+def test_write_lslr_location_map(tmp_path):
+    """
+    Test that deduplicated output can be expanded back to the original sites.
+    """
+    tmpfl = tmp_path / "lslr.nc"
+    sites = Locations(
+        name=np.array(["a", "b", "c"]),
+        id=np.array([10, 20, 30]),
+        lat=np.array([1.0, 2.0, 1.0]),
+        lon=np.array([3.0, 4.0, 3.0]),
+    )
+    location_map = deduplicate_locations(sites)
+    slots = location_map.locations
+    local_sl = np.arange(2 * 1 * slots.id.size, dtype="f4").reshape(2, 1, -1)
+
+    write_lslr(
+        tmpfl,
+        local_sl=local_sl,
+        targyears=np.array([2020]),
+        n_samps=2,
+        baseyear=2005,
+        scenario="ssp5",
+        locations=slots,
+        location_map=location_map,
+    )
+
+    with xr.open_dataset(tmpfl) as ds:
+        assert ds.sizes["locations"] == 2
+        expanded = ds["sea_level_change"].isel(locations=ds["site_index"])
+        np.testing.assert_array_equal(ds["site_id"], sites.id)
+        np.testing.assert_allclose(
+            ds["lat"].isel(locations=ds["site_index"]), sites.lat
+        )
+        np.testing.assert_array_equal(expanded[..., 0], expanded[..., 2])
+
+
+def test_write_lslr_overlap(tmp_path):
+    """
+    Test that overlapped chunk writes give the same file content as a plain write.
+    """
+    sites = Locations(
+        name=np.array(["a", "b", "c"]),
+        id=np.array([10, 20, 30]),
+        lat=np.array([1.0, 2.0, 3.0]),
+        lon=np.array([3.0, 4.0, 5.0]),
+    )
+    local_sl = da.from_array(
+        np.arange(4 * 2 * 3, dtype="f8").reshape(4, 2, 3), chunks=(2, 2, 1)
+    )
+    kwargs = dict(
+        local_sl=local_sl,
+        targyears=np.array([2020, 2030]),
+        n_samps=4,
+        baseyear=2005,
+        scenario="ssp5",
+        locations=sites,
+    )
+
+    write_lslr(tmp_path / "plain.nc", **kwargs)
+    write_lslr(tmp_path / "overlap.nc", overlap=True, **kwargs)
+
+    with (
+        xr.open_dataset(tmp_path / "plain.nc") as expected,
+        xr.open_dataset(tmp_path / "overlap.nc") as actual,
+    ):
+        xr.testing.assert_identical(
+            actual.drop_attrs(deep=False), expected.drop_attrs(deep=False)
+        )
+        assert actual["sea_level_change"].dtype == np.float32
+
+
+def test_chunk_shape_presets():
+    """
+    Test chunk shapes for the layout presets, clipped to the variable shape.
+    """
+    assert chunk_shape(None, 20000, 11, 1000) is None
+    # 1 MiB of float32 is 262144 values.
+    assert chunk_shape("by-location", 20000, 11, 1000) == (20000, 1, 13)
+    assert chunk_shape("by-sample", 20000, 11, 1000) == (23, 11, 1000)
+    assert chunk_shape("by-location", 10, 11, 3) == (10, 1, 3)
+    assert chunk_shape("5,1,2", 20000, 11, 1) == (5, 1, 1)
+
+
+def test_chunk_shape_bad_layout():
+    """
+    Test that unknown layouts are rejected.
+    """
+    with pytest.raises(ValueError):
+        chunk_shape("by-year", 10, 10, 10)
+    with pytest.raises(ValueError):
+        chunk_shape("1,2", 10, 10, 10)
+
+
+@pytest.mark.parametrize("overlap", [False, True])
+def test_write_lslr_chunk_layout(tmp_path, overlap):
+    """
+    Test that write_lslr uses the requested on-disk chunking.
+    """
+    tmpfl = tmp_path / "lslr.nc"
+    sites = Locations(
+        name=np.array(["a", "b", "c"]),
+        id=np.array([10, 20, 30]),
+        lat=np.array([1.0, 2.0, 3.0]),
+        lon=np.array([3.0, 4.0, 5.0]),
+    )
+
+    write_lslr(
+        tmpfl,
+        local_sl=np.zeros((4, 2, 3)),
+        targyears=np.array([2020, 2030]),
+        n_samps=4,
+        baseyear=2005,
+        scenario="ssp5",
+        locations=sites,
+        overlap=overlap,
+        chunk_layout="by-location",
+    )
+
+    with Dataset(tmpfl) as rootgrp:
+        assert rootgrp["sea_level_change"].chunking() == [4, 1, 3]
+
+
+def test_write_gslr_chunk_layout(tmp_path):
+    """
+    Test that write_gslr uses the requested on-disk chunking.
+    """
+    tmpfl = tmp_path / "gslr.nc"
+
+    write_gslr(
+        tmpfl,
+        lwssamps=np.zeros((4, 2)),
+        targyears=np.array([2020, 2030]),
+        n_samps=4,
+        pipeline_id="1234",
+        baseyear=2005,
+        scenario="ssp5",
+        chunk_layout="by-sample",
+    )
+
+    with Dataset(tmpfl) as rootgrp:
+        assert rootgrp["sea_level_change"].chunking() == [4, 2, 1]
+
+
+@pytest.mark.parametrize("overlap", [False, True])
+def test_lslr_writer_compression_threads(tmp_path, overlap):
+    """
+    Test that pre-compressed chunk writes give the same NetCDF4 file content, across batches.
+    """
+    pytest.importorskip("h5py")
+    sites = Locations(
+        name=np.array(["a", "b", "c"]),
+        id=np.array([10, 20, 30]),
+        lat=np.array([1.0, 2.0, 3.0]),
+        lon=np.array([3.0, 4.0, 5.0]),
+    )
+    samples = np.random.default_rng(0).normal(size=(7, 3, 3))
+    kwargs = dict(
+        targyears=np.array([2020, 2030, 2040]),
+        n_samps=7,
+        baseyear=2005,
+        scenario="ssp5",
+        locations=sites,
+        overlap=overlap,
+        # Batches end mid-chunk, and chunks overhang the last sample and year.
+        chunk_layout="2,2,2",
+        provenance="abc",
+    )
+
+    for name, threads in (("plain.nc", None), ("direct.nc", 3)):
+        with lslr_writer(
+            tmp_path / name, compression_threads=threads, **kwargs
+        ) as write:
+            write(0, da.from_array(samples[:3], chunks=(3, 3, 2)))
+            write(3, da.from_array(samples[3:], chunks=(2, 3, 2)))
+
+    with (
+        xr.open_dataset(tmp_path / "plain.nc") as expected,
+        xr.open_dataset(tmp_path / "direct.nc") as actual,
+    ):
+        xr.testing.assert_identical(
+            actual.drop_attrs(deep=False), expected.drop_attrs(deep=False)
+        )
+    with Dataset(tmp_path / "direct.nc") as rootgrp:
+        assert rootgrp.provenance == "abc"
+        assert rootgrp["sea_level_change"].chunking() == [2, 2, 2]
+        assert rootgrp["sea_level_change"].filters()["zlib"]
+
+
+def test_write_gslr_compression_threads(tmp_path):
+    """
+    Test that write_gslr writes the same samples with pre-compressed chunks.
+    """
+    pytest.importorskip("h5py")
+    lwssamps = np.random.default_rng(0).normal(size=(5, 3))
+    kwargs = dict(
+        lwssamps=lwssamps,
+        targyears=np.array([2020, 2030, 2040]),
+        n_samps=5,
+        pipeline_id="1234",
+        baseyear=2005,
+        scenario="ssp5",
+        chunk_layout="2,2,1",
+    )
+
+    write_gslr(tmp_path / "plain.nc", **kwargs)
+    write_gslr(tmp_path / "direct.nc", compression_threads=2, **kwargs)
+
+    with (
+        xr.open_dataset(tmp_path / "plain.nc") as expected,
+        xr.open_dataset(tmp_path / "direct.nc") as actual,
+    ):
+        xr.testing.assert_identical(
+            actual.drop_attrs(deep=False), expected.drop_attrs(deep=False)
+        )
+
+
+def test_read_manifest(tmp_path):
+    """
+    Test that manifest runs start from the defaults, with paths relative to the manifest.
+    """
+    tmpfl = tmp_path / "manifest.toml"
+    tmpfl.write_text(
+        """
+[defaults]
+gwd_files = ["a.csv", "/data/b.csv"]
+seed = 1
+
+[[runs]]
+scenario = "ssp1"
+
+[[runs]]
+seed = 2
+location_file = "sites/two.lst"
+"""
+    )
+
+    runs = read_manifest(tmpfl)
+
+    assert runs == [
+        {
+            "gwd_files": [str(tmp_path / "a.csv"), "/data/b.csv"],
+            "seed": 1,
+            "scenario": "ssp1",
+        },
+        {
+            "gwd_files": [str(tmp_path / "a.csv"), "/data/b.csv"],
+            "seed": 2,
+            "location_file": str(tmp_path / "sites" / "two.lst"),
+        },
+    ]
+    tmpfl = tmp_path / "manifest.json"
+    tmpfl.write_text('[{"seed": 3}]')
+    assert read_manifest(tmpfl) == [{"seed": 3}]
+    tmpfl.write_text('{"defaults": {}}')
+    with pytest.raises(ValueError, match="no list of runs"):
+        read_manifest(tmpfl)
+
+
+def test_read_job(tmp_path):
+    """
+    Test that a job's relative paths are relative to the job file.
+    """
+    tmpfl = tmp_path / "jobs" / "one.json"
+    tmpfl.parent.mkdir()
+    tmpfl.write_text('{"seed": 3, "fp_file": "../fp.nc", "gwd_files": ["/data/a.csv"]}')
+
+    assert read_job(tmpfl) == {
+        "seed": 3,
+        "fp_file": str(tmp_path / "fp.nc"),
+        "gwd_files": ["/data/a.csv"],
+    }
+    tmpfl.write_text("[]")
+    with pytest.raises(ValueError, match="not a table of run options"):
+        read_job(tmpfl)
+
+
+def test_save_load_stage(tmp_path):
+    """
+    Test that stage intermediates round-trip, optionally memory-mapped.
+    """
+    stage_dir = tmp_path / "fit-abc"
+    values = {
+        "config": {"scen": "ssp5", "baseyear": 2005, "pcterr": np.float64(0.25)},
+        "popt": np.array([1.0, 2.0, 3.0]),
+    }
+
+    save_stage(stage_dir, values)
+    actual = load_stage(stage_dir, mmap_mode="r")
+
+    assert actual["config"] == {"scen": "ssp5", "baseyear": 2005, "pcterr": 0.25}
+    assert isinstance(actual["popt"], np.memmap)
+    np.testing.assert_array_equal(actual["popt"], values["popt"])
+
+
+def test_load_stage_missing(tmp_path):
+    """
+    Test that an incomplete or missing stage loads as None.
+    """
+    assert load_stage(tmp_path / "missing") is None
+
+
+def test_estimate_output_bytes_chunk_padding():
+    """
+    Test that predicted file sizes account for float32 data padded to whole chunks.
+    """
+    plain = estimate_output_bytes(10, 3, 5)
+    padded = estimate_output_bytes(10, 3, 5, chunk_layout="4,3,2")
+
+    coords = 10 * 8 + 3 * 8 + 5 * 24
+    assert plain == 10 * 3 * 5 * 4 + coords
+    assert padded == 12 * 3 * 6 * 4 + coords
+    compressed = estimate_output_bytes(10, 3, 5, compressed=True)
+    assert compressed == int(10 * 3 * 5 * 4 * COMPRESSION_RATIO) + coords
+
+
+def test_read_provenance(tmp_path):
+    """
+    Test that provenance written with the output can be read back.
+    """
+    tmpfl = tmp_path / "gslr.nc"
+
+    write_gslr(
+        tmpfl,
+        lwssamps=np.zeros((4, 2)),
+        targyears=np.array([2020, 2030]),
+        n_samps=4,
+        pipeline_id="1234",
+        baseyear=2005,
+        scenario="ssp5",
+        provenance="abc123",
+    )
+
+    assert read_provenance(tmpfl) == "abc123"
+    assert read_provenance(tmp_path / "missing.nc") is None
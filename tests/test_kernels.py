@@ -0,0 +1,150 @@
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from ssp_landwaterstorage import kernels
+from ssp_landwaterstorage.kernels import get_kernels
+
+requires_numba = pytest.mark.skipif(
+    kernels.numba is None, reason="numba is not installed"
+)
+BACKENDS = ["numpy", pytest.param("numba", marks=requires_numba)]
+
+
+def sample_curves_args(nsettings=3, nyears=6, nsamps=5, ntraj=2):
+    """
+    Random inputs for the sample_curves kernel.
+    """
+    rng = np.random.default_rng(0)
+    out = dict(
+        gwd_base=rng.normal(size=(ntraj, nyears)),
+        gwd_factor=rng.normal(size=(nsettings, nsamps)),
+        dam_base=rng.normal(size=(ntraj, nyears)),
+        dam_factor=rng.normal(size=(nsettings, nsamps)),
+        dc_years=rng.normal(size=(nsettings, nyears)),
+        dc_rates=rng.normal(size=(nsettings, nsamps)),
+        traj=rng.integers(ntraj, size=nsamps),
+        base_idx=1,
+        targ_idx=np.array([1, 3, 4, 5]),
+    )
+    return out
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_sample_curves(backend):
+    """
+    Test that sample_curves adds up the contributions and centers them to the base year.
+    """
+    args = sample_curves_args()
+    full = (
+        args["gwd_factor"][:, :, np.newaxis] * args["gwd_base"][args["traj"]] * 0.8
+        + args["dam_factor"][:, :, np.newaxis] * args["dam_base"][args["traj"]]
+        + args["dc_rates"][:, :, np.newaxis] * args["dc_years"][:, np.newaxis, :]
+    )
+    expected = (full - full[:, :, [args["base_idx"]]])[:, :, args["targ_idx"]]
+
+    actual = get_kernels(backend).sample_curves(**args)
+
+    np.testing.assert_allclose(actual, expected)
+    np.testing.assert_array_equal(actual[:, :, 0], 0.0)
+    assert actual.flags.c_contiguous
+
+
+@requires_numba
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_backends_identical(dtype):
+    """
+    Test that the numba kernels give bit-identical results to the numpy kernels, in either precision.
+    """
+    args = sample_curves_args(nsettings=4, nyears=20, nsamps=101, ntraj=7)
+    args = {
+        k: v.astype(dtype) if np.asarray(v).dtype.kind == "f" else v
+        for k, v in args.items()
+    }
+    actual = get_kernels("numba").sample_curves(**args)
+    expected = get_kernels("numpy").sample_curves(**args)
+    assert actual.dtype == expected.dtype == dtype
+    np.testing.assert_array_equal(actual, expected)
+
+    rng = np.random.default_rng(1)
+    a = rng.normal(size=(7, 3)).astype(dtype)
+    b = rng.normal(size=4).astype(dtype)
+    actual = get_kernels("numba").outer(a, b)
+    assert actual.dtype == dtype
+    np.testing.assert_array_equal(actual, get_kernels("numpy").outer(a, b))
+
+    a = rng.normal(size=(2, 7, 3)).astype(dtype)
+    b = rng.normal(size=(2, 4)).astype(dtype)
+    np.testing.assert_array_equal(
+        get_kernels("numba").outer_sum(a, b), get_kernels("numpy").outer_sum(a, b)
+    )
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_outer_sum(backend):
+    """
+    Test that outer_sum adds up the outer products of each component.
+    """
+    rng = np.random.default_rng(0)
+    a = rng.normal(size=(2, 5, 3))
+    b = rng.normal(size=(2, 4))
+
+    actual = get_kernels(backend).outer_sum(a, b)
+
+    np.testing.assert_allclose(actual, np.einsum("csy,cl->syl", a, b))
+
+
+def test_get_kernels_auto(monkeypatch):
+    """
+    Test that "auto" falls back to numpy without numba, and that "numba" then errors.
+    """
+    monkeypatch.setattr(kernels, "numba", None)
+
+    assert get_kernels("auto").name == "numpy"
+    with pytest.raises(ValueError, match="requires numba"):
+        get_kernels("numba")
+    with pytest.raises(ValueError, match="unknown kernels backend"):
+        get_kernels("fortran")
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_kernels_release_gil(backend):
+    """
+    Test that another thread makes progress while a kernel runs.
+    """
+    outer = get_kernels(backend).outer
+    a = np.ones((400, 20))
+    b = np.ones(2000)
+    # Compile before timing.
+    outer(a[:1], b[:1])
+    # Switch threads often, so a kernel holding the GIL leaves no time to others.
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    count = 0
+    done = threading.Event()
+
+    def spin():
+        nonlocal count
+        while not done.is_set():
+            count += 1
+
+    spinner = threading.Thread(target=spin)
+    spinner.start()
+    try:
+        before = count
+        start = time.perf_counter()
+        outer(a, b)
+        seconds = time.perf_counter() - start
+        during = count - before
+        before = count
+        time.sleep(seconds)
+        idle = count - before
+    finally:
+        done.set()
+        spinner.join()
+        sys.setswitchinterval(switch_interval)
+
+    assert during > idle / 4
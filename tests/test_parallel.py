@@ -0,0 +1,41 @@
+import numpy as np
+
+from ssp_landwaterstorage.core import Fingerprints, Locations, postprocess
+from ssp_landwaterstorage.parallel import postprocess_processes
+
+
+def test_postprocess_processes_matches_postprocess(tmp_path):
+    """
+    Test that localizing with a process pool gives the float32 output of postprocess.
+    """
+    sites = Locations(
+        name=np.array(["a", "b", "c"]),
+        id=np.array([1, 2, 3]),
+        lat=np.array([42.5, 47.5, 45.0]),
+        lon=np.array([15.0, 22.5, 20.0]),
+    )
+    fprints = Fingerprints(
+        fp=np.array(
+            [
+                [350.0, 600.0, 850.0],
+                [250.0, 500.0, 750.0],
+                [150.0, 400.0, 650.0],
+            ]
+        ),
+        lat=np.array([40.0, 45.0, 50.0]),
+        lon=np.array([10.0, 20.0, 30.0]),
+    )
+    lwssamps = np.arange(12.0).reshape(4, 3)  # samples x years
+
+    actual = postprocess_processes(
+        lwssamps,
+        fprints,
+        sites,
+        chunksize=(3, 2),
+        processes=2,
+        out_path=tmp_path / "lslr.npy",
+    )
+
+    assert actual.chunks == ((3, 1), (3,), (2, 1))
+    expected = postprocess(lwssamps, fprints, sites, chunksize=2).compute()
+    np.testing.assert_array_equal(actual.compute(), expected.astype("f4"))
@@ -0,0 +1,71 @@
+import json
+import pstats
+import time
+
+import dask.array as da
+
+from ssp_landwaterstorage import profiling
+from ssp_landwaterstorage.profiling import RunProfiler
+
+
+def test_run_profiler(tmp_path):
+    """
+    Test that stages are profiled and dask tasks and memory traced in the Chrome trace format.
+    """
+    profiler = RunProfiler(tmp_path / "profile", memory_interval=0.01)
+
+    with profiler.stage("localize"):
+        with profiler.tasks("lslr.nc"):
+            da.ones((4, 4), chunks=2).sum().compute(scheduler="threads")
+
+    assert pstats.Stats(str(tmp_path / "profile" / "localize.prof")).total_calls > 0
+    events = json.loads((tmp_path / "profile" / "trace.json").read_text())[
+        "traceEvents"
+    ]
+    stages = [e for e in events if e.get("cat") == "stage"]
+    tasks = [e for e in events if e.get("cat") == "lslr.nc"]
+    assert [e["name"] for e in stages] == ["localize"]
+    assert len(tasks) > 4
+    assert all(e["ph"] == "X" and e["tid"] >= 2 for e in tasks)
+    assert all(
+        stages[0]["ts"] <= e["ts"] <= stages[0]["ts"] + stages[0]["dur"] for e in tasks
+    )
+    assert any(e["ph"] == "C" and e["args"]["rss_mib"] > 0 for e in events)
+
+
+def test_run_profiler_overlapping_stages(tmp_path, caplog):
+    """
+    Test that a stage starting while another is profiled is only timed, and that no profile_dir records nothing.
+    """
+    profiler = RunProfiler(tmp_path)
+
+    with profiler.stage("outer"), profiler.stage("inner"):
+        pass
+
+    assert (tmp_path / "outer.prof").exists()
+    assert not (tmp_path / "inner.prof").exists()
+    assert "Not profiling inner stage" in caplog.text
+    names = [
+        e["name"]
+        for e in json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    ]
+    assert "inner" in names and "outer" in names
+
+    with RunProfiler().stage("nothing"), RunProfiler().tasks("nothing"):
+        pass
+
+
+def test_run_profiler_memory_without_psutil(tmp_path, monkeypatch):
+    """
+    Test that memory is still sampled into the trace without psutil.
+    """
+    monkeypatch.setattr(profiling, "psutil", None)
+    profiler = RunProfiler(tmp_path, memory_interval=0.01)
+
+    with profiler.tasks("lslr.nc"):
+        time.sleep(0.05)
+
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    memory = [e for e in events if e["ph"] == "C"]
+    assert len(memory) > 1
+    assert all(e["name"] == "memory" and e["args"]["rss_mib"] > 0 for e in memory)
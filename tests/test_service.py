@@ -0,0 +1,960 @@
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dask
+import numpy as np
+import pytest
+import xarray as xr
+from netCDF4 import Dataset
+
+from ssp_landwaterstorage import service
+from ssp_landwaterstorage.core import fit, parameter_grid, project_sweep_batches
+from ssp_landwaterstorage.service import (
+    project_landwaterstorage,
+    sweep_landwaterstorage,
+)
+
+
+def run_kwargs(input_files, outdir, **kwargs):
+    """
+    Arguments for a small project_landwaterstorage run writing to outdir.
+    """
+    out = dict(
+        scenario="ssp5",
+        dotriangular=False,
+        baseyear=2005,
+        pyear_start=2020,
+        pyear_end=2100,
+        pyear_step=20,
+        nsamps=50,
+        seed=1234,
+        pipeline_id="test",
+        dcyear_start=2020,
+        dcyear_end=2040,
+        dcrate_lo=0.0,
+        dcrate_hi=0.1,
+        chunksize=2,
+        output_gslr_file=str(outdir / "gslr.nc"),
+        output_lslr_file=str(outdir / "lslr.nc"),
+    )
+    out.update(input_files)
+    out.update(kwargs)
+    return out
+
+
+def test_project_landwaterstorage_resume(input_files, tmp_path, monkeypatch):
+    """
+    Test that a resumed run reuses stage checkpoints and gives the same output.
+    """
+    checkpoint_dir = tmp_path / "checkpoints"
+    first = tmp_path / "first"
+    first.mkdir()
+    project_landwaterstorage(
+        **run_kwargs(input_files, first, checkpoint_dir=str(checkpoint_dir))
+    )
+
+    def fail(*args, **kwargs):
+        raise AssertionError("stage should have been resumed from checkpoint")
+
+    monkeypatch.setattr(service, "read_population_history", fail)
+    monkeypatch.setattr(service, "fit", fail)
+    monkeypatch.setattr(service, "project", fail)
+    second = tmp_path / "second"
+    second.mkdir()
+    project_landwaterstorage(
+        **run_kwargs(
+            input_files, second, checkpoint_dir=str(checkpoint_dir), resume=True
+        )
+    )
+
+    for fl in ("gslr.nc", "lslr.nc"):
+        with (
+            xr.open_dataset(first / fl) as expected,
+            xr.open_dataset(second / fl) as actual,
+        ):
+            np.testing.assert_array_equal(
+                actual["sea_level_change"], expected["sea_level_change"]
+            )
+
+
+def test_project_landwaterstorage_resume_needs_checkpoint_dir(input_files, tmp_path):
+    """
+    Test that resuming without a checkpoint directory is rejected.
+    """
+    with pytest.raises(ValueError):
+        project_landwaterstorage(**run_kwargs(input_files, tmp_path, resume=True))
+
+
+def test_project_landwaterstorage_skip_if_current(input_files, tmp_path, monkeypatch):
+    """
+    Test that a rerun with unchanged inputs and parameters is skipped.
+    """
+    project_landwaterstorage(**run_kwargs(input_files, tmp_path, skip_if_current=True))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("run should have been skipped")
+
+    with monkeypatch.context() as m:
+        m.setattr(service, "project", fail)
+        project_landwaterstorage(
+            **run_kwargs(input_files, tmp_path, skip_if_current=True)
+        )
+
+    # A changed parameter gives a different provenance, so the run is redone.
+    calls = []
+    real_project = service.project
+
+    def counting_project(*args, **kwargs):
+        calls.append(args)
+        return real_project(*args, **kwargs)
+
+    monkeypatch.setattr(service, "project", counting_project)
+    project_landwaterstorage(
+        **run_kwargs(input_files, tmp_path, seed=4321, skip_if_current=True)
+    )
+    assert len(calls) == 1
+
+
+def test_sweep_landwaterstorage_matches_single_runs(input_files, tmp_path):
+    """
+    Test that each setting of a sweep matches a separate run with that setting.
+    """
+    kwargs = run_kwargs(input_files, tmp_path)
+    sweep_kwargs = {
+        k: v
+        for k, v in kwargs.items()
+        if k
+        not in (
+            "fp_file",
+            "location_file",
+            "chunksize",
+            "output_lslr_file",
+        )
+    }
+    sweep_kwargs["output_gslr_file"] = str(tmp_path / "sweep.nc")
+    sweep_landwaterstorage(
+        **sweep_kwargs,
+        sweep={"dcrate_hi": [0.1, 0.3], "dgwd_dt_dpop_pcterr": [0.25, 0.5]},
+    )
+    swept = xr.open_dataset(tmp_path / "sweep.nc")
+    assert swept["sea_level_change"].dims[0] == "parameters"
+    np.testing.assert_array_equal(swept["dcrate_hi"], [0.1, 0.1, 0.3, 0.3])
+    np.testing.assert_array_equal(swept["dgwd_dt_dpop_pcterr"], [0.25, 0.5] * 2)
+
+    for i, dcrate_hi in [(0, 0.1), (2, 0.3)]:
+        project_landwaterstorage(
+            **run_kwargs(input_files, tmp_path, dcrate_hi=dcrate_hi)
+        )
+        single = xr.open_dataset(tmp_path / "gslr.nc")
+        np.testing.assert_allclose(
+            swept["sea_level_change"].isel(parameters=i),
+            single["sea_level_change"],
+            rtol=1e-6,
+        )
+        single.close()
+
+    # A larger GWD slope error only widens the spread around the same samples.
+    spread = swept["sea_level_change"].std("samples").isel(years=-1, locations=0)
+    assert spread[1] > spread[0]
+    swept.close()
+
+
+def test_project_landwaterstorage_processes(input_files, tmp_path):
+    """
+    Test that localizing with worker processes writes the same output and cleans up.
+    """
+    serial = tmp_path / "serial"
+    serial.mkdir()
+    project_landwaterstorage(**run_kwargs(input_files, serial))
+    pooled = tmp_path / "pooled"
+    pooled.mkdir()
+    project_landwaterstorage(**run_kwargs(input_files, pooled, processes=2))
+
+    expected = xr.open_dataset(serial / "lslr.nc")
+    actual = xr.open_dataset(pooled / "lslr.nc")
+    np.testing.assert_array_equal(
+        actual["sea_level_change"], expected["sea_level_change"]
+    )
+    assert sorted(p.name for p in pooled.iterdir()) == ["gslr.nc", "lslr.nc"]
+
+
+def test_project_landwaterstorage_scheduler_address(input_files, tmp_path):
+    """
+    Test that localizing on a distributed scheduler writes the same output.
+    """
+    distributed = pytest.importorskip("distributed")
+    serial = tmp_path / "serial"
+    serial.mkdir()
+    project_landwaterstorage(**run_kwargs(input_files, serial))
+
+    clustered = tmp_path / "clustered"
+    clustered.mkdir()
+    with distributed.LocalCluster(
+        n_workers=1, threads_per_worker=2, processes=False, dashboard_address=None
+    ) as cluster:
+        project_landwaterstorage(
+            **run_kwargs(
+                input_files, clustered, scheduler_address=cluster.scheduler_address
+            )
+        )
+
+    expected = xr.open_dataset(serial / "lslr.nc")
+    actual = xr.open_dataset(clustered / "lslr.nc")
+    np.testing.assert_array_equal(
+        actual["sea_level_change"], expected["sea_level_change"]
+    )
+    with pytest.raises(ValueError, match="not both"):
+        project_landwaterstorage(
+            **run_kwargs(
+                input_files,
+                clustered,
+                processes=2,
+                scheduler_address=cluster.scheduler_address,
+            )
+        )
+
+
+def test_project_landwaterstorage_scheduler_address_tiles(
+    input_files, tmp_path, monkeypatch
+):
+    """
+    Test that tiles submitted to a distributed scheduler only refer to scattered inputs.
+    """
+    distributed = pytest.importorskip("distributed")
+    submitted = []
+    compute = distributed.Client.compute
+
+    def record(self, arr, **kwargs):
+        submitted.append(arr)
+        return compute(self, arr, **kwargs)
+
+    monkeypatch.setattr(distributed.Client, "compute", record)
+    with (
+        dask.config.set({"array.chunk-size": "1KiB"}),
+        distributed.LocalCluster(
+            n_workers=1, threads_per_worker=2, processes=False, dashboard_address=None
+        ) as cluster,
+    ):
+        project_landwaterstorage(
+            **run_kwargs(
+                input_files, tmp_path, scheduler_address=cluster.scheduler_address
+            )
+        )
+
+    # 1KiB tiles the 50 samples of 5 years at 2 locations by 10.
+    assert {arr.shape[0] for arr in submitted} == {10}
+    assert all(arr.numblocks == (1, 1, 1) and arr.shape[2] <= 2 for arr in submitted)
+    for arr in submitted:
+        graph = dict(arr.__dask_graph__())
+        assert not any(isinstance(v, np.ndarray) for v in graph.values())
+
+
+def test_project_landwaterstorage_overlaps_io(input_files, tmp_path, monkeypatch):
+    """
+    Test that localization inputs are read and the global file written off the main thread.
+    """
+    threads = {}
+
+    def record(name, func):
+        def wrapper(*args, **kwargs):
+            threads[name] = threading.current_thread()
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    monkeypatch.setattr(
+        service, "read_fingerprints", record("read", service.read_fingerprints)
+    )
+    monkeypatch.setattr(service, "write_gslr", record("write", service.write_gslr))
+    project_landwaterstorage(**run_kwargs(input_files, tmp_path))
+
+    assert threads["read"] is not threading.main_thread()
+    assert threads["write"] is not threading.main_thread()
+
+    # Errors from background reads still fail the run.
+    with pytest.raises(FileNotFoundError):
+        project_landwaterstorage(
+            **run_kwargs(input_files, tmp_path, fp_file=str(tmp_path / "missing.nc"))
+        )
+
+
+@pytest.mark.parametrize("overlap_writes", [False, True])
+def test_project_landwaterstorage_batch_size(input_files, tmp_path, overlap_writes):
+    """
+    Test that projecting and localizing in batches writes the same outputs.
+    """
+    whole = tmp_path / "whole"
+    whole.mkdir()
+    project_landwaterstorage(
+        **run_kwargs(input_files, whole, overlap_writes=overlap_writes)
+    )
+    batched = tmp_path / "batched"
+    batched.mkdir()
+    project_landwaterstorage(
+        **run_kwargs(input_files, batched, batch_size=16, overlap_writes=overlap_writes)
+    )
+
+    for name in ("gslr.nc", "lslr.nc"):
+        expected = xr.open_dataset(whole / name)
+        actual = xr.open_dataset(batched / name)
+        np.testing.assert_array_equal(
+            actual["sea_level_change"], expected["sea_level_change"]
+        )
+        assert actual.attrs["provenance"] == expected.attrs["provenance"]
+
+
+def test_project_landwaterstorage_quantile_tolerance(input_files, tmp_path):
+    """
+    Test that adaptive projection stops early once converged and records how in both outputs.
+    """
+    full = tmp_path / "full"
+    full.mkdir()
+    project_landwaterstorage(**run_kwargs(input_files, full, nsamps=200))
+
+    converged = tmp_path / "converged"
+    converged.mkdir()
+    project_landwaterstorage(
+        **run_kwargs(
+            input_files,
+            converged,
+            nsamps=200,
+            batch_size=100,
+            quantile_tolerance=1e6,
+        )
+    )
+    capped = tmp_path / "capped"
+    capped.mkdir()
+    project_landwaterstorage(
+        **run_kwargs(
+            input_files,
+            capped,
+            nsamps=200,
+            batch_size=50,
+            quantile_tolerance=1e-9,
+        )
+    )
+
+    expected = xr.open_dataset(full / "gslr.nc")
+    for name in ("gslr.nc", "lslr.nc"):
+        actual = xr.open_dataset(converged / name)
+        assert actual.sizes["samples"] == 100
+        assert actual.attrs["nsamps"] == 100
+        assert actual.attrs["converged"] == 1
+        assert actual.attrs["quantile_error"] <= 1e6
+        actual = xr.open_dataset(capped / name)
+        assert actual.sizes["samples"] == 200
+        assert actual.attrs["converged"] == 0
+    # Adaptive runs give the first samples of a full run.
+    np.testing.assert_array_equal(
+        xr.open_dataset(converged / "gslr.nc")["sea_level_change"],
+        expected["sea_level_change"][:100],
+    )
+
+
+def test_project_landwaterstorage_population_ensemble(input_files, tmp_path):
+    """
+    Test that an ensemble of copies of one SSP's population gives that SSP's projection.
+    """
+    table = np.loadtxt(input_files["popscen_file"], delimiter=",", skiprows=1)
+    # SSP5 is the second scenario column, extended at the UN medium rates.
+    ensemble_file = tmp_path / "ensemble.csv"
+    ensemble_file.write_text(
+        "year,a,b,c\n"
+        + "".join(f"{row[0]:.0f},{row[2]},{row[2]},{row[2]}\n" for row in table)
+    )
+
+    ssp = tmp_path / "ssp"
+    ssp.mkdir()
+    project_landwaterstorage(**run_kwargs(input_files, ssp))
+    ensemble = tmp_path / "ensemble"
+    ensemble.mkdir()
+    project_landwaterstorage(
+        **run_kwargs(
+            input_files,
+            ensemble,
+            popscen_file=None,
+            population_ensemble_file=str(ensemble_file),
+        )
+    )
+
+    for name in ("gslr.nc", "lslr.nc"):
+        np.testing.assert_array_equal(
+            xr.open_dataset(ensemble / name)["sea_level_change"],
+            xr.open_dataset(ssp / name)["sea_level_change"],
+        )
+    with pytest.raises(ValueError, match="exactly one"):
+        project_landwaterstorage(
+            **run_kwargs(
+                input_files, ensemble, population_ensemble_file=str(ensemble_file)
+            )
+        )
+    with pytest.raises(ValueError, match="exactly one"):
+        project_landwaterstorage(**run_kwargs(input_files, ensemble, popscen_file=None))
+
+
+def test_project_landwaterstorage_compression_threads(input_files, tmp_path):
+    """
+    Test that pre-compressed chunk writes change neither the outputs nor their provenance.
+    """
+    pytest.importorskip("h5py")
+    plain = tmp_path / "plain"
+    plain.mkdir()
+    project_landwaterstorage(**run_kwargs(input_files, plain, chunk_layout="by-sample"))
+    direct = tmp_path / "direct"
+    direct.mkdir()
+    project_landwaterstorage(
+        **run_kwargs(
+            input_files, direct, chunk_layout="by-sample", compression_threads=2
+        )
+    )
+
+    for name in ("gslr.nc", "lslr.nc"):
+        expected = xr.open_dataset(plain / name)
+        actual = xr.open_dataset(direct / name)
+        np.testing.assert_array_equal(
+            actual["sea_level_change"], expected["sea_level_change"]
+        )
+        assert actual.attrs["provenance"] == expected.attrs["provenance"]
+
+
+def test_project_landwaterstorage_bootstrap(input_files, tmp_path):
+    """
+    Test that a bootstrap fit ensemble gives reproducible outputs, with one or several fit workers.
+    """
+    plain = tmp_path / "plain"
+    plain.mkdir()
+    project_landwaterstorage(**run_kwargs(input_files, plain))
+    serial = tmp_path / "serial"
+    serial.mkdir()
+    project_landwaterstorage(
+        **run_kwargs(input_files, serial, bootstrap=40, fit_workers=1)
+    )
+    pooled = tmp_path / "pooled"
+    pooled.mkdir()
+    project_landwaterstorage(
+        **run_kwargs(input_files, pooled, bootstrap=40, fit_workers=2)
+    )
+
+    for name in ("gslr.nc", "lslr.nc"):
+        expected = xr.open_dataset(serial / name)
+        actual = xr.open_dataset(pooled / name)
+        np.testing.assert_array_equal(
+            actual["sea_level_change"], expected["sea_level_change"]
+        )
+        assert np.isfinite(actual["sea_level_change"]).all()
+        assert actual.attrs["provenance"] == expected.attrs["provenance"]
+        other = xr.open_dataset(plain / name)
+        assert other.attrs["provenance"] != actual.attrs["provenance"]
+        assert not np.array_equal(other["sea_level_change"], actual["sea_level_change"])
+
+
+@pytest.mark.parametrize("batch_size", [None, 20])
+def test_project_landwaterstorage_compute_dtype(input_files, tmp_path, batch_size):
+    """
+    Test that computing in float32 agrees with float64 to the float32 output precision.
+    """
+    double = tmp_path / "double"
+    double.mkdir()
+    project_landwaterstorage(**run_kwargs(input_files, double))
+    single = tmp_path / "single"
+    single.mkdir()
+    project_landwaterstorage(
+        **run_kwargs(
+            input_files, single, compute_dtype="float32", batch_size=batch_size
+        )
+    )
+
+    for name in ("gslr.nc", "lslr.nc"):
+        expected = xr.open_dataset(double / name)
+        actual = xr.open_dataset(single / name)
+        # A few roundings to float32 of values up to the largest output.
+        atol = 4 * np.finfo(np.float32).eps * np.abs(expected["sea_level_change"]).max()
+        np.testing.assert_allclose(
+            actual["sea_level_change"], expected["sea_level_change"], rtol=0, atol=atol
+        )
+        assert actual.attrs["provenance"] != expected.attrs["provenance"]
+
+
+def test_project_landwaterstorage_fingerprint_components(input_files, tmp_path):
+    """
+    Test that GWD and dam samples are localized with their own fingerprints, in and out of batches.
+    """
+    with Dataset(input_files["fp_file"], "a") as rootgrp:
+        ground = rootgrp["GROUND"]
+        same = rootgrp.createVariable("SAME", "f8", ground.dimensions)
+        same[:] = ground[:]
+        dam = rootgrp.createVariable("DAM", "f8", ground.dimensions)
+        dam[:] = 2 * ground[:] - 50
+
+    plain = tmp_path / "plain"
+    plain.mkdir()
+    project_landwaterstorage(**run_kwargs(input_files, plain))
+    runs = {}
+    for name, variable, batch_size in [
+        ("same", "SAME", None),
+        ("dam", "DAM", None),
+        ("dam_batches", "DAM", 20),
+    ]:
+        runs[name] = tmp_path / name
+        runs[name].mkdir()
+        project_landwaterstorage(
+            **run_kwargs(
+                input_files,
+                runs[name],
+                dam_fp_variable=variable,
+                batch_size=batch_size,
+            )
+        )
+
+    def samples(outdir, name):
+        return xr.open_dataset(outdir / name)["sea_level_change"].values
+
+    for outdir in runs.values():
+        np.testing.assert_allclose(
+            samples(outdir, "gslr.nc"), samples(plain, "gslr.nc"), rtol=1e-6
+        )
+    np.testing.assert_allclose(
+        samples(runs["same"], "lslr.nc"), samples(plain, "lslr.nc"), rtol=1e-6
+    )
+    np.testing.assert_array_equal(
+        samples(runs["dam_batches"], "lslr.nc"), samples(runs["dam"], "lslr.nc")
+    )
+    assert not np.allclose(samples(runs["dam"], "lslr.nc"), samples(plain, "lslr.nc"))
+
+
+@pytest.mark.parametrize("batch_size", [None, 20])
+def test_project_landwaterstorage_location_sets(input_files, tmp_path, batch_size):
+    """
+    Test that several location sets are localized from one projection, like separate runs.
+    """
+    cities = tmp_path / "cities.lst"
+    cities.write_text("Lagos\t21\t6.45\t3.39\nLima\t22\t-12.05\t-77.04\n")
+    separate = {}
+    for name, location_file in [
+        ("gauges", input_files["location_file"]),
+        ("cities", str(cities)),
+    ]:
+        separate[name] = tmp_path / name
+        separate[name].mkdir()
+        project_landwaterstorage(
+            **run_kwargs(
+                input_files,
+                separate[name],
+                location_file=location_file,
+                batch_size=batch_size,
+            )
+        )
+
+    project_landwaterstorage(
+        **run_kwargs(
+            input_files,
+            tmp_path,
+            location_file=[input_files["location_file"], str(cities)],
+            output_lslr_file=[
+                str(tmp_path / "gauges.nc"),
+                str(tmp_path / "cities.nc"),
+            ],
+            batch_size=batch_size,
+        )
+    )
+
+    def samples(fl):
+        return xr.open_dataset(fl)["sea_level_change"].values
+
+    np.testing.assert_array_equal(
+        samples(tmp_path / "gslr.nc"), samples(separate["gauges"] / "gslr.nc")
+    )
+    for name in separate:
+        np.testing.assert_array_equal(
+            samples(tmp_path / f"{name}.nc"), samples(separate[name] / "lslr.nc")
+        )
+
+    with pytest.raises(ValueError, match="2 location files but 1 local SLR"):
+        project_landwaterstorage(
+            **run_kwargs(
+                input_files,
+                tmp_path,
+                location_file=[input_files["location_file"], str(cities)],
+            )
+        )
+
+
+@pytest.mark.parametrize("batch_size", [None, 20])
+def test_project_landwaterstorage_profile_dir(input_files, tmp_path, batch_size):
+    """
+    Test that a run with a profile_dir leaves a profile per stage and a trace of localization.
+    """
+    project_landwaterstorage(
+        **run_kwargs(
+            input_files,
+            tmp_path,
+            batch_size=batch_size,
+            profile_dir=str(tmp_path / "profile"),
+        )
+    )
+
+    stages = ["preprocess", "fit"]
+    stages += ["project", "localize"] if batch_size is None else ["project_batches"]
+    for stage in stages:
+        assert (tmp_path / "profile" / f"{stage}.prof").exists()
+    events = json.loads((tmp_path / "profile" / "trace.json").read_text())[
+        "traceEvents"
+    ]
+    assert [e["name"] for e in events if e.get("cat") == "stage"] == stages
+
+
+def test_batch_landwaterstorage(input_files, tmp_path):
+    """
+    Test that batch runs share stages, match single runs and report failures without stopping.
+    """
+    single = tmp_path / "single"
+    single.mkdir()
+    project_landwaterstorage(**run_kwargs(input_files, single, seed=7))
+
+    runs = [
+        run_kwargs(
+            input_files,
+            tmp_path,
+            name=f"seed{seed}",
+            seed=seed,
+            output_gslr_file=str(tmp_path / f"gslr{seed}.nc"),
+            output_lslr_file=str(tmp_path / f"lslr{seed}.nc"),
+        )
+        for seed in (1, 7)
+    ]
+    runs.append(
+        run_kwargs(
+            input_files,
+            tmp_path,
+            scenario="rcp99",
+            output_gslr_file=str(tmp_path / "bad_gslr.nc"),
+            output_lslr_file=str(tmp_path / "bad_lslr.nc"),
+        )
+    )
+
+    reports = service.batch_landwaterstorage(runs)
+
+    assert [r["status"] for r in reports] == ["ok", "ok", "failed"]
+    assert reports[0]["reused"] == {}
+    assert reports[1]["reused"] == {"preprocess": 1, "fit": 1, "localization": 1}
+    assert "rcp99" in reports[2]["error"]
+    for name in ("gslr", "lslr"):
+        np.testing.assert_array_equal(
+            xr.open_dataset(tmp_path / f"{name}7.nc")["sea_level_change"],
+            xr.open_dataset(single / f"{name}.nc")["sea_level_change"],
+        )
+    with pytest.raises(ValueError, match="unknown options"):
+        service.batch_landwaterstorage([{**runs[0], "nsamp": 10}])
+    with pytest.raises(ValueError, match="like an earlier run"):
+        service.batch_landwaterstorage([runs[0], runs[0]])
+
+
+def test_stage_cache_evicts_least_recently_used():
+    """
+    Test that a bounded StageCache drops the least recently used stage outputs.
+    """
+    cache = service.StageCache(max_entries=2)
+    computed = []
+
+    def get(name):
+        return cache.get(name, "key", lambda: computed.append(name) or name)
+
+    for name in ["a", "b", "a", "c", "a", "b"]:
+        assert get(name) == name
+
+    assert computed == ["a", "b", "c", "b"]
+    assert cache.hits == {"a": 2}
+    assert len(cache) == 2
+
+
+def test_batch_landwaterstorage_workers_share_stages(input_files, tmp_path):
+    """
+    Test that runs in worker processes reuse the stages they share, prepared once.
+    """
+    runs = [
+        run_kwargs(
+            input_files,
+            tmp_path,
+            seed=seed,
+            output_gslr_file=str(tmp_path / f"gslr{seed}.nc"),
+            output_lslr_file=str(tmp_path / f"lslr{seed}.nc"),
+        )
+        for seed in (1, 2, 3)
+    ]
+    runs.append(
+        run_kwargs(
+            input_files,
+            tmp_path,
+            scenario="rcp99",
+            output_gslr_file=str(tmp_path / "bad_gslr.nc"),
+            output_lslr_file=str(tmp_path / "bad_lslr.nc"),
+        )
+    )
+
+    reports = service.batch_landwaterstorage(runs, workers=2)
+
+    assert [r["status"] for r in reports] == ["ok", "ok", "ok", "failed"]
+    for report in reports[:3]:
+        assert report["reused"] == {"preprocess": 1, "fit": 1, "localization": 1}
+    serial = service.batch_landwaterstorage(
+        [
+            {
+                **run,
+                "output_gslr_file": run["output_gslr_file"] + ".serial",
+                "output_lslr_file": run["output_lslr_file"] + ".serial",
+            }
+            for run in runs[:3]
+        ]
+    )
+    for run, report in zip(runs, serial):
+        assert report["status"] == "ok"
+        for name in ("output_gslr_file", "output_lslr_file"):
+            np.testing.assert_array_equal(
+                xr.open_dataset(run[name])["sea_level_change"],
+                xr.open_dataset(run[name] + ".serial")["sea_level_change"],
+            )
+
+
+def test_serve_landwaterstorage(input_files, tmp_path):
+    """
+    Test that served jobs from the spool and socket share stages, and that bad jobs fail alone.
+    """
+    single = tmp_path / "single"
+    single.mkdir()
+    project_landwaterstorage(**run_kwargs(input_files, single, seed=7))
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    socket_path = str(tmp_path / "serve.sock")
+    stop = threading.Event()
+    server = threading.Thread(
+        target=service.serve_landwaterstorage,
+        kwargs=dict(
+            spool_dir=str(spool),
+            socket_path=socket_path,
+            cache_size=8,
+            poll_interval=0.05,
+            stop=stop,
+        ),
+    )
+    server.start()
+    try:
+        (spool / ".first.json").write_text(
+            json.dumps(run_kwargs(input_files, tmp_path, name="first"))
+        )
+        (spool / ".first.json").rename(spool / "first.json")
+        (spool / "bad.json").write_text("[1, 2]")
+        deadline = time.monotonic() + 60
+        while not (spool / "first.json.done").exists():
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+        def send(line):
+            while not os.path.exists(socket_path):
+                time.sleep(0.05)
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                conn.connect(socket_path)
+                conn.sendall(line.encode() + b"\n")
+                return json.loads(conn.makefile("rb").readline())
+
+        second = send(
+            json.dumps(
+                run_kwargs(
+                    input_files,
+                    tmp_path,
+                    seed=7,
+                    output_gslr_file=str(tmp_path / "gslr7.nc"),
+                    output_lslr_file=str(tmp_path / "lslr7.nc"),
+                )
+            )
+        )
+        rejected = send(json.dumps({"nsamps": 10}))
+    finally:
+        stop.set()
+        server.join()
+
+    first = json.loads((spool / "first.report.json").read_text())
+    assert first["status"] == "ok" and first["name"] == "first"
+    assert (spool / "bad.json.failed").exists()
+    assert "table of run options" in (spool / "bad.report.json").read_text()
+    assert second["status"] == "ok"
+    assert second["reused"] == {"preprocess": 1, "fit": 1, "localization": 1}
+    assert rejected["status"] == "failed" and "missing options" in rejected["error"]
+    assert not os.path.exists(socket_path)
+    for name in ("gslr", "lslr"):
+        np.testing.assert_array_equal(
+            xr.open_dataset(tmp_path / f"{name}7.nc")["sea_level_change"],
+            xr.open_dataset(single / f"{name}.nc")["sea_level_change"],
+        )
+
+
+def test_serve_landwaterstorage_concurrent_reuse(input_files, tmp_path, monkeypatch):
+    """
+    Test that jobs served at the same time each report only the stages they reused.
+    """
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    stop = threading.Event()
+    server = threading.Thread(
+        target=service.serve_landwaterstorage,
+        kwargs=dict(
+            spool_dir=str(spool),
+            socket_path=str(tmp_path / "serve.sock"),
+            workers=2,
+            poll_interval=0.05,
+            stop=stop,
+        ),
+    )
+
+    def wait_for(*names):
+        deadline = time.monotonic() + 60
+        while not all((spool / f"{n}.json.done").exists() for n in names):
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+    def spool_job(name):
+        kwargs = run_kwargs(
+            input_files,
+            tmp_path,
+            name=name,
+            output_gslr_file=str(tmp_path / f"gslr_{name}.nc"),
+            output_lslr_file=str(tmp_path / f"lslr_{name}.nc"),
+        )
+        (spool / f".{name}.json").write_text(json.dumps(kwargs))
+        (spool / f".{name}.json").rename(spool / f"{name}.json")
+
+    server.start()
+    try:
+        spool_job("warm")
+        wait_for("warm")
+        # Hold both jobs until the other has reused its stages too.
+        barrier = threading.Barrier(2, timeout=60)
+        localize_sets = service._localize_sets
+
+        def overlapping(*args, **kwargs):
+            barrier.wait()
+            return localize_sets(*args, **kwargs)
+
+        monkeypatch.setattr(service, "_localize_sets", overlapping)
+        spool_job("a")
+        spool_job("b")
+        wait_for("a", "b")
+    finally:
+        stop.set()
+        server.join()
+
+    for name in ("a", "b"):
+        report = json.loads((spool / f"{name}.report.json").read_text())
+        assert report["status"] == "ok"
+        assert report["reused"] == {"preprocess": 1, "fit": 1, "localization": 1}
+
+
+def test_estimate_landwaterstorage_components(input_files):
+    """
+    Test that a run localizing components with their own fingerprints is estimated to need more memory.
+    """
+    args = (input_files["location_file"], 2005, 2020, 2100, 20, 50000, 2)
+
+    single = service.estimate_landwaterstorage(*args)
+    split = service.estimate_landwaterstorage(*args, dam_fp_variable="GROUND_COPY")
+
+    assert split["peak_memory"] > single["peak_memory"]
+
+
+def test_project_landwaterstorage_bootstrap_conflicts(input_files, tmp_path):
+    """
+    Test that options a bootstrap ensemble would override are rejected rather than ignored.
+    """
+    with pytest.raises(ValueError, match="dotriangular"):
+        project_landwaterstorage(
+            **run_kwargs(input_files, tmp_path, bootstrap=10, dotriangular=True)
+        )
+
+    stage = service._read_and_preprocess(
+        input_files["pophist_file"],
+        input_files["reservoir_file"],
+        input_files["popscen_file"],
+        input_files["gwd_files"],
+        "ssp5",
+        False,
+        2005,
+        2020,
+        2100,
+        20,
+    )
+    out_fit = fit(stage["data"], stage["config"], "test", n_bootstrap=10, workers=1)
+    settings = parameter_grid(
+        {
+            "dcyear_start": 2020,
+            "dcyear_end": 2040,
+            "dcrate_lo": 0.0,
+            "dcrate_hi": 0.1,
+            "dgwd_dt_dpop_pcterr": stage["config"]["dgwd_dt_dpop_pcterr"],
+            "dam_pcterr": stage["config"]["dam_pcterr"],
+        },
+        {"dam_pcterr": [0.25, 0.5]},
+    )
+    with pytest.raises(ValueError, match="dam_pcterr"):
+        next(project_sweep_batches(out_fit, stage["config"], 10, 0, settings))
+
+
+def test_serve_landwaterstorage_recovers_spool(input_files, tmp_path):
+    """
+    Test that jobs left running by a dead daemon run again, but not those another daemon holds.
+    """
+    import fcntl
+
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    for name in ("stale", "held"):
+        (spool / f"{name}.json.running").write_text(
+            json.dumps(
+                run_kwargs(
+                    input_files,
+                    tmp_path,
+                    name=name,
+                    output_gslr_file=str(tmp_path / f"gslr_{name}.nc"),
+                    output_lslr_file=str(tmp_path / f"lslr_{name}.nc"),
+                )
+            )
+        )
+    stop = threading.Event()
+    with open(spool / "held.json.running", "rb") as held:
+        fcntl.flock(held, fcntl.LOCK_EX)
+        server = threading.Thread(
+            target=service.serve_landwaterstorage,
+            kwargs=dict(spool_dir=str(spool), poll_interval=0.05, stop=stop),
+        )
+        server.start()
+        try:
+            deadline = time.monotonic() + 60
+            while not (spool / "stale.json.done").exists():
+                assert time.monotonic() < deadline
+                time.sleep(0.05)
+        finally:
+            stop.set()
+            server.join()
+
+    assert json.loads((spool / "stale.report.json").read_text())["status"] == "ok"
+    assert (spool / "held.json.running").exists()
+    assert not (spool / "held.report.json").exists()
+
+
+def test_serve_landwaterstorage_reports_shutdown():
+    """
+    Test that a job sent while the daemon shuts down gets a failed report back.
+    """
+    pool = ThreadPoolExecutor(max_workers=1)
+    pool.shutdown()
+    slots = threading.BoundedSemaphore(1)
+    client, conn = socket.socketpair()
+    with client:
+        client.sendall(b'{"name": "late"}\n')
+        service._handle_connection(conn, pool, slots, run_job=None)
+        report = json.loads(client.makefile("rb").readline())
+
+    assert report["status"] == "failed" and "shutdown" in report["error"]
+    assert slots.acquire(blocking=False)